@@ -0,0 +1,8 @@
+"""
+Benchmarks for mkpw.
+
+Run with ``python -m benchmarks`` from the top-level source directory; see
+``python -m benchmarks --help``.  All benchmarks except the CLI cold-start
+measurement read from deterministic in-memory entropy streams, so that they
+don't depend on the state of the system's random number generator.
+"""
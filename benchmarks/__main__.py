@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import sys
+import os.path
+import json
+import platform
+import argparse
+
+from mkpw import __version__
+
+from .suite import run_benchmarks, compare_to_baseline
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description="Run the mkpw benchmarks",
+    )
+    parser.add_argument('-o', '--output', default=None,
+                        help="Write the results as JSON to this file (default: standard output)")
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE,
+                        help="Baseline JSON results to compare against (default: %(default)s)")
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help="Relative slowdown with respect to the baseline which counts as a "
+                        "regression (default: %(default)s)")
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help="Store the results as the new baseline instead of comparing")
+    parser.add_argument('-k', '--select', action='append', default=None,
+                        help="Only run benchmarks whose name starts with this prefix "
+                        "(may be repeated)")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Scale the amount of work done by each benchmark")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of repetitions; the best time is kept (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(scale=args.scale, repeat=args.repeat, select=args.select)
+
+    doc = {
+        'mkpw_version': __version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fw:
+            json.dump(doc, fw, indent=2)
+            fw.write('\n')
+        sys.stderr.write("Saved baseline to %s\n"%(args.baseline))
+        return 0
+
+    text = json.dumps(doc, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fw:
+            fw.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+    if not os.path.exists(args.baseline):
+        sys.stderr.write("No baseline found at %s, skipping comparison\n"%(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+
+    regressions = 0
+    for name, bvalue, value, change, is_regression in \
+            compare_to_baseline(results, baseline, args.threshold):
+        sys.stderr.write("%-40s %14.6g -> %14.6g  %+7.1f%%%s\n"%(
+            name, bvalue, value, 100*change, '  REGRESSION' if is_regression else ''))
+        if is_regression:
+            regressions += 1
+
+    if regressions:
+        sys.stderr.write("%d regression(s) beyond %.0f%%\n"%(regressions, 100*args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Concurrency check for `mkpw.aio.agenerate_passwords()`.
+
+Runs many large requests at once on a single event loop, more than the loop's
+default executor has threads, and checks that all of them finish within a
+timeout (rather than deadlocking with every executor thread waiting for
+entropy), with the right number of distinct passwords.
+
+Run with ``python -m benchmarks.aio``; exits with a nonzero status if a check
+fails.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from mkpw.aio import agenerate_passwords
+from mkpw.__main__ import make_argument_parser
+
+
+SOURCES = ('/dev/urandom', 'getrandom:')
+
+DEFAULT_TIMEOUT = 60.0
+
+
+def default_executor_threads():
+    # see concurrent.futures.ThreadPoolExecutor
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+async def run_requests(spec, nrequests, count, timeout):
+    """
+    Run `nrequests` concurrent requests of `count` passwords each.  Returns
+    `(seconds, list of password lists)`; raises `asyncio.TimeoutError` if they
+    don't all finish within `timeout` seconds.
+    """
+    args = make_argument_parser().parse_args(['-w', '-e', spec])
+
+    async def request():
+        return [ pw async for pw in agenerate_passwords(args, count) ]
+
+    t0 = time.perf_counter()
+    results = await asyncio.wait_for(
+        asyncio.gather(*[ request() for j in range(nrequests) ]), timeout
+    )
+    return time.perf_counter() - t0, results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.aio',
+                                     description="Concurrency check of mkpw.aio")
+    parser.add_argument('-r', '--requests', type=int, default=None,
+                        help="Number of concurrent requests (default: twice the number of "
+                        "threads of the default executor)")
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help="Passwords per request (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds before a run counts as deadlocked (default: %(default)s)")
+    args = parser.parse_args()
+
+    nrequests = args.requests or 2 * default_executor_threads()
+
+    failed = []
+    for spec in SOURCES:
+        try:
+            dt, results = asyncio.run(run_requests(spec, nrequests, args.count, args.timeout))
+        except asyncio.TimeoutError:
+            failed.append("%s: %d requests did not finish within %gs"
+                          %(spec, nrequests, args.timeout))
+            continue
+        passwords = [ pw for r in results for pw in r ]
+        sys.stdout.write("%-13s %3d requests of %d: %8.0f passwords/s\n"
+                         %(spec, nrequests, args.count, len(passwords)/dt))
+        if len(passwords) != nrequests * args.count:
+            failed.append("%s: %d passwords instead of %d"
+                          %(spec, len(passwords), nrequests * args.count))
+        if len(set(passwords)) != len(passwords):
+            failed.append("%s: %d duplicate passwords"
+                          %(spec, len(passwords) - len(set(passwords))))
+
+    for msg in failed:
+        sys.stdout.write("FAIL: %s\n"%(msg))
+    if not failed:
+        sys.stdout.write("OK\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Known-answer check for `mkpw.drbg`.
+
+Runs each DRBG mechanism, instantiated with SHA-256 instead of SHA-512, on a
+test vector of the NIST CAVP DRBG test suite (drbgvectors_no_reseed,
+PredictionResistance = False, no personalization string and no additional
+input): instantiate with the vector's EntropyInput and Nonce, generate 1024
+bits and discard them, generate another 1024 bits and compare them with the
+vector's ReturnedBits.
+
+The SHA-512 mechanisms that mkpw actually uses share all of their code with
+these; they are also run, with a reseed and additional input, against values
+recorded from this implementation, so that an accidental change of their output
+(which would change every seeded `--drbg` run) is caught as well.
+
+Run with ``python -m benchmarks.drbg``; exits with a nonzero status if a check
+fails.
+"""
+
+import sys
+import hashlib
+
+from mkpw.drbg import HashDrbg, HmacDrbg
+
+
+class HashDrbgSha256(HashDrbg):
+    HASH = hashlib.sha256
+    OUTLEN = 32
+    SEEDLEN = 55
+
+
+class HmacDrbgSha256(HmacDrbg):
+    HASH_NAME = 'sha256'
+    OUTLEN = 32
+
+
+# CAVP vectors
+# ------------
+
+# (name, class, EntropyInput, Nonce, ReturnedBits)
+CAVP_VECTORS = [
+    ('Hash_DRBG SHA-256', HashDrbgSha256,
+     'a65ad0f345db4e0effe875c3a2e71f42c7129d620ff5c119a9ef55f05185e0fb',
+     '8581f9317517276e06e9607ddbcbcc2e',
+     'd3e160c35b99f340b2628264d1751060e0045da383ff57a57d73a673d2b8d80d'
+     'aaf6a6c35a91bb4579d73fd0c8fed111b0391306828adfed528f018121b3febd'
+     'c343e797b87dbb63db1333ded9d1ece177cfa6b71fe8ab1da46624ed6415e51c'
+     'cde2c7ca86e283990eeaeb91120415528b2295910281b02dd431f4c9f70427df'),
+    ('HMAC_DRBG SHA-256', HmacDrbgSha256,
+     'ca851911349384bffe89de1cbdc46e6831e44d34a4fb935ee285dd14b71a7488',
+     '659ba96c601dc69fc902940805ec0ca8',
+     'e528e9abf2dece54d47c7e75e5fe302149f817ea9fb4bee6f4199697d04d5b89'
+     'd54fbb978a15b5c443c9ec21036d2460b6f73ebad0dc2aba6e624abf07745bc1'
+     '07694bb7547bb0995f70de25d6b29e2d3011bb19d27676c07162c8b5ccde0668'
+     '961df86803482cb37ed6d5c0bb8d50cf1f50d476aa0458bdaba806f48be9dcb8'),
+]
+
+
+# Recorded SHA-512 outputs
+# ------------------------
+
+# (name, class, output before the reseed, output after it); see `run_recorded`
+RECORDED_OUTPUTS = [
+    ('Hash_DRBG SHA-512', HashDrbg,
+     'e5038d1c4c2e364dd711c8f64107fa6cbf3d61ffeb96cd189198c7f17b4d35b5'
+     'f691a1e8f6023e4cae39818dea103f0a4c652b679a5334592419ecfb38d4a40c',
+     '4d1de297b502f7d8dd39dc6e810a87587d19ecdbcbca840b107c17d10b650c9c'
+     '2e856486dd1debc976b17554922b4827d9d4769dbd8da8f311aec1f2bb152806'
+     '7029530966d90e44b4deef62056515dae23c777ea7e4b63dbe8852b2ae2d103e'
+     '51b21ba0'),
+    ('HMAC_DRBG SHA-512', HmacDrbg,
+     '673799c1a652865acfeed2eb465ad1f646c6900bcee43ffaa9121cc7901639f5'
+     'a823cc923f0bed8fb9e94aac764450d4fe82f1b0202b0b79e9110070521d8407',
+     '6e14f7c0f0749b400055991d5006cc88e1e1e3c0246dce1ef5e742dbe2ad854c'
+     '7030379b2753265842ee998f1f76fff733cd4c46db04d247a1fd91a774261fe7'
+     '0d2af421060106468465507343fe911097b5b7ffbed256d77fc78fa052f8d1df'
+     '34d3ef56'),
+]
+
+
+def run_cavp(cls, entropy_input, nonce, nbytes):
+    """
+    Run the CAVP no-reseed procedure on `cls`; returns the second output.
+    """
+    drbg = cls(bytes.fromhex(entropy_input), bytes.fromhex(nonce))
+    drbg.generate(nbytes)
+    return drbg.generate(nbytes)
+
+
+def run_recorded(cls):
+    """
+    Instantiate `cls` with a fixed input and personalization string, generate,
+    reseed with additional input and generate again with additional input.
+    Returns both outputs.
+    """
+    drbg = cls(bytes(range(32)), bytes(range(32, 48)), b'mkpw')
+    first = drbg.generate(64)
+    drbg.reseed(bytes(range(48, 80)), b'add')
+    return first, drbg.generate(100, b'extra')
+
+
+def main():
+    failed = []
+
+    for name, cls, entropy_input, nonce, expected in CAVP_VECTORS:
+        expected = bytes.fromhex(expected)
+        ok = run_cavp(cls, entropy_input, nonce, len(expected)) == expected
+        sys.stdout.write("%-18s CAVP vector:      %s\n"%(name, 'pass' if ok else 'FAIL'))
+        if not ok:
+            failed.append("%s: ReturnedBits don't match the CAVP vector"%(name))
+
+    for name, cls, first, second in RECORDED_OUTPUTS:
+        ok = run_recorded(cls) == (bytes.fromhex(first), bytes.fromhex(second))
+        sys.stdout.write("%-18s recorded output:  %s\n"%(name, 'pass' if ok else 'FAIL'))
+        if not ok:
+            failed.append("%s: output differs from the recorded one"%(name))
+
+    for msg in failed:
+        sys.stdout.write("FAIL: %s\n"%(msg))
+    if not failed:
+        sys.stdout.write("OK\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Check that a reservoir entropy source never hands out the same bytes twice,
+even when a single `mkpw.entropy.ReservoirEntropySource` is read from several
+threads at once (as happens with `default_entropy_pool` in the server, in the
+prefetch pool's refill thread, or in user code).
+
+The reservoir is filled with distinct 8-byte counters, so that every block
+read can be traced back to its offset.  Several threads then read blocks with
+`readview()` and `readinto()` until the reservoir is exhausted, and the check
+fails if any offset was read twice or if the ledger doesn't account for every
+byte read.
+
+Run with ``python -m benchmarks.reservoir``; exits with a nonzero status if a
+check fails.
+"""
+
+import os
+import sys
+import struct
+import tempfile
+import threading
+import argparse
+
+from mkpw.entropy import ReservoirEntropySource, LEDGER_SUFFIX
+
+
+BLOCK = 64
+
+
+def make_reservoir(path, nblocks):
+    """
+    Write a reservoir of `nblocks` blocks, each starting with its index.
+    """
+    with open(path, 'wb') as f:
+        for j in range(nblocks):
+            f.write(struct.pack('<Q', j) + os.urandom(BLOCK - 8))
+
+
+def hammer(path, nthreads, use_readinto):
+    """
+    Read the reservoir at `path` from `nthreads` threads through one source,
+    block by block, until it is exhausted.  Returns `(block indices, errors)`.
+    """
+    source = ReservoirEntropySource('reservoir:' + path, path)
+    results = [ [] for k in range(nthreads) ]
+    errors = []
+    start = threading.Barrier(nthreads)
+
+    def worker(k):
+        buf = bytearray(BLOCK)
+        start.wait()
+        try:
+            while True:
+                if use_readinto:
+                    # readinto() may return a short read at the end of a
+                    # region; keep blocks aligned by reading the rest
+                    view = memoryview(buf)
+                    pos = 0
+                    while pos < BLOCK:
+                        pos += source.readinto(view[pos:])
+                    dat = bytes(buf)
+                else:
+                    dat = bytes(source.readview(BLOCK))
+                results[k].append(struct.unpack('<Q', dat[:8])[0])
+        except EOFError:
+            pass
+        except Exception as e:
+            errors.append("thread %d: %s: %s"%(k, e.__class__.__name__, e))
+
+    threads = [ threading.Thread(target=worker, args=(k,)) for k in range(nthreads) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    source.close()
+    return [ j for r in results for j in r ], errors
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.reservoir',
+                                     description="Thread-safety check of reservoir sources")
+    parser.add_argument('-t', '--threads', type=int, default=8,
+                        help="Number of reading threads (default: %(default)s)")
+    parser.add_argument('-n', '--blocks', type=int, default=160000,
+                        help="Size of the reservoir in %d-byte blocks (default: %%(default)s)"
+                        %(BLOCK))
+    args = parser.parse_args()
+
+    failed = []
+    tmpdir = tempfile.TemporaryDirectory()
+    for method, use_readinto in (('readview', False), ('readinto', True)):
+        path = os.path.join(tmpdir.name, 'reservoir-%s.bin'%(method))
+        make_reservoir(path, args.blocks)
+        blocks, errors = hammer(path, args.threads, use_readinto)
+        with open(path + LEDGER_SUFFIX, 'rb') as f:
+            used = int(f.read().strip())
+        ndup = len(blocks) - len(set(blocks))
+        sys.stdout.write("%-8s %2d threads: %d blocks read, %d duplicates, %d of %d bytes "
+                         "used\n"%(method, args.threads, len(blocks), ndup, used,
+                                   args.blocks * BLOCK))
+        failed += [ "%s: %s"%(method, e) for e in errors ]
+        if ndup:
+            failed.append("%s: %d blocks were read more than once"%(method, ndup))
+        if len(blocks) * BLOCK > used:
+            failed.append("%s: %d bytes read but only %d recorded in the ledger"
+                          %(method, len(blocks) * BLOCK, used))
+    tmpdir.cleanup()
+
+    for msg in failed:
+        sys.stdout.write("FAIL: %s\n"%(msg))
+    if not failed:
+        sys.stdout.write("OK\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Startup budget check for the command-line tool.
+
+Runs ``python -X importtime -m mkpw -w`` and checks that the time spent
+importing modules on behalf of mkpw (i.e., modules which a bare ``python -c
+pass`` doesn't import) stays below a budget, and that heavy modules which the
+fast path is not supposed to need are not imported at all, neither by the
+command-line tool nor by importing the `STARTUP_MODULES` from Python.  Also
+checks that the fast argument-parsing path gives the same settings as
+argparse.
+
+Run with ``python -m benchmarks.startup``; exits with a nonzero status if a
+check fails.  With ``--imports-only``, the import time is not measured, and
+the remaining checks don't depend on the speed of the machine (this is what
+the CI runs).
+"""
+
+import sys
+import subprocess
+import itertools
+import argparse
+
+
+# microseconds, best of several runs
+DEFAULT_BUDGET_US = 35000
+
+# modules which `mkpw -w` must not import
+FORBIDDEN_MODULES = ('numpy', 'argparse', 'logging', 'asyncio')
+
+# modules which must not import the FORBIDDEN_MODULES either
+STARTUP_MODULES = ('mkpw', 'mkpw.mkpw', 'mkpw.entropy', 'mkpw.__main__')
+
+STARTUP_ARGV = ['-w']
+
+
+def importtime(args):
+    """
+    Run `python -X importtime <args>` and return a dictionary
+    `{module: self-time-in-us}`.
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    times = {}
+    for line in p.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            selftime = int(fields[0])
+        except ValueError:
+            continue # header line
+        times[fields[2].strip()] = selftime
+    return times
+
+
+def measure_startup(argv=STARTUP_ARGV, runs=5):
+    """
+    Return `(import_us, modules)`: the smallest total self-time (in
+    microseconds) of the modules imported by `mkpw <argv>` on top of those
+    imported by a bare interpreter, over `runs` runs, and the set of those
+    modules.
+    """
+    bare = set(importtime(['-c', 'pass']).keys())
+    best = None
+    modules = None
+    for r in range(runs):
+        times = importtime(['-m', 'mkpw'] + list(argv))
+        extra = dict([ (m, t) for (m, t) in times.items() if m not in bare ])
+        total = sum(extra.values())
+        if best is None or total < best:
+            best = total
+            modules = set(extra.keys())
+    return best, modules
+
+
+def imported_modules(module):
+    """
+    Return the set of modules loaded by importing `module` in a fresh
+    interpreter.
+    """
+    p = subprocess.run([sys.executable, '-c',
+                        'import sys, %s; sys.stdout.write("\\n".join(sys.modules))'%(module)],
+                       stdout=subprocess.PIPE, check=True)
+    return set(p.stdout.decode('utf-8').split('\n'))
+
+
+def check_fast_path():
+    """
+    Return a list of error messages for preset combinations where the fast
+    argument-parsing path disagrees with argparse.
+    """
+    from mkpw.__main__ import parse_args_fast, make_argument_parser, FAST_PATH_PRESETS
+
+    def normalized(args):
+        return dict([ (k, repr(v)) for (k, v) in vars(args).items() ])
+
+    errors = []
+    presets = sorted(FAST_PATH_PRESETS.keys())
+    for n in range(0, 3):
+        for argv in itertools.permutations(presets, n):
+            argv = list(argv)
+            fast = normalized(parse_args_fast(argv))
+            full = normalized(make_argument_parser().parse_args(argv))
+            if fast != full:
+                errors.append("fast path differs for %r: %r != %r"%(argv, fast, full))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup',
+                                     description="Check the startup budget of mkpw")
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET_US,
+                        help="Import time budget in microseconds (default: %(default)s)")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="Number of runs; the best is kept (default: %(default)s)")
+    parser.add_argument('--imports-only', action='store_true', default=False,
+                        help="Only check which modules are imported, not how long it takes")
+    args = parser.parse_args()
+
+    failed = False
+
+    import_us, modules = measure_startup(runs=1 if args.imports_only else args.runs)
+    if not args.imports_only:
+        sys.stdout.write("mkpw %s: %d us importing %d modules (budget %d us)\n"%(
+            " ".join(STARTUP_ARGV), import_us, len(modules), args.budget))
+        if import_us > args.budget:
+            sys.stdout.write("FAIL: import time over budget\n")
+            failed = True
+
+    for m in FORBIDDEN_MODULES:
+        if m in modules:
+            sys.stdout.write("FAIL: module %s is imported by mkpw %s\n"
+                             %(m, " ".join(STARTUP_ARGV)))
+            failed = True
+
+    for module in STARTUP_MODULES:
+        loaded = imported_modules(module)
+        for m in FORBIDDEN_MODULES:
+            if m in loaded:
+                sys.stdout.write("FAIL: module %s is imported by 'import %s'\n"%(m, module))
+                failed = True
+
+    for err in check_fast_path():
+        sys.stdout.write("FAIL: %s\n"%(err))
+        failed = True
+
+    if not failed:
+        sys.stdout.write("OK\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
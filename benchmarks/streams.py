@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import random
+
+from mkpw.entropy import EntropySource
+
+
+
+class CyclicEntropyStream(EntropySource):
+    """
+    Deterministic in-memory entropy source for benchmarking.  Serves the bytes
+    of a fixed pseudo-random block generated from `seed`, cycling through it
+    forever.
+
+    Never use this for actual passwords!
+    """
+
+    parallel_safe = False
+
+    def __init__(self, seed=0, blocksize=1<<22):
+        super(CyclicEntropyStream, self).__init__('bench:%d'%(seed))
+        self.data = random.Random(seed).randbytes(blocksize)
+        self.view = memoryview(self.data)
+        self.pos = 0
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = len(out)
+        written = 0
+        while written < n:
+            k = min(n - written, len(self.data) - self.pos)
+            out[written:written+k] = self.view[self.pos:self.pos+k]
+            written += k
+            self.pos = (self.pos + k) % len(self.data)
+        return n
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import subprocess
+
+from mkpw.mkpw import (RandomSourceConcentrator, RandomStreamIntRecoder, NumpyIntRecoder,
+                       PasswordGenerator, CONCENTRATOR_ENGINES, import_numpy)
+from mkpw.entropy import EntropySourcePool
+from mkpw.__main__ import make_argument_parser
+
+from .streams import CyclicEntropyStream
+
+
+# registered benchmarks, in order: [ (name-prefix, function), ... ]
+BENCHMARKS = []
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+def best_time(fn, repeat):
+    """
+    Call `fn()` `repeat` times and return the shortest wall-clock time.
+    """
+    best = None
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def result(name, value, unit, higher_is_better=True):
+    return {
+        'name': name,
+        'value': value,
+        'unit': unit,
+        'higher_is_better': higher_is_better,
+    }
+
+
+# alphabet sizes: powers of two (no rejection) and worst cases 2^k+1 (almost
+# half of the draws rejected), plus the sizes of the usual categories
+RECODER_ALPHABET_SIZES = [2, 3, 16, 17, 26, 36, 62, 64, 65, 87, 256, 257]
+
+@benchmark('recoder.getInt')
+def bench_recoder_getint(scale, repeat):
+    count = int(20000 * scale)
+    for n in RECODER_ALPHABET_SIZES:
+        rndgen = RandomStreamIntRecoder(CyclicEntropyStream(seed=n))
+        def run():
+            for j in range(count):
+                rndgen.getInt(n)
+        dt = best_time(run, repeat)
+        yield result('recoder.getInt[n=%d]'%(n), count/dt, 'ints/s')
+
+@benchmark('recoder.getInts')
+def bench_recoder_getints(scale, repeat):
+    count = int(20000 * scale)
+    for n in RECODER_ALPHABET_SIZES:
+        rndgen = RandomStreamIntRecoder(CyclicEntropyStream(seed=n))
+        dt = best_time(lambda: rndgen.getInts(n, count), repeat)
+        yield result('recoder.getInts[n=%d]'%(n), count/dt, 'ints/s')
+
+@benchmark('recoder.numpy.getInts')
+def bench_recoder_numpy_getints(scale, repeat):
+    if import_numpy() is None:
+        return
+    count = int(200000 * scale)
+    for n in RECODER_ALPHABET_SIZES:
+        rndgen = NumpyIntRecoder(CyclicEntropyStream(seed=n))
+        dt = best_time(lambda: rndgen.getInts(n, count), repeat)
+        yield result('recoder.numpy.getInts[n=%d]'%(n), count/dt, 'ints/s')
+
+@benchmark('concentrator.read')
+def bench_concentrator_read(scale, repeat):
+    nbytes = int((1<<20) * scale)
+    chunk = 4096
+    for rate in (1.0, 0.6, 0.1):
+        conc = RandomSourceConcentrator(CyclicEntropyStream(seed=1), rate)
+        buf = bytearray(chunk)
+        def run():
+            for j in range(nbytes // chunk):
+                conc.readinto(buf)
+        dt = best_time(run, repeat)
+        yield result('concentrator.read[rate=%g]'%(rate), nbytes/dt, 'bytes/s')
+
+@benchmark('concentrator.engine')
+def bench_concentrator_engine(scale, repeat):
+    # small requests (one block at a time, as when generating a single short
+    # password) vs. large ones (e.g. multi-kilobyte keys), for each engine
+    nbytes = int((1<<20) * scale)
+    for engine in CONCENTRATOR_ENGINES:
+        for chunk in (64, 8192):
+            conc = RandomSourceConcentrator(CyclicEntropyStream(seed=1), 0.6, engine=engine)
+            buf = bytearray(chunk)
+            def run():
+                for j in range(nbytes // chunk):
+                    conc.readinto(buf)
+            dt = best_time(run, repeat)
+            yield result('concentrator.engine[%s,chunk=%d]'%(engine, chunk), nbytes/dt,
+                         'bytes/s')
+
+@benchmark('concentrator.source')
+def bench_concentrator_source(scale, repeat):
+    # a regular file read into the concentrator's buffer, vs. the same data
+    # used as a memory-mapped reservoir (hashed in place)
+    import os
+    import tempfile
+    from mkpw.entropy import make_entropy_source
+    nbytes = int((1<<20) * scale)
+    chunk = 8192
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'entropy.bin')
+        with open(path, 'wb') as f:
+            # enough for all the repetitions; the reservoir is never rewound
+            f.write(CyclicEntropyStream(seed=5).read(8 * nbytes * (repeat + 1)))
+        for engine in ('sha512', 'shake256'):
+            for kind in ('file', 'reservoir'):
+                source = make_entropy_source('%s:%s'%(kind, path))
+                conc = RandomSourceConcentrator(source, 0.6, engine=engine)
+                buf = bytearray(chunk)
+                def run():
+                    for j in range(nbytes // chunk):
+                        conc.readinto(buf)
+                dt = best_time(run, repeat)
+                del conc
+                source.close()
+                yield result('concentrator.source[%s,%s]'%(engine, kind), nbytes/dt,
+                             'bytes/s')
+
+@benchmark('drbg.read')
+def bench_drbg_read(scale, repeat):
+    # DRBG output in deterministic mode, i.e. the hashing alone
+    from mkpw.drbg import DrbgSource, DRBG_MECHANISMS
+    nbytes = int((1<<20) * scale)
+    chunk = 8192
+    for mechanism in DRBG_MECHANISMS:
+        drbg = DrbgSource(None, mechanism, seed=bytes(48))
+        buf = bytearray(chunk)
+        def run():
+            for j in range(nbytes // chunk):
+                drbg.readinto(buf)
+        dt = best_time(run, repeat)
+        yield result('drbg.read[%s]'%(mechanism), nbytes/dt, 'bytes/s')
+
+@benchmark('health.check')
+def bench_health_check(scale, repeat):
+    # the health tests on raw data, in read-sized blocks
+    from mkpw.health import HealthTests
+    nbytes = int((1<<22) * scale)
+    chunk = RandomSourceConcentrator.DEFAULT_READ_AHEAD
+    data = CyclicEntropyStream(seed=4).read(nbytes)
+    blocks = [ data[i:i+chunk] for i in range(0, nbytes, chunk) ]
+    variants = [ ('python', False) ]
+    if import_numpy() is not None:
+        variants.append(('numpy', True))
+    for name, use_numpy in variants:
+        tests = HealthTests(0.6, use_numpy=use_numpy)
+        def run():
+            for b in blocks:
+                tests.check(b)
+        dt = best_time(run, repeat)
+        yield result('health.check[%s]'%(name), nbytes/dt, 'bytes/s')
+
+@benchmark('generate_password')
+def bench_generate_password(scale, repeat):
+    count = int(2000 * scale)
+    for preset in ('-m', '-w', '-p'):
+        for recoder in ('python', 'numpy'):
+            if recoder == 'numpy' and import_numpy() is None:
+                continue
+            args = make_argument_parser().parse_args(
+                [preset, '-e', 'bench:', '--recoder', recoder]
+            )
+            with EntropySourcePool() as pool:
+                pool.add('bench:', CyclicEntropyStream(seed=2))
+                pwgen = PasswordGenerator(args, pool=pool)
+                def run():
+                    for j in range(count):
+                        pwgen.generate()
+                dt = best_time(run, repeat)
+            yield result('generate_password[%s,%s]'%(preset, recoder), count/dt, 'passwords/s')
+
+@benchmark('batch.run')
+def bench_batch_run(scale, repeat):
+    # a manifest of accounts with a mix of policies, written to memory
+    import io
+    import random
+    from mkpw.batch import run_batch, OUTPUT_FORMATS
+    from mkpw.entropy import default_entropy_pool
+    from mkpw.__main__ import PRESETS
+    count = int(5000 * scale)
+    r = random.Random(3)
+    rows = [ {'id': 'account%06d'%(j), 'length': r.choice([12, 16, 20, 24]),
+              'alpha_lower': True, 'alpha_upper': True, 'digits': r.random() < 0.8,
+              'chars': r.choice([False, True, '*!?']), 'split': r.choice([None, '4: ']),
+              'force_each_category': r.random() < 0.5}
+             for j in range(count) ]
+    base_args = make_argument_parser().parse_args(['-e', 'bench:', '--recoder', 'python'])
+    default_entropy_pool.add('bench:', CyclicEntropyStream(seed=6))
+    try:
+        for output_format in OUTPUT_FORMATS:
+            def run():
+                run_batch(rows, base_args, io.StringIO(), output_format=output_format,
+                          presets=PRESETS)
+            dt = best_time(run, repeat)
+            yield result('batch.run[%s]'%(output_format), count/dt, 'passwords/s')
+    finally:
+        default_entropy_pool.sources.pop('bench:', None)
+
+@benchmark('cli.cold_start')
+def bench_cli_cold_start(scale, repeat):
+    cmd = [sys.executable, '-m', 'mkpw', '-w']
+    runs = max(3, int(10 * scale))
+    def run():
+        for j in range(runs):
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    dt = best_time(run, repeat)
+    yield result('cli.cold_start[-w]', dt/runs, 's', higher_is_better=False)
+
+@benchmark('cli.import_time')
+def bench_cli_import_time(scale, repeat):
+    from .startup import measure_startup
+    import_us, modules = measure_startup(runs=repeat)
+    yield result('cli.import_time[-w]', import_us * 1e-6, 's', higher_is_better=False)
+
+
+def run_benchmarks(scale=1.0, repeat=3, select=None):
+    """
+    Run all benchmarks whose name starts with one of the prefixes in `select`
+    (all benchmarks if `select` is `None`), and return the list of results.
+    """
+    results = []
+    for name, fn in BENCHMARKS:
+        if select is not None and not any(name.startswith(sel) for sel in select):
+            continue
+        for r in fn(scale, repeat):
+            results.append(r)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Compare `results` to the `baseline` results.  Return a list of tuples
+    `(name, baseline_value, value, relative_change, is_regression)` for all
+    benchmarks present in both.  A change for the worse by more than the
+    fraction `threshold` counts as a regression.
+    """
+    baseline_by_name = dict([ (r['name'], r) for r in baseline ])
+    comparisons = []
+    for r in results:
+        b = baseline_by_name.get(r['name'])
+        if b is None or not b['value']:
+            continue
+        change = (r['value'] - b['value']) / b['value']
+        if r.get('higher_is_better', True):
+            is_regression = change < -threshold
+        else:
+            is_regression = change > threshold
+        comparisons.append((r['name'], b['value'], r['value'], change, is_regression))
+    return comparisons
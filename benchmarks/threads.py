@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Stress check for `mkpw.shared.SharedPasswordGenerator`.
+
+Hammers a single shared generator from 1, 2, 4, ... threads, and checks that
+no thread fails, that every password satisfies the policy, that no password is
+handed out twice, and that the merged statistics count every password.
+For a shared (locked) entropy source, also checks that the threads take its
+lock rarely, at most once per `1/MAX_READS_PER_PASSWORD` passwords apart from
+each thread's first read.  This count doesn't depend on the scheduling, unlike
+the time the threads spend waiting for each other (see
+`SharedPasswordGenerator.contention()`), which is reported along with the
+throughput: a thread waiting for the lock would mostly be waiting for the
+interpreter lock otherwise, so that this time varies a lot with the number
+of cores and the interpreter's switch interval.
+
+Each thread count is run with 'getrandom:' (which every thread opens on its
+own), with a deterministic in-memory stream and with a regular file, both
+shared by all threads behind the lock.  Note that the threads' hashing and
+recoding is serialized by the interpreter lock anyway, so the throughput is
+not expected to grow with the number of threads; what matters is that it
+doesn't collapse.
+
+Run with ``python -m benchmarks.threads``; exits with a nonzero status if a
+check fails.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import string
+import threading
+import argparse
+
+from mkpw.entropy import EntropySourcePool
+from mkpw.shared import SharedPasswordGenerator
+from mkpw.stats import GenerationStats
+from mkpw.__main__ import make_argument_parser
+
+from .streams import CyclicEntropyStream
+
+
+POLICY_ARGV = ['-l', '20', '-aAd', '-f']
+
+POLICY_CATEGORIES = (string.ascii_lowercase, string.ascii_uppercase, string.digits)
+
+SOURCES = ('getrandom:', 'bench:', 'file:')
+
+# reads from a shared source per password, beyond each thread's first read
+MAX_READS_PER_PASSWORD = 0.01
+
+
+def check_password(pw):
+    """
+    Return an error message if `pw` doesn't satisfy `POLICY_ARGV`, or `None`.
+    """
+    if len(pw) != 20:
+        return "wrong length: %r"%(pw)
+    allowed = "".join(POLICY_CATEGORIES)
+    if any(c not in allowed for c in pw):
+        return "invalid character: %r"%(pw)
+    for cat in POLICY_CATEGORIES:
+        if not any(c in cat for c in pw):
+            return "missing category: %r"%(pw)
+    return None
+
+
+def hammer(spec, nthreads, count, tmpdir):
+    """
+    Generate `count` passwords in each of `nthreads` threads from one
+    `SharedPasswordGenerator`.  Returns `(seconds, passwords, errors, pwgen,
+    stats)`.
+    """
+    if spec == 'file:':
+        # random data for all the passwords, generously
+        path = os.path.join(tmpdir, 'entropy-%d.bin'%(nthreads))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(nthreads * count * 64 + (nthreads << 17)))
+        spec = 'file:' + path
+    args = make_argument_parser().parse_args(POLICY_ARGV + ['-e', spec])
+    stats = GenerationStats()
+    results = [ [] for k in range(nthreads) ]
+    errors = []
+    start = threading.Barrier(nthreads + 1)
+
+    def worker(k):
+        start.wait()
+        try:
+            for j in range(count):
+                results[k].append(pwgen.generate())
+        except Exception as e:
+            errors.append("thread %d: %s: %s"%(k, e.__class__.__name__, e))
+
+    with EntropySourcePool() as pool:
+        if spec == 'bench:':
+            pool.add(spec, CyclicEntropyStream(seed=nthreads))
+        pwgen = SharedPasswordGenerator(args, pool=pool, stats=stats)
+        threads = [ threading.Thread(target=worker, args=(k,)) for k in range(nthreads) ]
+        for t in threads:
+            t.start()
+        start.wait()
+        t0 = time.perf_counter()
+        for t in threads:
+            t.join()
+        dt = time.perf_counter() - t0
+        pwgen.close()
+
+    passwords = [ pw for r in results for pw in r ]
+    return dt, passwords, errors, pwgen, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.threads',
+                                     description="Stress check of the shared password generator")
+    parser.add_argument('-t', '--threads', type=int, default=16,
+                        help="Largest number of threads, doubling from 1 (default: %(default)s)")
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help="Passwords per thread (default: %(default)s)")
+    args = parser.parse_args()
+
+    failed = []
+
+    tmpdir = tempfile.TemporaryDirectory()
+    nthreads = 1
+    while nthreads <= args.threads:
+        for spec in SOURCES:
+            dt, passwords, errors, pwgen, stats = hammer(spec, nthreads, args.count,
+                                                         tmpdir.name)
+            total = nthreads * args.count
+            mode = 'per-thread' if pwgen.per_thread_sources else 'shared'
+            sys.stdout.write("%-11s %3d threads (%s source): %8.0f passwords/s, %5d reads, "
+                             "waiting %.3f\n"%(spec, nthreads, mode, len(passwords)/dt,
+                                               pwgen.reads, pwgen.contention()))
+            where = "%s, %d threads"%(spec, nthreads)
+            failed += [ "%s: %s"%(where, e) for e in errors ]
+            if len(passwords) != total:
+                failed.append("%s: %d passwords instead of %d"%(where, len(passwords), total))
+            if len(set(passwords)) != len(passwords):
+                failed.append("%s: %d duplicate passwords"%(where,
+                                                             len(passwords)-len(set(passwords))))
+            for pw in passwords:
+                err = check_password(pw)
+                if err is not None:
+                    failed.append("%s: %s"%(where, err))
+                    break
+            if stats.passwords != total:
+                failed.append("%s: stats count %d passwords instead of %d"
+                              %(where, stats.passwords, total))
+            if pwgen.reads > nthreads + MAX_READS_PER_PASSWORD * total:
+                failed.append("%s: %d reads from the shared source for %d passwords"
+                              %(where, pwgen.reads, total))
+        nthreads *= 2
+    tmpdir.cleanup()
+
+    for msg in failed:
+        sys.stdout.write("FAIL: %s\n"%(msg))
+    if not failed:
+        sys.stdout.write("OK\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
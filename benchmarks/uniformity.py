@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+"""
+Statistical uniformity checks for the integer recoders and the choice of the
+forced-category positions.
+
+Draws as many integers as the sample target and time budget allow for each
+alphabet size and recoder (`RandomStreamIntRecoder.getInt()`, its block
+variant `getInts()`, and `NumpyIntRecoder`), from real randomness, and runs:
+
+  - a chi-square test of the frequency of each value;
+
+  - a chi-square test of the frequency of each pair of consecutive values (as
+    long as there are enough samples per pair);
+
+  - a serial correlation test between consecutive values, comparing the lag-1
+    autocorrelation (with the exact mean and variance of a uniform
+    distribution) to its normal approximation.
+
+For the forced-category positions (`mkpw.mkpw._choose_forced_positions()`),
+the positions given to all categories should be a uniformly random
+arrangement; this is tested with a chi-square test on the arrangements if
+there are enough samples for each of them, and otherwise on the position of
+each category and the positions of the first two categories.
+
+The draws run in worker processes (`-j`), each of which only sends back
+histograms, so that tens of millions of draws are analyzed within a few
+seconds with NumPy.  A deliberately biased control (bytes reduced modulo the
+alphabet size) must fail, which shows that the sample sizes are large enough
+to catch a bias of that order.
+
+Run with ``python -m benchmarks.uniformity`` (``--quick`` for a short run
+suitable for CI); exits with a nonzero status if a check fails.  Requires
+NumPy.
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+
+import numpy
+
+from mkpw.mkpw import (RandomStreamIntRecoder, NumpyIntRecoder, policy_from_args,
+                       _choose_forced_positions)
+from mkpw.entropy import make_entropy_source
+from mkpw.__main__ import make_argument_parser
+
+
+# alphabet sizes: powers of two (no rejection), 2^k+1 (almost half of the
+# draws rejected, which stresses the waste recycling), and the sizes of the
+# usual categories
+ALPHABET_SIZES = [2, 3, 5, 10, 16, 17, 26, 33, 36, 62, 65, 87, 94, 129, 257]
+
+RECODERS = ('getInt', 'getInts', 'numpy')
+
+# policies with forced categories: few positions (the arrangements are tested
+# directly), and more (only the marginals are)
+FORCED_POLICIES = [
+    ['-l', '8', '-aAd', '-f'],
+    ['-l', '24', '-aAdc', '-f'],
+]
+
+# draws per chunk sent to a worker, per recoder
+CHUNK_SIZES = {
+    'getInt': 1 << 17,
+    'getInts': 1 << 19,
+    'numpy': 1 << 22,
+    'control': 1 << 22,
+    'forced': 1 << 15,
+}
+
+# the first chunk of each test case, before the rate of the draws is known;
+# later chunks are sized to fit in what is left of the time budget
+MIN_CHUNK_SIZE = 1 << 10
+
+# pair histograms are only kept up to this many cells
+MAX_PAIR_CELLS = 1 << 17
+
+# chi-square tests need at least this many expected samples per cell
+MIN_EXPECTED = 5
+
+# a p-value below this fails the check; with about 150 tests, a false alarm
+# happens once in a few thousand runs
+DEFAULT_ALPHA = 1e-6
+
+DEFAULT_SAMPLES = 20000000
+DEFAULT_BUDGET = 10.0
+
+QUICK_SAMPLES = 2000000
+QUICK_BUDGET = 1.0
+
+
+# P-values
+# --------
+
+def chi2_sf(x, df):
+    """
+    Return the probability that a chi-square variable with `df` degrees of
+    freedom exceeds `x`, i.e., the regularized upper incomplete gamma function
+    `Q(df/2, x/2)`.
+    """
+    a = df / 2.0
+    x = x / 2.0
+    if x <= 0:
+        return 1.0
+    log_prefactor = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        # series for the lower function P(a, x)
+        term = total = 1.0 / a
+        k = a
+        while abs(term) > abs(total) * 1e-15:
+            k += 1
+            term *= x / k
+            total += term
+        return max(0.0, 1.0 - math.exp(log_prefactor) * total)
+    # continued fraction for Q(a, x) (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 100000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(log_prefactor) * h
+
+
+def normal_sf2(z):
+    """
+    Return the two-sided p-value `P(|Z| >= |z|)` of a standard normal variable.
+    """
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def chi2_test(counts, expected):
+    """
+    Chi-square goodness-of-fit test of the histogram `counts` against the
+    expected counts `expected` (arrays of the same shape).  Returns `(statistic,
+    df, p-value)`.
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64).ravel()
+    expected = numpy.asarray(expected, dtype=numpy.float64).ravel()
+    stat = float(numpy.sum((counts - expected) ** 2 / expected))
+    df = len(counts) - 1
+    return stat, df, chi2_sf(stat, df)
+
+
+# Drawing (in the workers)
+# ------------------------
+
+# per-process state: the entropy source, and a recoder per (kind, n) which
+# keeps its state (waste, buffered bits) from one chunk to the next
+_source_spec = None
+_source = None
+_recoders = {}
+
+
+def _worker_init(spec):
+    global _source_spec
+    _source_spec = spec
+
+
+def _get_recoder(kind, n):
+    global _source
+    if _source is None:
+        _source = make_entropy_source(_source_spec)
+    key = (kind, n)
+    rndgen = _recoders.get(key)
+    if rndgen is None:
+        if kind == 'numpy':
+            rndgen = NumpyIntRecoder(_source)
+        elif kind == 'forced':
+            rndgen = (RandomStreamIntRecoder(_source), policy_from_args(
+                make_argument_parser().parse_args(list(n))))
+        else:
+            rndgen = RandomStreamIntRecoder(_source)
+        _recoders[key] = rndgen
+    return rndgen
+
+
+def _draw(kind, n, count):
+    if kind == 'control':
+        # biased on purpose: random bytes reduced modulo n
+        _get_recoder('numpy', n)
+        return numpy.frombuffer(_source.read(count), dtype=numpy.uint8) % n
+    rndgen = _get_recoder(kind, n)
+    if kind == 'getInt':
+        getInt = rndgen.getInt
+        return numpy.fromiter((getInt(n) for j in range(count)), dtype=numpy.int64,
+                              count=count)
+    if kind == 'getInts':
+        return numpy.array(rndgen.getInts(n, count), dtype=numpy.int64)
+    return rndgen.getInts(n, count).astype(numpy.int64)
+
+
+def _draw_chunk(kind, n, count):
+    """
+    Draw `count` integers in `{0, ..., n-1}` with the recoder `kind`, and return
+    the histograms `(counts, pair_counts, lag1)` where `lag1` is the sum of the
+    products of consecutive values, centered on the mean of the uniform
+    distribution.
+    """
+    xs = _draw(kind, n, count)
+    counts = numpy.bincount(xs, minlength=n)
+    pair_counts = None
+    if n * n <= MAX_PAIR_CELLS:
+        pair_counts = numpy.bincount(xs[:-1] * n + xs[1:], minlength=n * n)
+    centered = xs - (n - 1) / 2.0
+    lag1 = float(numpy.dot(centered[:-1], centered[1:]))
+    return counts, pair_counts, lag1
+
+
+def _draw_forced_chunk(argv, count):
+    """
+    Choose the forced positions `count` times for the policy given by the
+    command-line options `argv`, and return the histogram of the arrangements
+    (the position of each category, in the order of the categories, as a
+    mixed-radix number).
+    """
+    rndgen, policy = _get_recoder('forced', tuple(argv))
+    L = policy.length
+    names = policy.category_names
+    codes = numpy.empty(count, dtype=numpy.int64)
+    for j in range(count):
+        forced = _choose_forced_positions(policy, rndgen)
+        pos_by_cat = dict([ (cat, pos) for (pos, cat) in forced.items() ])
+        code = 0
+        for cat in names:
+            code = code * L + pos_by_cat[cat]
+        codes[j] = code
+    return numpy.bincount(codes, minlength=L ** len(names))
+
+
+class _Runner(object):
+    """
+    Runs chunks of draws within the sample target and time budget, in worker
+    processes if `jobs > 1`.
+    """
+    def __init__(self, spec, jobs):
+        self.jobs = jobs
+        self.executor = None
+        if jobs > 1:
+            import concurrent.futures
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_worker_init, initargs=(spec,))
+        else:
+            _worker_init(spec)
+
+    def run(self, fn, args, chunk_size, samples, budget):
+        """
+        Call `fn(*args, chunk)` with chunks adding up to `samples` (fewer if
+        the time budget runs out), and return the list of results along with
+        the number of samples drawn.
+
+        Chunks are at most `chunk_size` draws, and are sized from the rate of
+        the draws so far so that they finish within the budget; once the
+        budget is spent, chunks which haven't started yet are cancelled.
+        """
+        t0 = time.perf_counter()
+        results = []
+        drawn = 0
+
+        def next_chunk(submitted, inflight):
+            # the size of the next chunk, or 0 if the budget is spent; the
+            # chunk has to wait for `inflight` chunks of the same size (the
+            # workers being busy), hence the factor
+            elapsed = time.perf_counter() - t0
+            if submitted >= samples or elapsed >= budget:
+                return 0
+            k = MIN_CHUNK_SIZE
+            if drawn:
+                k = max(k, int(drawn / elapsed * (budget - elapsed) / inflight))
+            return min(k, chunk_size, samples - submitted)
+
+        if self.executor is None:
+            while True:
+                k = next_chunk(drawn, 1)
+                if not k:
+                    return results, drawn
+                results.append(fn(*(args + (k,))))
+                drawn += k
+        import concurrent.futures
+        pending = {}
+        submitted = 0
+        while True:
+            # a single chunk per worker until the rate is known
+            while len(pending) < (2 * self.jobs if drawn else self.jobs):
+                k = next_chunk(submitted, 2 * self.jobs)
+                if not k:
+                    break
+                pending[self.executor.submit(fn, *(args + (k,)))] = k
+                submitted += k
+            if time.perf_counter() - t0 >= budget:
+                for fut in list(pending):
+                    if fut.cancel():
+                        del pending[fut]
+            if not pending:
+                return results, drawn
+            done, notdone = concurrent.futures.wait(
+                pending, timeout=max(0, budget - (time.perf_counter() - t0)) or None,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                results.append(fut.result())
+                drawn += pending.pop(fut)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# Tests
+# -----
+
+class Report(object):
+    """
+    Collects the test results; a test fails if its p-value is below `alpha`.
+    """
+    def __init__(self, alpha, out=sys.stdout):
+        self.alpha = alpha
+        self.out = out
+        self.failures = []
+        self.ntests = 0
+
+    def add(self, name, test, pvalue, detail=''):
+        self.ntests += 1
+        ok = pvalue >= self.alpha
+        if not ok:
+            self.failures.append("%s: %s p=%.3g"%(name, test, pvalue))
+        self.out.write("  %-9s p=%-10.3g %s%s\n"%(test, pvalue, detail,
+                                                  '' if ok else '  FAIL'))
+        self.out.flush()
+        return ok
+
+
+def test_recoder(runner, report, kind, n, samples, budget):
+    """
+    Run the frequency, pair and serial correlation tests on integers drawn with
+    the recoder `kind`.  Returns whether all passed.
+    """
+    t0 = time.perf_counter()
+    results, N = runner.run(_draw_chunk, (kind, n), CHUNK_SIZES[kind], samples, budget)
+    dt = time.perf_counter() - t0
+    counts = sum([ r[0] for r in results ])
+    report.out.write("%s[n=%d]: %d samples in %.1fs\n"%(kind, n, N, dt))
+
+    ok = True
+    stat, df, p = chi2_test(counts, numpy.full(n, N / n))
+    ok &= report.add('%s[n=%d]'%(kind, n), 'freq', p, 'chi2=%.1f df=%d'%(stat, df))
+
+    if results[0][1] is not None:
+        npairs = N - len(results)
+        if npairs >= MIN_EXPECTED * n * n:
+            pairs = sum([ r[1] for r in results ])
+            stat, df, p = chi2_test(pairs, numpy.full(n * n, npairs / (n * n)))
+            ok &= report.add('%s[n=%d]'%(kind, n), 'pairs', p, 'chi2=%.1f df=%d'%(stat, df))
+
+    # under uniformity, consecutive values are independent with variance
+    # (n^2-1)/12, so the normalized lag-1 sum is about N(0, 1)
+    npairs = N - len(results)
+    variance = (n * n - 1) / 12.0
+    z = sum([ r[2] for r in results ]) / (variance * math.sqrt(npairs))
+    ok &= report.add('%s[n=%d]'%(kind, n), 'serial', normal_sf2(z), 'z=%+.2f'%(z))
+    return ok
+
+
+def test_forced_positions(runner, report, argv, samples, budget):
+    """
+    Test that the forced-category positions chosen for the policy `argv` are a
+    uniformly random arrangement.  Returns whether all passed.
+    """
+    policy = policy_from_args(make_argument_parser().parse_args(list(argv)))
+    L = policy.length
+    m = len(policy.category_names)
+    name = 'forced[%s]'%(" ".join(argv))
+
+    t0 = time.perf_counter()
+    results, N = runner.run(_draw_forced_chunk, (tuple(argv),), CHUNK_SIZES['forced'],
+                            samples, budget)
+    dt = time.perf_counter() - t0
+    counts = sum(results).reshape((L,) * m)
+    report.out.write("%s: %d samples in %.1fs\n"%(name, N, dt))
+
+    # arrangements with two categories at the same position are impossible
+    valid = numpy.ones((L,) * m, dtype=bool)
+    for i in range(m):
+        for j in range(i + 1, m):
+            eq = numpy.eye(L, dtype=bool)
+            shape = [ 1 ] * m
+            shape[i] = L
+            shape[j] = L
+            valid &= ~eq.reshape(shape)
+    if counts[~valid].any():
+        report.failures.append("%s: two categories at the same position"%(name))
+        report.out.write("  two categories at the same position  FAIL\n")
+        return False
+
+    ok = True
+    narrangements = int(valid.sum())
+    if N >= MIN_EXPECTED * narrangements:
+        stat, df, p = chi2_test(counts[valid], numpy.full(narrangements, N / narrangements))
+        ok &= report.add(name, 'arrange', p, 'chi2=%.1f df=%d'%(stat, df))
+    for i in range(m):
+        marginal = counts.sum(axis=tuple([ a for a in range(m) if a != i ]))
+        stat, df, p = chi2_test(marginal, numpy.full(L, N / L))
+        ok &= report.add(name, 'pos[%d]'%(i), p, 'chi2=%.1f df=%d'%(stat, df))
+    if m >= 2:
+        pair = counts.sum(axis=tuple(range(2, m)))
+        offdiag = ~numpy.eye(L, dtype=bool)
+        stat, df, p = chi2_test(pair[offdiag], numpy.full(L * (L - 1), N / (L * (L - 1))))
+        ok &= report.add(name, 'pos[0,1]', p, 'chi2=%.1f df=%d'%(stat, df))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.uniformity',
+                                     description="Statistical uniformity checks of the recoders")
+    parser.add_argument('-n', '--samples', type=int, default=DEFAULT_SAMPLES,
+                        help="Number of draws per test case (default: %(default)s)")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help="Time budget per test case in seconds; fewer draws are made "
+                        "if it runs out (default: %(default)s)")
+    parser.add_argument('--quick', action='store_true', default=False,
+                        help="Short run for CI (-n %d --budget %g)"%(QUICK_SAMPLES, QUICK_BUDGET))
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (default: %(default)s)")
+    parser.add_argument('-r', '--recoder', action='append', choices=RECODERS, default=None,
+                        help="Recoder(s) to test (default: all)")
+    parser.add_argument('-s', '--size', type=int, action='append', default=None,
+                        help="Alphabet size(s) to test (default: %s)"
+                        %(" ".join([ str(n) for n in ALPHABET_SIZES ])))
+    parser.add_argument('-e', '--entropy-file', default='/dev/urandom',
+                        help="Entropy source to draw from (default: %(default)s)")
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA,
+                        help="Fail tests with a p-value below this (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.samples = QUICK_SAMPLES
+        args.budget = QUICK_BUDGET
+    recoders = args.recoder or RECODERS
+    sizes = args.size or ALPHABET_SIZES
+
+    report = Report(args.alpha)
+    runner = _Runner(args.entropy_file, args.jobs)
+    t0 = time.perf_counter()
+    try:
+        for kind in recoders:
+            for n in sizes:
+                test_recoder(runner, report, kind, n, args.samples, args.budget)
+        for argv in FORCED_POLICIES:
+            test_forced_positions(runner, report, argv, args.samples, args.budget)
+
+        # the control must fail, or the harness can't see anything
+        control = Report(args.alpha, out=open(os.devnull, 'w'))
+        if test_recoder(runner, control, 'control', 62, args.samples, args.budget):
+            report.failures.append("control: the bias of a modulo reduction was not detected")
+            sys.stdout.write("control[n=62]: bias NOT detected  FAIL\n")
+        else:
+            sys.stdout.write("control[n=62]: bias detected, as expected\n")
+    finally:
+        runner.close()
+
+    sys.stdout.write("%d tests in %.1fs\n"%(report.ntests, time.perf_counter() - t0))
+    for msg in report.failures:
+        sys.stdout.write("FAIL: %s\n"%(msg))
+    if not report.failures:
+        sys.stdout.write("OK\n")
+    return 1 if report.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
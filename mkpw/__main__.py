@@ -1,66 +1,82 @@
 #!/usr/bin/env python
 
 import sys
-import re
-import os
-import os.path
-import string
-import argparse
-import math
 
-import logging
+# Keep the imports here to a strict minimum, the command-line tool is often
+# invoked in tight loops.  In particular, argparse, logging and numpy are only
+# imported when they are needed.
 
-
-from .mkpw import SplitSpec, generate_password
+from .mkpw import SplitSpec, policy_from_args, generate_passwords, write_passwords
+from .entropy import open_entropy_source, default_entropy_pool
+from ._logutil import get_logger
 from . import __version__
 
 
-class PresetAction(argparse.Action):
-    def __init__(self, option_strings, nargs=None, **kwargs):
-        if nargs is not None:
-            raise ValueError("nargs not allowed")
-        super(PresetAction, self).__init__(option_strings, nargs=0, **kwargs)
-    def __call__(self, parser, namespace, values=None, option_string=None):
-        assert(not values)
-        # set defaults for mobile
-        self.setPreset(namespace)
-
-class MobilePresetAction(PresetAction):
-    def setPreset(self, args):
-        args.length = 16
-        args.alpha_lower = True
-        args.alpha_upper = False
-        args.chars = False
-        args.digits = False
-        args.split = SplitSpec('4: ')
-
-class WebsitePresetAction(PresetAction):
-    def setPreset(self, args):
-        args.length = 24
-        args.alpha_lower = True
-        args.alpha_upper = True
-        args.chars = False
-        args.digits = True
-        args.split = SplitSpec('') # default split
-
-class ParanoidPresetAction(PresetAction):
-    def setPreset(self, args):
-        args.length = 64
-        args.alpha_lower = True
-        args.alpha_upper = True
-        args.chars = True
-        args.digits = True
-        args.split = SplitSpec(None)
-        args.entropy_file = '/dev/random'
-        args.in_entropy_rate = 0.1
-        args.concentrate_randomness = True
-        args.force_each_category = True
-
-
-
-def main():
-
-    # args parser & open entropy file
+def set_mobile_preset(args):
+    args.length = 16
+    args.alpha_lower = True
+    args.alpha_upper = False
+    args.chars = False
+    args.digits = False
+    args.split = SplitSpec('4: ')
+
+def set_website_preset(args):
+    args.length = 24
+    args.alpha_lower = True
+    args.alpha_upper = True
+    args.chars = False
+    args.digits = True
+    args.split = SplitSpec('') # default split
+
+def set_paranoid_preset(args):
+    args.length = 64
+    args.alpha_lower = True
+    args.alpha_upper = True
+    args.chars = True
+    args.digits = True
+    args.split = SplitSpec(None)
+    args.entropy_file = '/dev/random'
+    args.in_entropy_rate = 0.1
+    args.concentrate_randomness = True
+    args.force_each_category = True
+
+
+# presets by name (also available to clients of the password server, --serve)
+PRESETS = {
+    'mobile': set_mobile_preset,
+    'website': set_website_preset,
+    'paranoid': set_paranoid_preset,
+}
+
+
+def _preset_action(setpreset):
+    """
+    Return an `argparse.Action` class which applies the preset `setpreset`.
+    """
+
+    import argparse
+
+    class PresetAction(argparse.Action):
+        def __init__(self, option_strings, nargs=None, **kwargs):
+            if nargs is not None:
+                raise ValueError("nargs not allowed")
+            super(PresetAction, self).__init__(option_strings, nargs=0, **kwargs)
+        def __call__(self, parser, namespace, values=None, option_string=None):
+            assert(not values)
+            setpreset(namespace)
+
+    return PresetAction
+
+
+def make_argument_parser():
+    """
+    Return the `argparse.ArgumentParser` for the command-line options.
+    """
+
+    import argparse
+
+    from .mkpw import RandomSourceConcentrator
+    from .drbg import DEFAULT_RESEED_INTERVAL
 
     parser = argparse.ArgumentParser(
         description="Generate a good password",
@@ -95,16 +111,31 @@ Your results may vary :)
                          help='Number of characters (14)')
     legroup.add_argument('-e', '--entropy_file', type=str, default='/dev/urandom',
                          help="Entropy file. Typical choices are /dev/random or "
-                         "/dev/urandom (the default).")
+                         "/dev/urandom (the default). Can also be 'getrandom:' to use the "
+                         "getrandom() system call directly (optionally with flags, e.g. "
+                         "'getrandom:random,nonblock'), 'device:PATH' or 'file:PATH' to "
+                         "read from a device or regular file, 'reservoir:PATH' to use up a "
+                         "file of random data without ever reusing any of it (the amount "
+                         "used is kept in PATH.ledger), or '-' for standard input.")
+    legroup.add_argument('-n', '--count', type=int, default=1,
+                         help="Number of passwords to generate, one per line (1). The "
+                         "entropy file is opened only once for the whole batch.")
+    legroup.add_argument('-j', '--jobs', type=int, default=1,
+                         help="Number of worker processes to generate passwords in parallel "
+                         "when used with -n. Each worker reads from the entropy file on "
+                         "its own (1)")
     
     pgroup = parser.add_argument_group('convenient presets')
-    pgroup.add_argument('-m', '--mobile', action=MobilePresetAction,
+    pgroup.add_argument('-m', '--mobile', action=_preset_action(set_mobile_preset),
+                        default=argparse.SUPPRESS,
                         help="Sets some defaults so that password is easy to enter on a "
                         "mobile phone's keyboard. Short for: -l16 -a -s' '")
-    pgroup.add_argument('-w', '--website', action=WebsitePresetAction,
+    pgroup.add_argument('-w', '--website', action=_preset_action(set_website_preset),
+                        default=argparse.SUPPRESS,
                         help="Sets some defaults so that password is pretty secure and "
                         "suitable for a website. Short for: -l24 -aAd -s")
-    pgroup.add_argument('-p', '--paranoid', action=ParanoidPresetAction,
+    pgroup.add_argument('-p', '--paranoid', action=_preset_action(set_paranoid_preset),
+                        default=argparse.SUPPRESS,
                         help="Sets some defaults so that password is paranoidly difficult "
                         "to guess, with many different characters. "
                         "Short for: -l64 -aAdc -f -e'/dev/random' -C -E0.1 -s")
@@ -132,6 +163,15 @@ Your results may vary :)
                         "Possible option values are \"<SEPARATOR-CHARS>\" or \"<NUMBER>\" "
                         "or \"<NUMBER>:<SEPARATOR-CHARS>\", which sets the grouping length "
                         "and/or the separating character string.")
+
+    wgroup = parser.add_argument_group('passphrase options')
+    wgroup.add_argument('--wordlist', dest='wordlist', metavar='FILE', default=None,
+                        help="Generate a passphrase of words drawn from FILE (one word per "
+                        "line, a leading dice-roll number is ignored) instead of a password. "
+                        "An index of the words is stored beside it as FILE.mkpwidx. Words "
+                        "are separated by spaces, or by the separator given with -s")
+    wgroup.add_argument('--words', dest='words', metavar='N', type=int, default=6,
+                        help="Number of words in the passphrase (default %(default)s)")
     
     rgroup = parser.add_argument_group('randomness concentration options')
     rgroup.add_argument('-C', '--concentrate-randomness', dest="concentrate_randomness",
@@ -144,28 +184,442 @@ Your results may vary :)
                         action='store', default=0.6, type=float,
                         help="The entropy per bit of the randomness file or device which you're "
                         "willing to assume (default 0.6)")
+    rgroup.add_argument('--read-ahead', dest="read_ahead", action='store', default=None,
+                        type=int, metavar='NBYTES',
+                        help="Number of bytes to read from the entropy file at once when "
+                        "concentrating randomness (default %d)"%(
+                            RandomSourceConcentrator.DEFAULT_READ_AHEAD))
+    rgroup.add_argument('--health-tests', dest="health_tests", action='store',
+                        default='abort', choices=('off', 'abort', 'warn', 'reseed'),
+                        help="Run the NIST SP 800-90B repetition count and adaptive "
+                        "proportion tests on the raw data, with cutoffs based on "
+                        "IN_ENTROPY_RATE, and on failure: stop with an error ('abort', the "
+                        "default), log a warning ('warn'), or drop the failing data and read "
+                        "more ('reseed')")
+    rgroup.add_argument('--concentrator', dest="concentrator", action='store',
+                        default='sha512', choices=('sha512', 'shake256', 'blake2b'),
+                        help="The hash construction used to concentrate randomness. "
+                        "'sha512' (the default) emits one 64-byte digest per input block; "
+                        "the extendable-output engines 'shake256' and 'blake2b' emit up to "
+                        "8KiB per input block, which is faster for long passwords or many "
+                        "passwords at once, but whose output is only computationally "
+                        "secure (a security strength of 256 bits) rather than full-entropy")
+    rgroup.add_argument('--drbg', dest="drbg", action='store', default='off',
+                        choices=('off', 'hash', 'hmac'),
+                        help="Generate the password(s) from a NIST SP 800-90A Hash_DRBG "
+                        "('hash') or HMAC_DRBG ('hmac') with SHA-512, seeded from the "
+                        "concentrated randomness, instead of from the concentrated "
+                        "randomness directly.  Much less entropy is read, so many "
+                        "passwords can be generated quickly even from a slow source; the "
+                        "passwords then have at most 256 bits of (computational) security. "
+                        "(default: off)")
+    rgroup.add_argument('--drbg-reseed-interval', dest="drbg_reseed_interval", action='store',
+                        default=None, type=int, metavar='NBYTES',
+                        help="With --drbg, reseed the DRBG after every NBYTES bytes of "
+                        "output (default %d)"%(DEFAULT_RESEED_INTERVAL))
+    rgroup.add_argument('--drbg-seed', dest="drbg_seed", action='store', default=None,
+                        metavar='HEX',
+                        help="With --drbg, seed the DRBG with the given hexadecimal string "
+                        "instead of reading any entropy, so that the output is reproducible. "
+                        "For testing only: never use the passwords generated this way")
+    rgroup.add_argument('--recoder', dest="recoder", action='store', default='auto',
+                        choices=('auto', 'python', 'numpy'),
+                        help="How random bytes are turned into characters. 'numpy' draws all "
+                        "characters at once using NumPy, 'python' uses the pure-Python "
+                        "recoder.  The default 'auto' currently uses the pure-Python recoder, "
+                        "so that the output for a given random stream doesn't depend on "
+                        "whether NumPy is installed or loaded.")
+
+    bgroup = parser.add_argument_group('batch options')
+    bgroup.add_argument('--batch', dest='batch', metavar='MANIFEST', default=None,
+                        help="Generate one password per row of MANIFEST ('-' for the standard "
+                        "input), a JSON or CSV file whose rows give an 'id' and optionally "
+                        "a 'preset' and policy fields ('length', 'alpha_lower', "
+                        "'alpha_upper', 'digits', 'chars', 'split', 'force_each_category', "
+                        "'words'); the other options given here are the defaults.  Rows with "
+                        "the same policy are generated together.  See mkpw/batch.py for the "
+                        "format")
+    bgroup.add_argument('--batch-format', dest='batch_format', default='auto',
+                        choices=('auto', 'json', 'csv'),
+                        help="Format of the manifest (default: guess from the file name or "
+                        "contents)")
+    bgroup.add_argument('--batch-output', dest='batch_output', default='jsonl',
+                        choices=('jsonl', 'csv'),
+                        help="Write the ids and passwords as JSON lines (the default) or as "
+                        "CSV")
 
     ogroup = parser.add_argument_group('other options')
     ogroup.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="Show verbose output on how the password was generated "
                         "(for debugging)")
+    ogroup.add_argument('-o', '--output', dest='output', metavar='FILE', default=None,
+                        help="Write the password(s) to FILE (created readable by you only) "
+                        "instead of the standard output")
+    ogroup.add_argument('--stream', dest='stream', action='store_true', default=False,
+                        help="Write each password in pieces as it is generated, using "
+                        "constant memory.  Use this for very long secrets, e.g. "
+                        "-l 10000000 for key material or one-time pads")
+    ogroup.add_argument('--stats', action='store_true', default=False,
+                        help="Print statistics on the entropy consumed and the time spent "
+                        "in each stage to the standard error when done")
+    ogroup.add_argument('--serve', dest='serve', metavar='SOCKET', default=None,
+                        help="Run as a server listening on the Unix socket SOCKET, keeping "
+                        "the entropy source and generator state warm. The entropy options "
+                        "given here apply to all requests")
+    ogroup.add_argument('--prefetch', dest='prefetch', metavar='SIZE', type=int, default=None,
+                        help="With --serve, keep SIZE passwords ready for each policy "
+                        "requested so far, generated in the background, so that requests "
+                        "don't wait on the entropy source")
+    ogroup.add_argument('--prefetch-ttl', dest='prefetch_ttl', metavar='SECONDS', type=float,
+                        default=600.0,
+                        help="With --prefetch, drop ready passwords which were not used "
+                        "within SECONDS (default %(default)s)")
+    ogroup.add_argument('--connect', dest='connect', metavar='SOCKET', default=None,
+                        help="Fetch the password(s) from the server listening on SOCKET "
+                        "(see --serve) instead of generating them in this process")
+    ogroup.add_argument('--metrics', dest='metrics', action='store_true', default=False,
+                        help="With --connect, print the counters of the server's password "
+                        "pool (see --prefetch) as JSON instead of fetching passwords")
     ogroup.add_argument('--help', action='help', help="Show this help information and exit")
     ogroup.add_argument('--version', action='version', version='mkpw version %s'%(__version__))
 
-    args = parser.parse_args()
+    return parser
+
+
+# Default values of all the command-line options, as set by
+# make_argument_parser().  Used by the fast path of parse_args(), which skips
+# argparse for the most common invocations.
+ARG_DEFAULTS = {
+    'length': 14,
+    'entropy_file': '/dev/urandom',
+    'count': 1,
+    'jobs': 1,
+    'alpha_lower': False,
+    'alpha_upper': False,
+    'digits': False,
+    'chars': None,
+    'force_each_category': False,
+    'split': SplitSpec(None),
+    'wordlist': None,
+    'words': 6,
+    'concentrate_randomness': True,
+    'in_entropy_rate': 0.6,
+    'read_ahead': None,
+    'concentrator': 'sha512',
+    'health_tests': 'abort',
+    'drbg': 'off',
+    'drbg_reseed_interval': None,
+    'drbg_seed': None,
+    'recoder': 'auto',
+    'batch': None,
+    'batch_format': 'auto',
+    'batch_output': 'jsonl',
+    'verbose': False,
+    'output': None,
+    'stream': False,
+    'stats': False,
+    'serve': None,
+    'prefetch': None,
+    'prefetch_ttl': 600.0,
+    'connect': None,
+    'metrics': False,
+}
+
+# command-line arguments handled by the fast path
+FAST_PATH_PRESETS = {
+    '-m': set_mobile_preset,
+    '--mobile': set_mobile_preset,
+    '-w': set_website_preset,
+    '--website': set_website_preset,
+    '-p': set_paranoid_preset,
+    '--paranoid': set_paranoid_preset,
+}
+
+def parse_args_fast(argv):
+    """
+    Parse the command-line arguments `argv` without argparse, if they consist
+    only of presets (or are empty).  Returns `None` if `argv` needs the full
+    argument parser.
+    """
+    if any(arg not in FAST_PATH_PRESETS for arg in argv):
+        return None
+    import types
+    args = types.SimpleNamespace(**ARG_DEFAULTS)
+    for arg in argv:
+        FAST_PATH_PRESETS[arg](args)
+    return args
+
+
+def parse_args(argv=None):
+    """
+    Parse the command-line arguments `argv` (by default, `sys.argv[1:]`).
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args_fast(argv)
+    if args is None:
+        args = make_argument_parser().parse_args(argv)
+    return args
+
+
+def cli_error(message):
+    """
+    Report a command-line usage error and exit.
+    """
+    make_argument_parser().error(message)
+
+
+def main(argv=None):
+
+    # parse args & open entropy file
+
+    args = parse_args(argv)
 
     if args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+        import logging
+        logging.basicConfig(level=logging.DEBUG)
 
-    logger = logging.getLogger(__name__)
+    logger = get_logger(__name__)
 
     logger.debug("args are : %r", args)
 
-    pw = generate_password(args)
+    if args.count < 1:
+        cli_error("argument -n/--count: expected a positive number")
+
+    if args.jobs < 1:
+        cli_error("argument -j/--jobs: expected a positive number")
+
+    if args.stream and args.jobs > 1:
+        cli_error("argument --stream: not allowed with argument -j/--jobs")
+
+    if args.drbg_seed is not None:
+        if args.drbg == 'off':
+            cli_error("argument --drbg-seed: requires --drbg")
+        if args.jobs > 1:
+            cli_error("argument --drbg-seed: not allowed with argument -j/--jobs")
+        from .drbg import parse_seed
+        try:
+            parse_seed(args.drbg_seed)
+        except ValueError as e:
+            cli_error("argument --drbg-seed: %s"%(e))
+
+    if args.drbg_reseed_interval is not None and args.drbg_reseed_interval < 1:
+        cli_error("argument --drbg-reseed-interval: expected a positive number")
+
+    if args.batch is not None:
+        if args.stream:
+            cli_error("argument --batch: not allowed with argument --stream")
+        if args.serve or args.connect:
+            cli_error("argument --batch: not allowed with arguments --serve/--connect")
+        return batch(args)
+
+    if args.serve:
+        return serve(args)
+
+    if args.connect:
+        return connect(args)
+
+    try:
+        # compile the policy up front, so that any error in the settings is
+        # reported here (the compiled policy is cached for the generator)
+        policy_from_args(args)
+    except ValueError as e:
+        cli_error(str(e))
+
+    try:
+        try:
+            source = open_entropy_source(args.entropy_file)
+        except (ValueError, EOFError, OSError) as e:
+            cli_error("argument -e/--entropy_file: %s"%(e))
+
+        if args.jobs > 1 and not source.parallel_safe:
+            cli_error("argument -j/--jobs: can't read from entropy source %r in parallel"
+                      %(args.entropy_file))
+
+        out = sys.stdout
+        if args.output:
+            try:
+                out = open_output_file(args.output)
+            except OSError as e:
+                cli_error("argument -o/--output: %s"%(e))
+
+        stats = None
+        if args.stats:
+            import time
+            from .stats import GenerationStats
+            stats = GenerationStats()
+            t0 = time.perf_counter()
+
+        from .health import EntropyHealthError
+
+        try:
+            if args.stream:
+                write_passwords(args, out, args.count, stats=stats)
+            else:
+                for pw in generate_passwords(args, args.count, jobs=args.jobs, stats=stats):
+                    out.write(pw + '\n')
+        except (EntropyHealthError, EOFError) as e:
+            # failed health test, or used up reservoir
+            sys.exit("mkpw: error: %s"%(e))
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        if stats is not None:
+            sys.stdout.flush()
+            stats.add_time('total', time.perf_counter() - t0)
+            sys.stderr.write(stats.format_report() + '\n')
+    finally:
+        default_entropy_pool.close()
+
+
+def open_output_file(path):
+    """
+    Open `path` for writing passwords, creating it readable and writable by the
+    current user only.
+    """
+    import os
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    return open(fd, 'w', encoding='utf-8')
+
+
+def batch(args):
+
+    from .batch import read_manifest, run_batch
+    from .health import EntropyHealthError
+
+    try:
+        if args.batch == '-':
+            rows = read_manifest(sys.stdin, args.batch_format)
+        else:
+            with open(args.batch, encoding='utf-8', newline='') as f:
+                rows = read_manifest(f, args.batch_format, path=args.batch)
+    except OSError as e:
+        cli_error("argument --batch: %s"%(e))
+    except ValueError as e:
+        sys.exit("mkpw: error: %s"%(e))
+
+    stats = None
+    if args.stats:
+        import time
+        from .stats import GenerationStats
+        stats = GenerationStats()
+        t0 = time.perf_counter()
+
+    out = sys.stdout
+    if args.output:
+        try:
+            out = open_output_file(args.output)
+        except OSError as e:
+            cli_error("argument -o/--output: %s"%(e))
+
+    try:
+        run_batch(rows, args, out, output_format=args.batch_output, presets=PRESETS,
+                  jobs=args.jobs, stats=stats)
+    except (ValueError, EntropyHealthError, EOFError) as e:
+        sys.exit("mkpw: error: %s"%(e))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        default_entropy_pool.close()
+
+    if stats is not None:
+        sys.stdout.flush()
+        stats.add_time('total', time.perf_counter() - t0)
+        sys.stderr.write(stats.format_report() + '\n')
+
+
+def _preset_matches_settings(setpreset, args):
+    """
+    Return whether the preset `setpreset` leaves the settings of `args` other
+    than the policy fields (entropy source, rate, ...) as they are.
+    """
+    import types
+    from .mkpw import POLICY_FIELDS
+    ns = types.SimpleNamespace(**vars(args))
+    setpreset(ns)
+    return all(getattr(ns, k) == v for (k, v) in vars(args).items()
+               if k not in POLICY_FIELDS)
+
+
+def serve(args):
+
+    import signal
+    import logging
+    from .server import PasswordServer
+
+    if not args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    logger = get_logger(__name__)
+
+    password_pool = None
+    if args.prefetch is not None:
+        from .pwpool import PasswordPool
+        try:
+            password_pool = PasswordPool(size=args.prefetch, ttl=args.prefetch_ttl)
+        except ValueError as e:
+            cli_error("argument --prefetch: %s"%(e))
+
+    try:
+        server = PasswordServer(args.serve, args, presets=PRESETS,
+                                password_pool=password_pool)
+    except (ValueError, OSError) as e:
+        cli_error("argument --serve: %s"%(e))
+
+    if password_pool is not None:
+        # start with the presets' pools filled, except for presets meant for
+        # other entropy settings (such as 'paranoid' and /dev/random), which
+        # are only registered when a client first asks for them
+        for name, setpreset in PRESETS.items():
+            if _preset_matches_settings(setpreset, args):
+                password_pool.register(server.make_args({'preset': name}), name=name)
+
+    logger.info("Serving passwords on %s", args.serve)
+
+    # shut down cleanly (removing the socket) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        default_entropy_pool.close()
+
+
+def connect(args):
+
+    from .server import PasswordClient, POLICY_FIELDS
+
+    request = dict([ (k, getattr(args, k)) for k in POLICY_FIELDS ])
+    request['chars'] = args.chars if args.chars is not None else False
+    if args.split.num > 0:
+        request['split'] = '%d:%s'%(args.split.num, args.split.sepstr)
+    else:
+        request['split'] = None
+    request['count'] = args.count
+
+    try:
+        with PasswordClient(args.connect) as client:
+            if args.metrics:
+                metrics = client.metrics()
+            else:
+                pws = client.request(**request)
+    except OSError as e:
+        cli_error("argument --connect: %s"%(e))
+    except ValueError as e:
+        cli_error("server error: %s"%(e))
+
+    if args.metrics:
+        import json
+        sys.stdout.write(json.dumps(metrics, indent=2, sort_keys=True) + '\n')
+        return
 
-    print(pw)
+    for pw in pws:
+        sys.stdout.write(pw + '\n')
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.INFO)
     main()
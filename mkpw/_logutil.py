@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import sys
+
+
+# Importing and setting up the logging module is a noticeable part of the
+# startup time of the command-line tool.  Unless logging is already in use
+# (i.e., the logging module was imported, e.g. because -v was given or by the
+# host application), we hand out lightweight loggers which drop debug messages
+# and only import logging when something more important has to be reported.
+
+DEBUG = 10
+
+
+class _QuietLogger(object):
+    def __init__(self, name):
+        self.name = name
+
+    def isEnabledFor(self, level):
+        return False
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def _forward(self, method, args, kwargs):
+        import logging
+        getattr(logging.getLogger(self.name), method)(*args, **kwargs)
+
+    def info(self, *args, **kwargs):
+        self._forward('info', args, kwargs)
+
+    def warning(self, *args, **kwargs):
+        self._forward('warning', args, kwargs)
+
+    def error(self, *args, **kwargs):
+        self._forward('error', args, kwargs)
+
+    def exception(self, *args, **kwargs):
+        self._forward('exception', args, kwargs)
+
+    def critical(self, *args, **kwargs):
+        self._forward('critical', args, kwargs)
+
+
+_quiet_loggers = {}
+
+def get_logger(name):
+    """
+    Return the logger `logging.getLogger(name)` if the logging module is in
+    use, or a lightweight stand-in which ignores debug messages otherwise.
+    """
+    logging = sys.modules.get('logging')
+    if logging is not None:
+        return logging.getLogger(name)
+    logger = _quiet_loggers.get(name)
+    if logger is None:
+        logger = _QuietLogger(name)
+        _quiet_loggers[name] = logger
+    return logger
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+import os
+import math
+import asyncio
+import weakref
+
+from ._logutil import get_logger
+
+from .mkpw import policy_from_args, PasswordGenerator
+from .entropy import EntropySource, GetrandomEntropySource, EntropySourcePool, \
+    open_entropy_source
+
+
+
+class AsyncEntropyPool(object):
+    """
+    Reads raw random bytes from an entropy source without blocking the event
+    loop.
+
+    With a `getrandom:` source, the `getrandom()` system call is polled with the
+    `GRND_NONBLOCK` flag, backing off with `asyncio.sleep()` while no randomness
+    is available.  Other sources (devices, files, standard input) are read in
+    the executor `executor`; by default, the pool starts its own reader thread
+    for this.  (It must not share the loop's default executor with
+    `agenerate_passwords()`, whose generation threads wait for these reads:
+    with enough concurrent requests, all the executor's threads would be
+    waiting and none left to read.)  Reads are serialized, so a single pool can
+    be shared by any number of concurrent requests; use
+    `get_async_entropy_pool()` to get the shared pool for a given entropy
+    source specification.
+    """
+
+    POLL_MIN_DELAY = 0.001
+    POLL_MAX_DELAY = 0.1
+
+    def __init__(self, spec, pool=None, executor=None):
+        self.spec = spec
+        self.source = open_entropy_source(spec, pool=pool)
+        self.executor = executor
+        self.own_executor = False
+        self.lock = asyncio.Lock()
+
+    def _get_executor(self):
+        if self.executor is None:
+            import concurrent.futures
+            # reads are serialized, so a single thread is enough
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='mkpw-entropy')
+            self.own_executor = True
+        return self.executor
+
+    async def read(self, n):
+        """
+        Return `n` raw random bytes from the source.
+        """
+        async with self.lock:
+            if isinstance(self.source, GetrandomEntropySource):
+                return await self._read_getrandom(n)
+            loop = asyncio.get_running_loop()
+            dat = await loop.run_in_executor(self._get_executor(), self.source.read, n)
+            if len(dat) < n:
+                raise EOFError("Entropy source is exhausted")
+            return dat
+
+    async def _read_getrandom(self, n):
+        flags = self.source.flags | os.GRND_NONBLOCK
+        dat = b''
+        delay = self.POLL_MIN_DELAY
+        while len(dat) < n:
+            try:
+                dat += os.getrandom(n - len(dat), flags)
+                delay = self.POLL_MIN_DELAY
+            except BlockingIOError:
+                await asyncio.sleep(delay)
+                delay = min(2*delay, self.POLL_MAX_DELAY)
+        return dat
+
+    def close(self):
+        """
+        Stop the pool's own reader thread, if it started one.  The entropy
+        source belongs to the `EntropySourcePool` and is left open.
+        """
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            self.own_executor = False
+
+
+# shared pools, {event-loop: {spec: AsyncEntropyPool}}
+_async_entropy_pools = weakref.WeakKeyDictionary()
+
+def get_async_entropy_pool(spec):
+    """
+    Return the `AsyncEntropyPool` shared by all requests of the running event
+    loop reading from the entropy source `spec`.
+    """
+    loop_pools = _async_entropy_pools.setdefault(asyncio.get_running_loop(), {})
+    aep = loop_pools.get(spec)
+    if aep is None:
+        aep = AsyncEntropyPool(spec)
+        loop_pools[spec] = aep
+    return aep
+
+
+class _ReservoirExhausted(Exception):
+    pass
+
+class _ReservoirEntropySource(EntropySource):
+    """
+    Serves bytes which were fetched beforehand; raises `_ReservoirExhausted`
+    once they are used up.
+    """
+    def __init__(self, spec, data):
+        super(_ReservoirEntropySource, self).__init__(spec)
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        k = min(len(out), len(self.view) - self.pos)
+        if k == 0 and len(out):
+            raise _ReservoirExhausted()
+        out[:k] = self.view[self.pos:self.pos+k]
+        self.pos += k
+        return k
+
+class _BridgeEntropySource(EntropySource):
+    """
+    Used from an executor thread: reads through the `AsyncEntropyPool` running
+    on the event loop `loop`, waiting for the result.
+    """
+    def __init__(self, spec, aep, loop):
+        super(_BridgeEntropySource, self).__init__(spec)
+        self.aep = aep
+        self.loop = loop
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        dat = asyncio.run_coroutine_threadsafe(self.aep.read(len(out)), self.loop).result()
+        out[:len(dat)] = dat
+        return len(dat)
+
+
+# requests whose estimated entropy needs are below this many raw bytes are
+# generated directly on the event loop
+SMALL_REQUEST_BYTES = 16384
+
+def _estimate_raw_bytes(args, policy, count):
+    # generous margin for rejected draws and for the recoders' read sizes
+    nbytes = (count * (policy.draw_bits * 2 + 256)) // 8 + 64
+    drbg = getattr(args, 'drbg', None)
+    if drbg and drbg != 'off':
+        if getattr(args, 'drbg_seed', None) is not None:
+            return 0
+        from .drbg import SEED_BYTES, RESEED_BYTES, DEFAULT_RESEED_INTERVAL
+        # only the entropy input of the DRBG comes from the source
+        interval = getattr(args, 'drbg_reseed_interval', None) or DEFAULT_RESEED_INTERVAL
+        nbytes = SEED_BYTES + RESEED_BYTES * (nbytes // interval + 1)
+        if not args.concentrate_randomness:
+            return math.ceil(nbytes / min(args.in_entropy_rate, 1.0))
+    if args.concentrate_randomness:
+        # whole 64-byte blocks for sha512, at least 64 bytes at a time for the
+        # extendable engines; allow one byte of rounding per block
+        block_size = 64
+        nbytes = ( math.ceil( 2 * (nbytes + block_size) / args.in_entropy_rate )
+                   + nbytes // block_size + 1 )
+    return nbytes
+
+
+def _make_generator(args, source, stats):
+    pool = EntropySourcePool()
+    pool.add(args.entropy_file, source)
+    return PasswordGenerator(args, pool=pool, stats=stats)
+
+
+async def agenerate_passwords(args, count, chunksize=64, executor=None, stats=None):
+    """
+    Asynchronous counterpart of `mkpw.mkpw.generate_passwords()`: an
+    asynchronous generator yielding `count` passwords.
+
+    Entropy is read through the shared `AsyncEntropyPool` for
+    `args.entropy_file`, so the event loop is never blocked on the entropy
+    source.  Small requests are generated directly on the event loop from
+    entropy fetched beforehand; larger ones are generated in chunks of
+    `chunksize` passwords in the executor `executor` (the loop's default
+    executor if `None`), so that the hashing doesn't hold up the event loop
+    either.
+    """
+
+    logger = get_logger(__name__ + ".agenerate_passwords()")
+
+    if count < 0:
+        raise ValueError("agenerate_passwords(): Expected count >= 0")
+    if count == 0:
+        return
+
+    loop = asyncio.get_running_loop()
+    aep = get_async_entropy_pool(args.entropy_file)
+    policy = policy_from_args(args)
+
+    estimate = _estimate_raw_bytes(args, policy, count)
+
+    if estimate <= SMALL_REQUEST_BYTES:
+        data = await aep.read(estimate)
+        try:
+            with _make_generator(args, _ReservoirEntropySource(args.entropy_file, data),
+                                 stats) as pwgen:
+                pws = [ pwgen.generate() for j in range(count) ]
+        except _ReservoirExhausted:
+            # unlucky; the fetched entropy wasn't enough.  Drop everything and
+            # go through the executor instead.
+            logger.debug("prefetched %d bytes were not enough, using the executor", estimate)
+        else:
+            for pw in pws:
+                yield pw
+            return
+
+    pwgen = _make_generator(args, _BridgeEntropySource(args.entropy_file, aep, loop), stats)
+    with pwgen:
+        remaining = count
+        while remaining > 0:
+            n = min(chunksize, remaining)
+            pws = await loop.run_in_executor(
+                executor, lambda: [ pwgen.generate() for j in range(n) ]
+            )
+            remaining -= n
+            for pw in pws:
+                yield pw
+
+
+async def agenerate_password(args, executor=None, stats=None):
+    """
+    Asynchronous counterpart of `mkpw.mkpw.generate_password()`.  See
+    `agenerate_passwords()`.
+    """
+    pwiter = agenerate_passwords(args, 1, executor=executor, stats=stats)
+    try:
+        return await pwiter.__anext__()
+    finally:
+        await pwiter.aclose()
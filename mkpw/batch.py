@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+import os
+import collections
+
+from ._logutil import get_logger
+
+from .mkpw import POLICY_FIELDS, PasswordGenerator, args_with_policy, generate_passwords, \
+    check_parallel_args
+from .entropy import EntropySourcePool
+
+
+# Manifests
+# ---------
+#
+# A batch manifest lists the passwords to generate, one row per password, each
+# with an "id" (e.g. an account name) and optionally its own policy, as in the
+# requests of the password server (see mkpw.server): a "preset", and any of
+# the policy fields "length", "alpha_lower", "alpha_upper", "digits", "chars",
+# "split", "force_each_category" and "words".  Fields which are not given
+# are taken from the base settings (e.g. the command-line options), as are the
+# entropy settings, which a preset doesn't change.
+#
+#   - JSON: an array of objects, or one object per line (JSON lines), e.g.
+#
+#       [ {"id": "alice", "preset": "website"},
+#         {"id": "bob", "length": 20, "digits": true, "split": null} ]
+#
+#   - CSV: a header row naming the columns, one of which is "id".  Empty cells
+#     are treated as not given.  Boolean fields are "true"/"false" (or
+#     "yes"/"no", "1"/"0"); the "chars" column is "true", "false" or a string
+#     of special chars.
+#
+# The output has one row per manifest row, in the same order, with the "id"
+# and the "password": JSON lines ({"id": ..., "password": ...}) or CSV with a
+# header row "id,password".
+#
+# Rows with the same settings are generated together, by a single generator,
+# so that the compiled policy and the entropy state are set up only once per
+# distinct policy.
+
+MANIFEST_FORMATS = ('json', 'csv')
+
+OUTPUT_FORMATS = ('jsonl', 'csv')
+
+# number of output rows written at once
+WRITE_BATCH_SIZE = 4096
+
+_POLICY_KEYS = ('preset',) + POLICY_FIELDS
+
+_MANIFEST_KEYS = frozenset(('id',) + _POLICY_KEYS)
+
+_CSV_BOOLEANS = {
+    'true': True, 'yes': True, '1': True,
+    'false': False, 'no': False, '0': False,
+}
+
+
+def _csv_value(field, text):
+    # convert a CSV cell to the value it would have in JSON
+    if field in ('id', 'preset', 'split'):
+        return text
+    if field in ('length', 'words'):
+        try:
+            return int(text)
+        except ValueError:
+            raise ValueError("Invalid %s: %r"%(field, text))
+    b = _CSV_BOOLEANS.get(text.strip().lower())
+    if field == 'chars':
+        return b if b is not None else text
+    if b is None:
+        raise ValueError("Invalid %s: %r (expected true or false)"%(field, text))
+    return b
+
+
+def _read_json_manifest(f):
+    import json
+    text = f.read()
+    if text.lstrip().startswith('['):
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise ValueError("Invalid JSON manifest: %s"%(e))
+        if not isinstance(rows, list):
+            raise ValueError("Invalid JSON manifest: expected an array of objects")
+        return rows
+    rows = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError("Invalid JSON manifest, line %d: %s"%(lineno, e))
+    return rows
+
+
+def _read_csv_manifest(f):
+    import csv
+    reader = csv.DictReader(f)
+    if reader.fieldnames is None or 'id' not in reader.fieldnames:
+        raise ValueError("Invalid CSV manifest: expected a header row with an 'id' column")
+    rows = []
+    for record in reader:
+        if None in record:
+            raise ValueError("Invalid CSV manifest, line %d: too many cells"%(reader.line_num))
+        try:
+            rows.append(dict([ (k, _csv_value(k, v)) for (k, v) in record.items()
+                               if v != '' or k == 'id' ]))
+        except ValueError as e:
+            raise ValueError("Invalid CSV manifest, line %d: %s"%(reader.line_num, e))
+    return rows
+
+
+def detect_manifest_format(path, head):
+    """
+    Guess the format of a manifest from its file name `path` (may be `None`)
+    and its first characters `head`.
+    """
+    if path:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.csv':
+            return 'csv'
+        if ext in ('.json', '.jsonl', '.ndjson'):
+            return 'json'
+    if head.lstrip()[:1] in ('[', '{'):
+        return 'json'
+    return 'csv'
+
+
+def read_manifest(f, format='auto', path=None):
+    """
+    Read a manifest (see the description in this module) from the text file
+    `f`, and return its rows as a list of dictionaries.
+
+    Arguments:
+
+      - `f`: a text file object.
+
+      - `format`: 'json', 'csv', or 'auto' to guess it from the name of the
+        file `path` or from its contents (see `detect_manifest_format()`).
+
+    Raises `ValueError` if the manifest can't be parsed, or if a row has no
+    "id" (a string or an integer) or an unknown field.
+    """
+    if format == 'auto':
+        head = f.read(256)
+        rest = f.read()
+        format = detect_manifest_format(path, head)
+        import io
+        f = io.StringIO(head + rest)
+    if format == 'json':
+        rows = _read_json_manifest(f)
+    elif format == 'csv':
+        rows = _read_csv_manifest(f)
+    else:
+        raise ValueError("Invalid manifest format: %r (expected one of %s)"
+                         %(format, ", ".join(MANIFEST_FORMATS)))
+
+    for j, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ValueError("Manifest row %d: expected an object"%(j+1))
+        rowid = row.get('id')
+        if rowid is None or rowid == '':
+            raise ValueError("Manifest row %d: missing id"%(j+1))
+        if not isinstance(rowid, (str, int)) or isinstance(rowid, bool):
+            raise ValueError("Manifest row %d: invalid id %r (expected a string or an "
+                             "integer)"%(j+1, rowid))
+        unknown = set(row.keys()) - _MANIFEST_KEYS
+        if unknown:
+            raise ValueError("Manifest row %d (id %r): unknown field(s) %s"
+                             %(j+1, row['id'], ", ".join(sorted(unknown))))
+    return rows
+
+
+def group_rows(rows, base_args, presets=None):
+    """
+    Resolve the settings of each manifest row on top of `base_args` (see
+    `mkpw.mkpw.args_with_policy()`), and group the rows with the same
+    settings.  Returns a list of `(args, row_indices)` pairs, in the order in
+    which each group first appears.
+
+    Raises `ValueError` if a row's settings are invalid, or if an id appears
+    more than once.
+    """
+    groups = collections.OrderedDict()
+    # {row-fields: key}, so that the settings are resolved only once for rows
+    # which spell out the same policy.  The fields include the type of each
+    # value, since e.g. 1, 1.0 and true compare equal but only the first is a
+    # valid length.
+    keys_by_fields = {}
+    seen_ids = set()
+    for j, row in enumerate(rows):
+        rowid = row['id']
+        if rowid in seen_ids:
+            raise ValueError("Manifest row %d: duplicate id %r"%(j+1, rowid))
+        seen_ids.add(rowid)
+        fields = tuple([ (k, type(row[k]), row[k]) for k in _POLICY_KEYS if k in row ])
+        try:
+            key = keys_by_fields.get(fields)
+            if key is None:
+                args = args_with_policy(base_args, row, presets)
+                key = PasswordGenerator.key_from_args(args)
+                keys_by_fields[fields] = key
+                if key not in groups:
+                    groups[key] = (args, [])
+        except ValueError as e:
+            raise ValueError("Manifest row %d (id %r): %s"%(j+1, rowid, e))
+        except TypeError:
+            # unhashable value, e.g. a JSON array
+            raise ValueError("Manifest row %d (id %r): invalid value (expected a number, "
+                             "a string, true/false or null)"%(j+1, rowid))
+        groups[key][1].append(j)
+    return list(groups.values())
+
+
+def run_batch(rows, base_args, out, output_format='jsonl', presets=None, jobs=1,
+              stats=None):
+    """
+    Generate a password for each manifest row in `rows` (as returned by
+    `read_manifest()`), and write them to the text file `out` in the format
+    `output_format` ('jsonl' or 'csv').  Returns the number of passwords
+    written.
+
+    All settings are resolved first, so that an invalid row is reported before
+    any password is generated.  Each group of rows with the same settings is
+    then generated in one go, updating `stats` (a `mkpw.stats.GenerationStats`)
+    if given.  With `jobs > 1`, the groups are split into chunks which are
+    generated by a pool of `jobs` worker processes, each keeping one generator
+    per group (see `mkpw.mkpw.generate_passwords()` for the requirements on the
+    entropy source).  The output is written in the order of the manifest.
+    """
+
+    logger = get_logger(__name__ + ".run_batch()")
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Invalid output format: %r (expected one of %s)"
+                         %(output_format, ", ".join(OUTPUT_FORMATS)))
+
+    groups = group_rows(rows, base_args, presets)
+
+    logger.debug("%d rows in %d groups", len(rows), len(groups))
+
+    passwords = [ None ] * len(rows)
+    if jobs is not None and jobs > 1:
+        _generate_groups_parallel(groups, passwords, jobs, stats)
+    else:
+        for args, indices in groups:
+            for j, pw in zip(indices, generate_passwords(args, len(indices), stats=stats)):
+                passwords[j] = pw
+
+    if output_format == 'jsonl':
+        import json
+        encode = json.dumps
+        format_row = lambda rowid, pw: '{"id": %s, "password": %s}\n'%(encode(rowid),
+                                                                       encode(pw))
+    else:
+        import csv
+        csvline = _CsvLine(csv)
+        format_row = lambda rowid, pw: csvline((rowid, pw))
+        out.write(csvline(('id', 'password')))
+
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        end = min(start + WRITE_BATCH_SIZE, len(rows))
+        out.write(''.join([ format_row(rows[j]['id'], passwords[j])
+                            for j in range(start, end) ]))
+        # don't keep the passwords around longer than needed
+        passwords[start:end] = [ None ] * (end - start)
+
+    return len(rows)
+
+
+# the state of a worker process: its own entropy source pool, and its
+# generators by key, each with the number of buffered bits last reported
+_worker_pool = None
+_worker_generators = {}
+
+def _worker_init():
+    global _worker_pool
+    _worker_pool = EntropySourcePool()
+
+def _worker_generate(args, count, with_stats):
+    key = PasswordGenerator.key_from_args(args)
+    item = _worker_generators.get(key)
+    if item is None:
+        stats = None
+        if with_stats:
+            from .stats import GenerationStats
+            stats = GenerationStats()
+        item = [ PasswordGenerator(args, pool=_worker_pool, stats=stats), 0 ]
+        _worker_generators[key] = item
+    pwgen = item[0]
+    pws = [ pwgen.generate() for j in range(count) ]
+    if pwgen.stats is None:
+        return pws, None
+    # report the counters accumulated since the last chunk
+    bits_left = pwgen.buffered_bits()
+    pwgen.stats.bits_left = bits_left - item[1]
+    item[1] = bits_left
+    statsdict = pwgen.stats.as_dict()
+    pwgen.stats.reset()
+    return pws, statsdict
+
+def _generate_groups_parallel(groups, passwords, jobs, stats):
+
+    import concurrent.futures
+
+    for args, indices in groups:
+        check_parallel_args(args)
+
+    total = sum([ len(indices) for args, indices in groups ])
+    chunksize = max(1, min(10000, total // (4*jobs)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=_worker_init) as executor:
+        futures = {}
+        for args, indices in groups:
+            for k in range(0, len(indices), chunksize):
+                chunk = indices[k:k+chunksize]
+                fut = executor.submit(_worker_generate, args, len(chunk), stats is not None)
+                futures[fut] = chunk
+        for fut in concurrent.futures.as_completed(futures):
+            pws, statsdict = fut.result()
+            if stats is not None:
+                stats.merge(statsdict)
+            for j, pw in zip(futures[fut], pws):
+                passwords[j] = pw
+
+
+class _CsvLine(object):
+    """
+    Formats a single CSV record as a string (with line terminator).
+    """
+    def __init__(self, csv):
+        import io
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, lineterminator='\n')
+
+    def __call__(self, record):
+        self.buf.seek(0)
+        self.buf.truncate()
+        self.writer.writerow(record)
+        return self.buf.getvalue()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import math
+import time
+import hmac
+import hashlib
+
+from ._logutil import get_logger
+
+
+# Deterministic random bit generators
+# -----------------------------------
+#
+# Optional stage between the concentrator and the integer recoder: a DRBG of
+# NIST SP 800-90A rev. 1 (Hash_DRBG or HMAC_DRBG, both with SHA-512) is seeded
+# with concentrated randomness, and its output is what the recoder turns into
+# characters.  Raw entropy is then only needed for seeding and reseeding, so
+# that generating a large amount of passwords is limited by the speed of the
+# hash function instead of that of the entropy source.
+#
+# Security margin:
+#
+#   - With SHA-512, both mechanisms have a security strength of 256 bits (SP
+#     800-90A, table 2 and table 3).  The generator is instantiated with 48
+#     bytes of concentrated randomness (256 bits of entropy input plus a 128-bit
+#     nonce, SP 800-90A section 8.6.7), and reseeded with 32 bytes.  Without a
+#     concentration step, correspondingly more raw bytes are used, according to
+#     the assumed entropy rate.
+#
+#   - Predicting the output without knowing the internal state is then as hard
+#     as breaking SHA-512 (resp. HMAC-SHA-512), i.e., about 2^256 operations.
+#     This caps the strength of any password: a 64-character paranoid password
+#     carries about 420 bits of entropy when drawn from concentrated randomness,
+#     but only 256 bits of computational security when drawn from the DRBG.
+#
+#   - Somebody who learns the internal state can compute all the output up to
+#     the next reseed, but none of the output before (the state is updated
+#     after each request, SP 800-90A section 8.8).  The reseed interval (in
+#     bytes of output) thus bounds how many passwords a compromise of the
+#     process memory exposes.  Each reseed costs 32 concentrated bytes.
+#
+# The deterministic mode (an explicit seed, no entropy source) produces the
+# same output for the same seed, for reproducible tests and benchmarks.  It is
+# never reseeded, and the secrecy of the output is that of the seed.
+
+DRBG_MECHANISMS = ('hash', 'hmac')
+
+# bytes of entropy input (including the nonce) when instantiating, and when
+# reseeding
+SEED_BYTES = 48
+RESEED_BYTES = 32
+
+# SP 800-90A limits a single request to 2^19 bits
+MAX_REQUEST_BYTES = 1 << 16
+
+DEFAULT_RESEED_INTERVAL = 1 << 16
+
+PERSONALIZATION = b'mkpw'
+
+
+def parse_seed(seed):
+    """
+    Return the DRBG seed `seed` (a string of hexadecimal digits, or `bytes`) as
+    `bytes`.
+    """
+    if isinstance(seed, (bytes, bytearray)):
+        dat = bytes(seed)
+    else:
+        try:
+            dat = bytes.fromhex(seed)
+        except ValueError:
+            dat = b''
+    if not dat:
+        raise ValueError("Invalid DRBG seed %r (expected hexadecimal digits)"%(seed,))
+    return dat
+
+
+def _hash_df(hashfn, outlen, data, nbytes):
+    # Hash_df of SP 800-90A section 10.3.1
+    prefix = (nbytes * 8).to_bytes(4, 'big')
+    out = b''.join( hashfn(bytes([counter]) + prefix + data).digest()
+                    for counter in range(1, math.ceil(nbytes / outlen) + 1) )
+    return out[:nbytes]
+
+
+class HashDrbg(object):
+    """
+    Hash_DRBG with SHA-512, as specified in NIST SP 800-90A rev. 1, section
+    10.1.1 (without prediction resistance; reseeding is up to the caller, see
+    `DrbgSource`).
+    """
+
+    name = 'hash'
+
+    HASH = hashlib.sha512
+    OUTLEN = 64
+    SEEDLEN = 111
+
+    def __init__(self, entropy_input, nonce=b'', personalization=b''):
+        self._modulus = 1 << (8 * self.SEEDLEN)
+        self._set_seed(self._hash_df(entropy_input + nonce + personalization))
+
+    def _hash_df(self, data):
+        return _hash_df(self.HASH, self.OUTLEN, data, self.SEEDLEN)
+
+    def _set_seed(self, seed):
+        self.V = int.from_bytes(seed, 'big')
+        self.C = int.from_bytes(self._hash_df(b'\x00' + seed), 'big')
+        self.reseed_counter = 1
+
+    def reseed(self, entropy_input, additional_input=b''):
+        V = self.V.to_bytes(self.SEEDLEN, 'big')
+        self._set_seed(self._hash_df(b'\x01' + V + entropy_input + additional_input))
+
+    def generate(self, n, additional_input=b''):
+        """
+        Return `n` pseudorandom bytes, `n <= MAX_REQUEST_BYTES`.
+        """
+        if n > MAX_REQUEST_BYTES:
+            raise ValueError("Can't request more than %d bytes at once"%(MAX_REQUEST_BYTES))
+        hashfn, seedlen, modulus = self.HASH, self.SEEDLEN, self._modulus
+        V = self.V
+        if additional_input:
+            w = hashfn(b'\x02' + V.to_bytes(seedlen, 'big') + additional_input).digest()
+            V = (V + int.from_bytes(w, 'big')) % modulus
+        # Hashgen
+        data = V
+        blocks = []
+        for j in range(math.ceil(n / self.OUTLEN)):
+            blocks.append(hashfn(data.to_bytes(seedlen, 'big')).digest())
+            data = (data + 1) % modulus
+        H = hashfn(b'\x03' + V.to_bytes(seedlen, 'big')).digest()
+        self.V = (V + int.from_bytes(H, 'big') + self.C + self.reseed_counter) % modulus
+        self.reseed_counter += 1
+        return b''.join(blocks)[:n]
+
+
+class HmacDrbg(object):
+    """
+    HMAC_DRBG with SHA-512, as specified in NIST SP 800-90A rev. 1, section
+    10.1.2 (without prediction resistance; reseeding is up to the caller, see
+    `DrbgSource`).
+    """
+
+    name = 'hmac'
+
+    HASH_NAME = 'sha512'
+    OUTLEN = 64
+
+    def __init__(self, entropy_input, nonce=b'', personalization=b''):
+        self.K = bytes(self.OUTLEN)
+        self.V = b'\x01' * self.OUTLEN
+        self._update(entropy_input + nonce + personalization)
+        self.reseed_counter = 1
+
+    def _update(self, provided_data):
+        hname = self.HASH_NAME
+        K = hmac.digest(self.K, self.V + b'\x00' + provided_data, hname)
+        V = hmac.digest(K, self.V, hname)
+        if provided_data:
+            K = hmac.digest(K, V + b'\x01' + provided_data, hname)
+            V = hmac.digest(K, V, hname)
+        self.K = K
+        self.V = V
+
+    def reseed(self, entropy_input, additional_input=b''):
+        self._update(entropy_input + additional_input)
+        self.reseed_counter = 1
+
+    def generate(self, n, additional_input=b''):
+        """
+        Return `n` pseudorandom bytes, `n <= MAX_REQUEST_BYTES`.
+        """
+        if n > MAX_REQUEST_BYTES:
+            raise ValueError("Can't request more than %d bytes at once"%(MAX_REQUEST_BYTES))
+        if additional_input:
+            self._update(additional_input)
+        # copying the keyed HMAC object saves setting up the key each time
+        keyed = hmac.new(self.K, digestmod=self.HASH_NAME)
+        V = self.V
+        blocks = []
+        for j in range(math.ceil(n / self.OUTLEN)):
+            h = keyed.copy()
+            h.update(V)
+            V = h.digest()
+            blocks.append(V)
+        self.V = V
+        self._update(additional_input)
+        self.reseed_counter += 1
+        return b''.join(blocks)[:n]
+
+
+_MECHANISM_CLASSES = {
+    'hash': HashDrbg,
+    'hmac': HmacDrbg,
+}
+
+
+class DrbgSource(object):
+    """
+    A file-like source of pseudorandom bytes from a DRBG (see the description
+    in this module), to be placed between a `RandomSourceConcentrator` and the
+    integer recoder.
+
+    Arguments:
+
+      - `source`: where to get the entropy input from, usually a
+        `RandomSourceConcentrator` (any object with a `read(n)` method).  It is
+        read from only when the DRBG is instantiated (on the first read) and
+        reseeded.  Must be `None` if `seed` is given.
+
+      - `mechanism`: 'hash' for Hash_DRBG or 'hmac' for HMAC_DRBG.
+
+      - `reseed_interval`: reseed after this many bytes of output.
+
+      - `seed`: a `bytes` object; if given, the DRBG is instantiated with it
+        and never reseeded, so that the output is reproducible.  For testing
+        and benchmarking only.
+
+      - `entropyrate`: the min-entropy per bit of the data read from `source`;
+        1.0 for concentrated randomness.  With a lower rate, proportionally more
+        entropy input is read.
+
+      - `stats`: an optional `mkpw.stats.GenerationStats` to update with the
+        number of bytes of entropy input read, of bytes generated and of
+        reseeds.
+    """
+
+    def __init__(self, source, mechanism='hmac', reseed_interval=DEFAULT_RESEED_INTERVAL,
+                 seed=None, entropyrate=1.0, stats=None):
+        if mechanism not in _MECHANISM_CLASSES:
+            raise ValueError("Invalid DRBG mechanism %r (expected one of %s)"
+                             %(mechanism, ", ".join(DRBG_MECHANISMS)))
+        if reseed_interval < 1:
+            raise ValueError("DrbgSource(): Expected reseed_interval >= 1")
+        if (seed is None) == (source is None):
+            raise ValueError("DrbgSource(): Expected exactly one of source and seed")
+        self.source = source
+        self.mechanism = mechanism
+        self.reseed_interval = reseed_interval
+        self.entropyrate = entropyrate
+        self.stats = stats
+
+        self.drbg = None
+        if seed is not None:
+            self.drbg = _MECHANISM_CLASSES[mechanism](seed, b'', PERSONALIZATION)
+        # bytes generated since the last (re)seeding
+        self.since_reseed = 0
+        self.request_size = min(4096, reseed_interval)
+
+        # generated bytes which have not been returned yet: buf[bufpos:]
+        self.buf = b''
+        self.bufpos = 0
+
+    def _entropy_input(self, nbytes):
+        nbytes = math.ceil(nbytes / min(self.entropyrate, 1.0))
+        dat = self.source.read(nbytes)
+        if dat is None or len(dat) < nbytes:
+            raise EOFError("Entropy source is exhausted")
+        if self.stats is not None:
+            self.stats.drbg_seed_bytes += len(dat)
+        return dat
+
+    def _generate(self):
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        if self.drbg is None:
+            logger.debug("instantiating %s DRBG", self.mechanism)
+            self.drbg = _MECHANISM_CLASSES[self.mechanism](
+                self._entropy_input(SEED_BYTES), b'', PERSONALIZATION
+            )
+            self.since_reseed = 0
+        elif self.source is not None and self.since_reseed >= self.reseed_interval:
+            logger.debug("reseeding %s DRBG after %d bytes", self.mechanism, self.since_reseed)
+            self.drbg.reseed(self._entropy_input(RESEED_BYTES))
+            self.since_reseed = 0
+            if self.stats is not None:
+                self.stats.drbg_reseeds += 1
+
+        k = self.request_size
+        if self.source is not None:
+            k = min(k, self.reseed_interval - self.since_reseed)
+        self.since_reseed += k
+        if self.stats is None:
+            return self.drbg.generate(k)
+        self.stats.drbg_bytes += k
+        t0 = time.perf_counter()
+        dat = self.drbg.generate(k)
+        self.stats.add_time('drbg', time.perf_counter() - t0)
+        return dat
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = len(out)
+        pos = 0
+        while pos < n:
+            if self.bufpos == len(self.buf):
+                self.buf = self._generate()
+                self.bufpos = 0
+            k = min(n - pos, len(self.buf) - self.bufpos)
+            out[pos:pos+k] = self.buf[self.bufpos:self.bufpos+k]
+            self.bufpos += k
+            pos += k
+        return n
+
+    def read(self, n):
+        buf = bytearray(n)
+        self.readinto(buf)
+        return bytes(buf)
+
+    def __repr__(self):
+        return "DrbgSource(%r, mechanism=%r, reseed_interval=%r)"%(
+            self.source, self.mechanism, self.reseed_interval)
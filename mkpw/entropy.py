@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import stat
+
+from ._logutil import get_logger
+
+
+
+class EntropySource(object):
+    """
+    Base class for a source of raw random bytes.
+
+    Sources implement `readinto(b)` and `read(n)` like a binary file object, so
+    that they can be handed directly to `RandomSourceConcentrator` or
+    `RandomStreamIntRecoder`.
+
+    The attribute `parallel_safe` tells whether several independent readers
+    (e.g. worker processes each opening the same source) are guaranteed to get
+    independent data.  This is the case for the kernel's random number
+    generator, but not for a regular file, which would be read from the start
+    by each reader (unless it is used as a reservoir, see
+    `ReservoirEntropySource`).
+
+    The attribute `can_read_ahead` tells whether more bytes than are needed
+    right away may be read at once.  This is the case for regular files and
+    devices, but not for pipes and terminals (e.g. the standard input fed by a
+    slow hardware RNG), where such a read would wait for bytes which are not
+    needed yet.
+    """
+
+    parallel_safe = False
+
+    can_read_ahead = True
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.closed = False
+
+    def readinto(self, b):
+        raise NotImplementedError()
+
+    def read(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            nread = self.readinto(view[pos:])
+            if not nread:
+                break
+            pos += nread
+        return bytes(view[:pos])
+
+    def close(self):
+        self.closed = True
+
+    def __repr__(self):
+        return "%s(%r)"%(self.__class__.__name__, self.spec)
+
+
+class GetrandomEntropySource(EntropySource):
+    """
+    Read random bytes with the `getrandom()` system call (`os.getrandom`),
+    without going through any file.
+
+    Arguments:
+
+      - `random`: if `True`, use the `GRND_RANDOM` flag (i.e., draw from the same
+        source as `/dev/random`).
+
+      - `nonblock`: if `True`, use the `GRND_NONBLOCK` flag.  Reads then raise
+        `BlockingIOError` instead of blocking when no randomness is available.
+    """
+
+    parallel_safe = True
+
+    def __init__(self, spec, random=False, nonblock=False):
+        super(GetrandomEntropySource, self).__init__(spec)
+        if not hasattr(os, 'getrandom'):
+            raise ValueError("os.getrandom() is not available on this system")
+        self.flags = 0
+        if random:
+            self.flags |= os.GRND_RANDOM
+        if nonblock:
+            self.flags |= os.GRND_NONBLOCK
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        dat = os.getrandom(len(view), self.flags)
+        view[:len(dat)] = dat
+        return len(dat)
+
+    def read(self, n):
+        dat = os.getrandom(n, self.flags)
+        while len(dat) < n:
+            # GRND_RANDOM may return fewer bytes than requested
+            dat += os.getrandom(n - len(dat), self.flags)
+        return dat
+
+
+def _is_file_or_device(f):
+    # whether the file object `f` is a regular file or a device other than a
+    # terminal (see EntropySource.can_read_ahead)
+    try:
+        fd = f.fileno()
+        mode = os.fstat(fd).st_mode
+    except (AttributeError, OSError, ValueError):
+        return False
+    if stat.S_ISREG(mode):
+        return True
+    return (stat.S_ISCHR(mode) or stat.S_ISBLK(mode)) and not os.isatty(fd)
+
+
+class FileEntropySource(EntropySource):
+    """
+    Read random bytes from a file.
+
+    Arguments:
+
+      - `path`: the file to read from.
+
+      - `device`: if `True`, the file is a character device such as
+        `/dev/urandom`; it is then read without any buffering in Python, as the
+        device can provide exactly the amount of bytes requested.  Regular files
+        are read through a buffer.
+    """
+
+    def __init__(self, spec, path, device=False):
+        super(FileEntropySource, self).__init__(spec)
+        self.path = path
+        self.device = device
+        if device:
+            self.f = open(path, 'rb', buffering=0)
+            self.parallel_safe = True
+        else:
+            self.f = open(path, 'rb')
+        # e.g. a named pipe
+        self.can_read_ahead = _is_file_or_device(self.f)
+
+    def readinto(self, b):
+        return self.f.readinto(b)
+
+    def read(self, n):
+        return self.f.read(n)
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super(FileEntropySource, self).close()
+
+
+# Reservoir files
+# ---------------
+#
+# A reservoir is a large regular file of random data (e.g. collected from a
+# hardware RNG) which is used up bit by bit: no byte of it is ever handed out
+# twice, neither within a run nor across runs or concurrent processes.  The
+# number of bytes of "<reservoir>" used so far is kept in the ledger file
+# "<reservoir>.ledger", as a right-aligned decimal number on a single line.
+# Readers reserve a region by advancing the ledger while holding an exclusive
+# lock (flock()) on it; the new value is synced to disk before any byte of the
+# region is used, so that a crash can waste data but never reuse it.
+#
+# Deleting or resetting the ledger makes the reservoir be used again from the
+# start -- only do that after replacing the data.
+
+LEDGER_SUFFIX = '.ledger'
+
+_LEDGER_WIDTH = 20
+
+
+class ReservoirEntropySource(EntropySource):
+    """
+    Read random bytes from a reservoir file (see the description in this
+    module), which is memory-mapped.  Raises `EOFError` when the reservoir is
+    exhausted.
+
+    Besides `readinto()`, the source has a method `readview(n)` which returns
+    the next `n` bytes as a `memoryview` of the mapped file, so that they can
+    be hashed without being copied.
+
+    Regions are reserved from the ledger as they are needed, in increasing
+    sizes (up to `MAX_RESERVE` bytes) so that large reads don't have to lock
+    the ledger over and over again.  What is left of the current region when
+    the source is closed is lost.
+
+    The ledger's lock only keeps other processes out; within a process, the
+    same source may be read by several threads at once (e.g. through
+    `default_entropy_pool`), so the current region is handed out under a
+    `threading.Lock`.
+    """
+
+    parallel_safe = True
+
+    MAX_RESERVE = 1 << 20
+
+    def __init__(self, spec, path):
+        super(ReservoirEntropySource, self).__init__(spec)
+        import mmap
+        import threading
+        try:
+            import fcntl
+        except ImportError:
+            raise ValueError("Reservoir entropy files need file locking (fcntl), which is "
+                             "not available on this system")
+        self._fcntl = fcntl
+        self.path = path
+        self.ledger_path = path + LEDGER_SUFFIX
+
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size == 0:
+                raise EOFError("Entropy reservoir %s is empty"%(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.mm)
+
+        self.ledger_fd = os.open(self.ledger_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # the current reserved region is [pos, end), protected by self.lock
+        self.lock = threading.Lock()
+        self.pos = 0
+        self.end = 0
+        self.last_reserve = 0
+
+    def _reserve(self, n, minimum):
+        """
+        Reserve a new region of at least `minimum` bytes, preferably of `n`
+        bytes or more.  Raises `EOFError` if fewer than `minimum` bytes are
+        left in the reservoir; in that case nothing is reserved.  Must be
+        called with `self.lock` held.
+        """
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        want = max(n, min(2 * self.last_reserve, self.MAX_RESERVE))
+        fcntl = self._fcntl
+        fd = self.ledger_fd
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(fd, 2 * _LEDGER_WIDTH, 0).strip()
+            try:
+                offset = int(data) if data else 0
+            except ValueError:
+                raise ValueError("Invalid entropy reservoir ledger %s"%(self.ledger_path))
+            avail = self.size - offset
+            if avail < minimum:
+                raise EOFError("Entropy reservoir %s is exhausted (%d of %d bytes used, "
+                               "see %s)"%(self.path, offset, self.size, self.ledger_path))
+            k = min(want, avail)
+            os.pwrite(fd, b'%*d\n'%(_LEDGER_WIDTH, offset + k), 0)
+            os.fsync(fd)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        logger.debug("reserved bytes %d to %d of %s", offset, offset + k, self.path)
+        # what's left of the previous region is dropped
+        self.pos = offset
+        self.end = offset + k
+        self.last_reserve = k
+
+    def readview(self, n):
+        """
+        Return a `memoryview` of the next `n` bytes of the reservoir.  Raises
+        `EOFError` if fewer than `n` bytes are left.
+        """
+        with self.lock:
+            if self.end - self.pos < n:
+                self._reserve(n, n)
+            view = self.view[self.pos:self.pos+n]
+            self.pos += n
+        return view
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = len(out)
+        if not n:
+            return 0
+        with self.lock:
+            if self.pos == self.end:
+                self._reserve(n, 1)
+            k = min(n, self.end - self.pos)
+            out[:k] = self.view[self.pos:self.pos+k]
+            self.pos += k
+        return k
+
+    def close(self):
+        if not self.closed:
+            os.close(self.ledger_fd)
+            try:
+                self.view.release()
+                self.mm.close()
+            except BufferError:
+                # views handed out by readview() are still around; the mapping
+                # goes away with them
+                pass
+        super(ReservoirEntropySource, self).close()
+
+
+class StdinEntropySource(EntropySource):
+    """
+    Read random bytes from the standard input.  The standard input is not closed
+    by `close()`.  Unless it is redirected from a file, it is not read ahead
+    (see `EntropySource`).
+    """
+
+    def __init__(self, spec):
+        super(StdinEntropySource, self).__init__(spec)
+        self.f = sys.stdin.buffer
+        self.can_read_ahead = _is_file_or_device(self.f)
+
+    def readinto(self, b):
+        return self.f.readinto(b)
+
+    def read(self, n):
+        return self.f.read(n)
+
+
+def parse_entropy_source_spec(spec):
+    """
+    Parse an entropy source specification and return a tuple `(kind, options)`.
+
+    Accepted specifications are:
+
+      - `-` or `stdin:` -- the standard input;
+
+      - `getrandom:` or `getrandom:<FLAGS>` -- the `getrandom()` system call,
+        where `<FLAGS>` is a comma-separated list of `random` and `nonblock`;
+
+      - `device:<PATH>` -- a character device such as `/dev/urandom`;
+
+      - `file:<PATH>` -- a regular file;
+
+      - `reservoir:<PATH>` -- a regular file which is used up as it is read,
+        with its consumed offset recorded in `<PATH>.ledger` (see
+        `ReservoirEntropySource`);
+
+      - `<PATH>` -- a device or a regular file, depending on what `<PATH>`
+        points to.
+    """
+
+    if spec == '-' or spec == 'stdin:':
+        return ('stdin', {})
+
+    if spec.startswith('getrandom:'):
+        flags = [ fl.strip().lower() for fl in spec[len('getrandom:'):].split(',') ]
+        options = {}
+        for fl in flags:
+            if not fl:
+                continue
+            if fl not in ('random', 'nonblock'):
+                raise ValueError("Invalid getrandom flag %r in entropy source %r "
+                                 "(expected 'random' and/or 'nonblock')"%(fl, spec))
+            options[fl] = True
+        return ('getrandom', options)
+
+    if spec.startswith('device:'):
+        return ('device', {'path': spec[len('device:'):]})
+
+    if spec.startswith('file:'):
+        return ('file', {'path': spec[len('file:'):]})
+
+    if spec.startswith('reservoir:'):
+        return ('reservoir', {'path': spec[len('reservoir:'):]})
+
+    return ('path', {'path': spec})
+
+
+def make_entropy_source(spec):
+    """
+    Open a new entropy source as given by the specification `spec` (see
+    `parse_entropy_source_spec()`).
+    """
+
+    logger = get_logger(__name__ + ".make_entropy_source()")
+
+    kind, options = parse_entropy_source_spec(spec)
+
+    logger.debug("opening entropy source %r: %s %r", spec, kind, options)
+
+    if kind == 'stdin':
+        return StdinEntropySource(spec)
+    if kind == 'getrandom':
+        return GetrandomEntropySource(spec, **options)
+    if kind == 'device':
+        return FileEntropySource(spec, options['path'], device=True)
+    if kind == 'file':
+        return FileEntropySource(spec, options['path'], device=False)
+    if kind == 'reservoir':
+        return ReservoirEntropySource(spec, options['path'])
+
+    path = options['path']
+    is_device = stat.S_ISCHR(os.stat(path).st_mode)
+    return FileEntropySource(spec, path, device=is_device)
+
+
+class EntropySourcePool(object):
+    """
+    Keeps entropy sources open so that they can be reused across calls, instead
+    of opening the entropy file anew each time.
+
+    Sources are keyed by their specification string.  Call `close()` (or use the
+    pool as a context manager) to close all the sources held by the pool.
+    """
+    def __init__(self):
+        self.sources = {}
+
+    def get(self, spec):
+        """
+        Return the entropy source for the specification `spec`, opening it if it
+        isn't open yet.
+        """
+        source = self.sources.get(spec)
+        if source is None or getattr(source, 'closed', False):
+            source = make_entropy_source(spec)
+            self.sources[spec] = source
+        return source
+
+    def add(self, spec, source):
+        """
+        Register an already open `source` (any object with `read()` and
+        `readinto()` methods) under the specification `spec`.  Useful e.g. to
+        feed a deterministic stream for testing or benchmarking.
+        """
+        self.sources[spec] = source
+
+    def discard(self):
+        """
+        Forget about all sources without closing them.  Used in a forked child
+        process, which must not continue reading from the parent's buffers.
+        """
+        self.sources = {}
+
+    def close(self):
+        for source in self.sources.values():
+            if hasattr(source, 'close'):
+                source.close()
+        self.sources = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+default_entropy_pool = EntropySourcePool()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=default_entropy_pool.discard)
+
+
+def open_entropy_source(spec, pool=None):
+    """
+    Return an entropy source for the specification `spec` (see
+    `parse_entropy_source_spec()`), reusing an already open one from `pool` if
+    possible.  By default, `default_entropy_pool` is used.
+    """
+    if pool is None:
+        pool = default_entropy_pool
+    return pool.get(spec)
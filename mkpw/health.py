@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+import sys
+import math
+import functools
+
+from ._logutil import get_logger
+
+from .entropy import EntropySource
+
+
+# Continuous health tests on the raw entropy source, after NIST SP 800-90B,
+# section 4.4.  Each raw byte is a sample, and the min-entropy per sample is
+# taken to be H = 8*entropyrate bits, i.e., what we assume anyway when
+# concentrating randomness (see RandomSourceConcentrator).
+#
+#   - Repetition Count Test (RCT): fails if the same sample value occurs C or
+#     more times in a row, with C = 1 + ceil(-log2(alpha)/H).
+#
+#   - Adaptive Proportion Test (APT): in each window of W = 512 samples, counts
+#     how many times the first sample of the window occurs; fails if that's C
+#     or more times, where C = 1 + CRITBINOM(W, 2^-H, 1-alpha).
+#
+# alpha is the false positive probability per sample; SP 800-90B recommends
+# 2^-20 <= alpha <= 2^-40.  We use 2^-40 by default so that false alarms never
+# get in the way even with large amounts of data; a stuck source is still
+# caught after a few dozen bytes.
+#
+# Both tests are run on each block of data as it is read, carrying their state
+# over from one block to the next.  They only use operations working on whole
+# blocks (big integer XOR or NumPy comparisons, bytes.find(), bytes.count()),
+# so that they cost a small fraction of reading the data.
+
+DEFAULT_ALPHA_BITS = 40
+
+APT_WINDOW_SIZE = 512
+
+HEALTH_POLICIES = ('abort', 'warn', 'reseed')
+
+# with the 'reseed' policy, give up after this many failed blocks in a row
+RESEED_MAX_ATTEMPTS = 8
+
+
+class EntropyHealthError(RuntimeError):
+    """
+    Raised when the entropy source fails a health test (with the 'abort'
+    policy), or keeps failing (with the 'reseed' policy).
+    """
+    pass
+
+
+def _min_entropy_per_sample(entropyrate):
+    return 8 * min(entropyrate, 1.0)
+
+def rct_cutoff(entropyrate, alpha_bits=DEFAULT_ALPHA_BITS):
+    """
+    Return the cutoff of the Repetition Count Test for bytes with min-entropy
+    `8*entropyrate` bits each.
+    """
+    return 1 + math.ceil(alpha_bits / _min_entropy_per_sample(entropyrate))
+
+@functools.lru_cache(maxsize=32)
+def apt_cutoff(entropyrate, alpha_bits=DEFAULT_ALPHA_BITS, window_size=APT_WINDOW_SIZE):
+    """
+    Return the cutoff of the Adaptive Proportion Test for bytes with min-entropy
+    `8*entropyrate` bits each, i.e., `1 + CRITBINOM(W, 2^-H, 1-alpha)`.
+    """
+    W = window_size
+    p = 2.0 ** (-_min_entropy_per_sample(entropyrate))
+    if p >= 1.0:
+        return W
+    log_alpha = -alpha_bits * math.log(2)
+    log_p, log_q = math.log(p), math.log1p(-p)
+    # find the largest i with P(X >= i) > alpha, X ~ Binomial(W, p), summing
+    # the upper tail in log space
+    log_tail = None
+    for i in range(W, -1, -1):
+        log_pmf = (math.lgamma(W + 1) - math.lgamma(i + 1) - math.lgamma(W - i + 1)
+                   + i * log_p + (W - i) * log_q)
+        if log_tail is None:
+            log_tail = log_pmf
+        else:
+            hi, lo = max(log_tail, log_pmf), min(log_tail, log_pmf)
+            log_tail = hi + math.log1p(math.exp(lo - hi))
+        if log_tail > log_alpha:
+            return min(1 + i, W)
+    return 1
+
+
+class HealthTests(object):
+    """
+    Online Repetition Count and Adaptive Proportion tests (NIST SP 800-90B,
+    section 4.4) on a stream of raw bytes, fed block by block with `check()`.
+
+    Arguments:
+
+      - `entropyrate`: the assumed min-entropy per bit of the raw data, which
+        determines the cutoffs (see `rct_cutoff()` and `apt_cutoff()`);
+
+      - `alpha_bits`: the false positive probability per sample is
+        `2**-alpha_bits`;
+
+      - `use_numpy`: whether to use NumPy for the repetition count test.  By
+        default (`None`), NumPy is used only if it was loaded already (see
+        `mkpw.mkpw.import_numpy()`).
+
+    Counters: `samples` (bytes tested), `apt_windows` (complete APT windows),
+    `rct_failures` and `apt_failures`.
+    """
+
+    COUNTERS = ('samples', 'apt_windows', 'rct_failures', 'apt_failures')
+
+    def __init__(self, entropyrate, alpha_bits=DEFAULT_ALPHA_BITS, use_numpy=None):
+        self.entropyrate = entropyrate
+        if use_numpy is None:
+            self.numpy = sys.modules.get('numpy')
+        elif use_numpy:
+            import numpy
+            self.numpy = numpy
+        else:
+            self.numpy = None
+        self.rct_cutoff = rct_cutoff(entropyrate, alpha_bits)
+        self.apt_cutoff = apt_cutoff(entropyrate, alpha_bits)
+        # a run of rct_cutoff equal bytes shows up as this in the XOR (resp.
+        # comparison) of consecutive bytes
+        self._rct_zeros = bytes(self.rct_cutoff - 1)
+        self._rct_ones = b'\x01' * (self.rct_cutoff - 1)
+        for c in self.COUNTERS:
+            setattr(self, c, 0)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the state carried over from the data seen so far (but keep the
+        counters).
+        """
+        # RCT: the last sample value seen and how many times in a row
+        self.rct_last = None
+        self.rct_run = 0
+        # APT: the first sample of the current window, its count, and the
+        # number of samples left in the window
+        self.apt_first = None
+        self.apt_count = 0
+        self.apt_remaining = 0
+
+    def check(self, data):
+        """
+        Run the tests on the next block of raw bytes `data` (any bytes-like
+        object, e.g. a `memoryview` of the source's buffer, which is not
+        copied).  Returns `None` if the tests pass, or the name of the failing
+        test ('RCT' or 'APT').  The state of a failing test is reset.
+        """
+        data = memoryview(data).cast('B')
+        n = len(data)
+        if not n:
+            return None
+        self.samples += n
+        a = None
+        if self.numpy is not None:
+            a = self.numpy.frombuffer(data, dtype=self.numpy.uint8)
+        failed = None
+        if not self._check_rct(data, n, a):
+            self.rct_failures += 1
+            self.rct_last = None
+            self.rct_run = 0
+            failed = 'RCT'
+        if not self._check_apt(data, n):
+            self.apt_failures += 1
+            self.apt_first = None
+            failed = failed or 'APT'
+        return failed
+
+    def _check_rct(self, data, n, a):
+        C = self.rct_cutoff
+        ok = True
+        # run continued from the previous block (only counted as far as
+        # needed to reach the cutoff)
+        last = self.rct_last
+        if last is not None:
+            need = C - self.rct_run
+            lead = 0
+            while lead < n and lead < need and data[lead] == last:
+                lead += 1
+            if lead >= need:
+                ok = False
+        # runs within this block
+        if ok and n >= C:
+            if a is not None:
+                if (a[1:] == a[:-1]).tobytes().find(self._rct_ones) != -1:
+                    ok = False
+            else:
+                # byte i of v ^ (v >> 8) is data[i] ^ data[i-1], which is zero
+                # iff the two are equal (byte 0 is data[0], so skip it)
+                v = int.from_bytes(data, 'big')
+                if (v ^ (v >> 8)).to_bytes(n, 'big').find(self._rct_zeros, 1) != -1:
+                    ok = False
+        # run at the end of the block; a run of C or more within the block
+        # has failed above, so there is no need to count further
+        tail = data[n-1]
+        t = 1
+        while t < n and t < C and data[n-1-t] == tail:
+            t += 1
+        if t == n and tail == last:
+            self.rct_run += n
+        else:
+            self.rct_run = t
+        self.rct_last = tail
+        return ok
+
+    def _check_apt(self, data, n):
+        # memoryviews have no count(), so each window (at most W bytes) is
+        # copied to be counted, rather than the whole block
+        C = self.apt_cutoff
+        W = APT_WINDOW_SIZE
+        pos = 0
+        # finish the window started in a previous block
+        if self.apt_first is not None:
+            k = min(self.apt_remaining, n)
+            self.apt_count += bytes(data[:k]).count(self.apt_first)
+            self.apt_remaining -= k
+            pos = k
+            if self.apt_count >= C:
+                return False
+            if self.apt_remaining:
+                return True
+            self.apt_windows += 1
+            self.apt_first = None
+        # complete windows within this block
+        starts = range(pos, n - W + 1, W)
+        if len(starts):
+            counts = [ bytes(data[i:i+W]).count(data[i]) for i in starts ]
+            self.apt_windows += len(counts)
+            pos = starts[-1] + W
+            if max(counts) >= C:
+                return False
+        # start a new window with what's left
+        if pos < n:
+            self.apt_first = data[pos]
+            self.apt_count = bytes(data[pos:]).count(self.apt_first)
+            self.apt_remaining = W - (n - pos)
+            if self.apt_count >= C:
+                return False
+        return True
+
+    def as_dict(self):
+        return dict([ (c, getattr(self, c)) for c in self.COUNTERS ])
+
+
+class HealthTestedSource(EntropySource):
+    """
+    Wraps the entropy source `source`, running `HealthTests` on all the raw
+    data read through it.
+
+    Arguments:
+
+      - `source`: the entropy source to read from (any object with a
+        `readinto()` method, and optionally `readview()`, see
+        `mkpw.entropy.ReservoirEntropySource`).  It is not closed by
+        `close()`.
+
+      - `entropyrate`, `alpha_bits`: see `HealthTests`.
+
+      - `policy`: what to do when a test fails: 'abort' raises
+        `EntropyHealthError`; 'warn' logs a warning and goes on; 'reseed' drops
+        the whole block which failed and reads fresh data instead, raising
+        `EntropyHealthError` after `RESEED_MAX_ATTEMPTS` failed blocks in a
+        row.  Note that 'reseed' can't take back data from earlier blocks which
+        was already handed out, e.g. the start of a run of repeated bytes.
+
+      - `stats`: an optional `mkpw.stats.GenerationStats` to update with the
+        number of bytes tested, the failures and the bytes discarded.
+
+    The attribute `tests` holds the `HealthTests` instance, and
+    `discarded_bytes` counts the bytes dropped by the 'reseed' policy.
+    """
+
+    def __init__(self, source, entropyrate, policy='abort', alpha_bits=DEFAULT_ALPHA_BITS,
+                 stats=None):
+        super(HealthTestedSource, self).__init__(getattr(source, 'spec', None))
+        if policy not in HEALTH_POLICIES:
+            raise ValueError("Invalid health test policy %r (expected one of %s)"
+                             %(policy, ", ".join(HEALTH_POLICIES)))
+        self.source = source
+        self.policy = policy
+        self.stats = stats
+        self.parallel_safe = getattr(source, 'parallel_safe', False)
+        self.can_read_ahead = getattr(source, 'can_read_ahead', True)
+        self.tests = HealthTests(entropyrate, alpha_bits)
+        self.discarded_bytes = 0
+        if hasattr(source, 'readview'):
+            # let the concentrator hash the source's data in place; the tests
+            # read the same views
+            self.readview = self._readview
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        attempts = 0
+        while True:
+            n = self.source.readinto(out)
+            if not n:
+                return n
+            if self._check(out[:n], attempts):
+                return n
+            attempts += 1
+
+    def _readview(self, n):
+        attempts = 0
+        while True:
+            view = self.source.readview(n)
+            if self._check(view, attempts):
+                return view
+            attempts += 1
+
+    def _check(self, view, attempts):
+        """
+        Test the data in `view` and apply the policy.  Returns `True` if the
+        data can be used, or `False` if it was dropped ('reseed' policy) and
+        fresh data should be read; `attempts` is the number of blocks dropped
+        in a row so far.
+        """
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        n = len(view)
+        failed = self.tests.check(view)
+        if self.stats is not None:
+            self.stats.health_samples += n
+        if failed is None:
+            return True
+
+        if self.stats is not None:
+            self.stats.health_failures += 1
+        msg = ("Entropy source %r failed the %s health test (assuming %.2f bits of "
+               "min-entropy per byte)"%(self.spec, _TEST_NAMES[failed],
+                                        _min_entropy_per_sample(self.tests.entropyrate)))
+        if self.policy == 'abort':
+            raise EntropyHealthError(msg)
+        if self.policy == 'warn':
+            logger.warning("%s", msg)
+            return True
+
+        # 'reseed': drop this block and start over with fresh data
+        attempts += 1
+        self.discarded_bytes += n
+        if self.stats is not None:
+            self.stats.health_discarded_bytes += n
+        if attempts >= RESEED_MAX_ATTEMPTS:
+            raise EntropyHealthError("%s; giving up after %d attempts"%(msg, attempts))
+        logger.warning("%s; discarding %d bytes", msg, n)
+        self.tests.reset()
+        return False
+
+    def __repr__(self):
+        return "HealthTestedSource(%r, policy=%r)"%(self.source, self.policy)
+
+
+_TEST_NAMES = {
+    'RCT': 'repetition count',
+    'APT': 'adaptive proportion',
+}
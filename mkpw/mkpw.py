@@ -1,79 +1,476 @@
 #!/usr/bin/env python
 
-import sys
-import re
-import os
-import os.path
-import string
 import math
-import hashlib
 import collections
+import functools
+import bisect
+import time
 
-import logging
+from .entropy import open_entropy_source, EntropySourcePool
+from ._logutil import get_logger, DEBUG
 
+# NumPy is optional, and is only imported when needed (see import_numpy()), as
+# importing it takes much longer than generating a password.
+numpy = None
+_numpy_unavailable = False
+
+def import_numpy():
+    """
+    Import NumPy if it is available.  Returns the `numpy` module, or `None` if
+    NumPy is not installed.
+    """
+    global numpy, _numpy_unavailable
+    if numpy is None and not _numpy_unavailable:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy_unavailable = True
+        else:
+            numpy = _numpy
+    return numpy
+
+
+class ConcentratorEngine(object):
+    """
+    A hash construction used by `RandomSourceConcentrator` to condense raw
+    randomness.
+
+    Attributes:
+
+      - `name`: the name of the engine, as in `CONCENTRATOR_ENGINES`;
+
+      - `new`: a callable returning a fresh hash state, with an
+        `update(data)` method and a `digest()` method (if `extendable` is
+        false) or `digest(n)` method (if `extendable` is true);
+
+      - `extendable`: whether the engine can produce any number of output bytes
+        per absorbed input block (an extendable-output function, or XOF);
+
+      - `block_size`: the number of output bytes per absorbed input block (if
+        not `extendable`), or the smallest number of bytes produced at once
+        (if `extendable`);
+
+      - `max_output`: the largest number of output bytes produced per absorbed
+        input block.
+
+    In all cases, `k` output bytes are only produced after absorbing
+    `ceil(2*k/entropyrate)` fresh raw input bytes.  This does not make the
+    output of the extendable engines full-entropy, though, see the security
+    margin below.
+    """
+    def __init__(self, name, new, block_size, extendable=False, max_output=None):
+        self.name = name
+        self.new = new
+        self.block_size = block_size
+        self.extendable = extendable
+        self.max_output = max_output if max_output is not None else block_size
+
+    def __repr__(self):
+        return "ConcentratorEngine(%r)"%(self.name)
+
+
+class _Blake2bCounterXof(object):
+    """
+    Extendable output from BLAKE2b: the running BLAKE2b-512 hash of all absorbed
+    input is used as the key of a keyed BLAKE2b-512 hash of a block counter,
+    `output = H(key=K, 0) || H(key=K, 1) || ...`.
+    """
+    PERSON = b'mkpw-concentrat'
+
+    def __init__(self):
+        import hashlib
+        self.blake2b = hashlib.blake2b
+        self.chain = hashlib.blake2b(digest_size=64, person=self.PERSON)
+
+    def update(self, data):
+        self.chain.update(data)
+
+    def digest(self, n):
+        key = self.chain.digest()
+        blake2b = self.blake2b
+        return b''.join([ blake2b(i.to_bytes(8, 'little'), key=key, digest_size=64).digest()
+                          for i in range((n + 63) // 64) ])[:n]
+
+
+def _sha512_engine():
+    import hashlib
+    return ConcentratorEngine('sha512', hashlib.sha512, hashlib.sha512().digest_size)
+
+def _shake256_engine():
+    import hashlib
+    return ConcentratorEngine('shake256', hashlib.shake_256, 64, extendable=True,
+                              max_output=XOF_MAX_OUTPUT)
+
+def _blake2b_engine():
+    return ConcentratorEngine('blake2b', _Blake2bCounterXof, 64, extendable=True,
+                              max_output=XOF_MAX_OUTPUT)
+
+# Security margin of the extendable engines
+# ------------------------------------------
+#
+# Chained SHA-512 emits one 64-byte digest per input block, which holds (up to
+# the assumptions of NIST SP 800-90B, section 3.1.5) the full 512 bits of
+# entropy of the 2*512/entropyrate absorbed bits.
+#
+# The extendable engines emit up to XOF_MAX_OUTPUT bytes per input block, all
+# of which are a deterministic function of a fixed-size secret: the 1600-bit
+# Keccak state for SHAKE256, the 512-bit key for the BLAKE2b counter
+# construction.  Such a block thus holds at most 1600 (resp. 512) bits of
+# entropy, however much raw input was absorbed for it; the rest of the output
+# is only computationally secure, with a security strength of 256 bits
+# (SHAKE256's capacity is 512 bits; a BLAKE2b-512 key is not recovered faster
+# than by brute force).  As with the DRBG (see mkpw.drbg), this caps the
+# strength of a password drawn from a single block: a 64-character paranoid
+# password has some 420 bits of entropy with 'sha512', but 256 bits of
+# computational security with 'shake256' or 'blake2b'.  The raw input absorbed
+# per output byte is accounted for in the same way for all engines, but only
+# 'sha512' turns it into full-entropy output.
+
+# largest output of the extendable engines per absorbed input block
+XOF_MAX_OUTPUT = 8192
+
+# {name: factory}
+CONCENTRATOR_ENGINES = collections.OrderedDict([
+    ('sha512', _sha512_engine),
+    ('shake256', _shake256_engine),
+    ('blake2b', _blake2b_engine),
+])
+
+def get_concentrator_engine(engine):
+    """
+    Return the `ConcentratorEngine` named `engine` (one of the keys of
+    `CONCENTRATOR_ENGINES`).  If `engine` is already a `ConcentratorEngine`, it
+    is returned as is.
+    """
+    if isinstance(engine, ConcentratorEngine):
+        return engine
+    try:
+        factory = CONCENTRATOR_ENGINES[engine]
+    except KeyError:
+        raise ValueError("Unknown concentrator engine: %r"%(engine,))
+    return factory()
 
 
 class RandomSourceConcentrator(object):
-    def __init__(self, f, entropyrate=0.6):
+
+    DEFAULT_READ_AHEAD = 4096
+
+    def __init__(self, f, entropyrate=0.6, read_ahead=None, stats=None, engine='sha512'):
         """
         Arguments:
 
           - `f`: a binary opened file-like object.  Needs to implement the method
-            `f.read(nbytes)` which should return `bytes()`.
+            `f.read(nbytes)` which should return `bytes()`.  If `f` implements
+            `f.readinto(buffer)`, that method is used instead in order to avoid
+            copying the data read.  If `f` implements `f.readview(nbytes)`,
+            returning a `memoryview` of exactly `nbytes` bytes (as
+            `mkpw.entropy.ReservoirEntropySource` does), the data is hashed
+            straight from the views it returns.
 
           - `entropyrate`: the amount of min-entropy per bit of the data read
             from the source `f` we are ready to assume.
+
+          - `read_ahead`: the number of bytes to read from `f` at once.  A large
+            value lets a single read feed many hash blocks.  The value is
+            raised to at least the number of input bytes needed for one hash
+            block.  Sources whose `can_read_ahead` attribute is false (pipes
+            and terminals, see `mkpw.entropy.EntropySource`) are only read for
+            what each hash block needs.  (Default: `DEFAULT_READ_AHEAD`.)
+
+          - `stats`: an optional `mkpw.stats.GenerationStats` instance to
+            update with the amount of data read and hashed.
+
+          - `engine`: the hash construction to use, the name of one of the
+            `CONCENTRATOR_ENGINES` or a `ConcentratorEngine`.  The default
+            'sha512' chains SHA-512, emitting one 64-byte digest per input
+            block.  The extendable-output engines 'shake256' and 'blake2b'
+            emit up to `XOF_MAX_OUTPUT` bytes per input block, which saves
+            most of the per-block overhead when large amounts of randomness
+            are requested at once, at the price of output which is only
+            computationally secure (see the security margin in this module).
         """
         self.f = f
         self.entropyrate = entropyrate
-        self.buf = bytes()
+        self.stats = stats
 
-    def read(self, n):
+        self.engine = get_concentrator_engine(engine)
+        self.hashfn = self.engine.new
+        self.digest_size = self.engine.block_size
+
+        # need 2*bits/entropyrate bytes to ensure that at input to
+        # concentrator has at least 2*bits entropy rate.  (See NIST SP
+        # 800-90B, section 3.1.5; we use hash function sha512; I'm not sure
+        # I read all of this correctly but sounds not too wrong)
+        #
+        # The extendable engines absorb needbytes_for(k) bytes for each k
+        # output bytes as well, but their output has at most the entropy of
+        # their internal state (see the security margin above).
+        self.needbytes = self.needbytes_for(self.digest_size)
+
+        if read_ahead is None:
+            read_ahead = self.DEFAULT_READ_AHEAD
+        if not getattr(f, 'can_read_ahead', True):
+            # reading ahead would wait for data which isn't needed yet
+            read_ahead = 0
+        self.read_ahead = max(read_ahead, self.needbytes)
+
+        # buffer of raw bytes read from `f` but not yet hashed:
+        # inbuf[inpos:inpos+inlen]
+        self.inbuf = bytearray(self.read_ahead)
+        self.inview = memoryview(self.inbuf)
+        self.inpos = 0
+        self.inlen = 0
+
+        # sources which can hand out views of their data (e.g. a memory-mapped
+        # file) don't need to go through inbuf
+        self.readview = getattr(f, 'readview', None)
+
+        # concentrated bytes which have not been returned yet:
+        # buf[bufpos:bufpos+buflen].  Holds what is left over from the last hash
+        # block, so it never needs more than digest_size bytes.
+        self.buf = bytearray(self.digest_size)
+        self.bufview = memoryview(self.buf)
+        self.bufpos = 0
+        self.buflen = 0
+
+    def needbytes_for(self, k):
         """
-        Return `n` bytes of concentrated randomness from the source given in the
-        constructor.
+        Return the number of raw input bytes to absorb in order to produce `k`
+        bytes of output.
         """
+        return math.ceil( 2 * k / self.entropyrate )
 
-        logger = logging.getLogger(__name__ + "." + self.__class__.__name__ + ".read()")
+    def _read_raw_block(self, needbytes=None):
+        """
+        Return a memoryview of exactly `needbytes` raw bytes from the source
+        (by default, `self.needbytes`).  The view is only valid until the next
+        call.
+        """
+        if needbytes is None:
+            needbytes = self.needbytes
+
+        if self.readview is not None and not self.inlen:
+            return self._read_view(needbytes)
+
+        if self.inlen < needbytes:
+            # move what's left to the front of the buffer and fill the rest
+            if needbytes > len(self.inbuf):
+                # large block for an extendable engine; get a larger buffer
+                inbuf = bytearray(needbytes)
+                inbuf[:self.inlen] = self.inview[self.inpos:self.inpos+self.inlen]
+                self.inbuf = inbuf
+                self.inview = memoryview(inbuf)
+            elif self.inlen:
+                self.inbuf[:self.inlen] = self.inview[self.inpos:self.inpos+self.inlen]
+            self.inpos = 0
+            fillend = max(self.read_ahead, needbytes)
+            while self.inlen < needbytes:
+                nread = self._fill(self.inview[self.inlen:fillend])
+                self.inlen += nread
+
+        block = self.inview[self.inpos:self.inpos+needbytes]
+        self.inpos += needbytes
+        self.inlen -= needbytes
+        return block
+
+    def _read_view(self, needbytes):
+        stats = self.stats
+        if stats is not None:
+            t0 = time.perf_counter()
+        block = self.readview(needbytes)
+        if stats is not None:
+            stats.add_time('read', time.perf_counter() - t0)
+            stats.source_reads += 1
+            stats.source_bytes += needbytes
+        return block
+
+    def _fill(self, view):
+        """
+        Read at most `len(view)` bytes from the source into `view`; return the
+        number of bytes read.
+        """
+        stats = self.stats
+        if stats is not None:
+            t0 = time.perf_counter()
 
-        logger.debug("n = %d, current buf len = %d", n, len(self.buf))
+        readinto = getattr(self.f, 'readinto', None)
+        if readinto is not None:
+            nread = readinto(view)
+        else:
+            dat = self.f.read(len(view))
+            nread = None
+            if dat is not None:
+                nread = len(dat)
+                view[:nread] = dat
+
+        if stats is not None:
+            stats.add_time('read', time.perf_counter() - t0)
+            stats.source_reads += 1
+            stats.source_bytes += (nread or 0)
+
+        if nread is None:
+            # non-blocking source, no data available yet
+            return 0
+        if nread == 0 and len(view):
+            raise EOFError("Entropy source is exhausted")
+        return nread
+
+    def readinto(self, b):
+        """
+        Fill the writable buffer `b` (e.g. a `bytearray` or a `memoryview`) with
+        concentrated randomness from the source given in the constructor.
+        Returns the number of bytes written, i.e., `len(b)`.
+        """
 
-        m = hashlib.sha512()
+        logger = get_logger(__name__ + "." + self.__class__.__name__ + ".readinto()")
 
-        while len(self.buf) < n:
-            # collect some concentrated randomness into our buffer.
-            #
-            # need 2*bits/entropyrate bytes to ensure that at input to
-            # concentrator has at least 2*bits entropy rate.  (See NIST SP
-            # 800-90B, section 3.1.5; we use hash function sha512; I'm not sure
-            # I read all of this correctly but sounds not too wrong)
+        out = memoryview(b).cast('B')
+        n = len(out)
 
-            # increase the amount of concentrated randomness by m.digest_size:
-            
-            needbytes = math.ceil( 2 * m.digest_size / self.entropyrate )
-            
-            # read exactly needbytes from the entropy source
-            inbytes = b''
-            while len(inbytes) < needbytes:
-                inbytes = self.f.read(needbytes-len(inbytes))
+        logger.debug("n = %d, current buf len = %d", n, self.buflen)
 
-            m.update(inbytes)
+        # first, serve whatever we have left over from the previous call
+        pos = min(n, self.buflen)
+        if pos:
+            out[:pos] = self.bufview[self.bufpos:self.bufpos+pos]
+            self.bufpos += pos
+            self.buflen -= pos
+
+        if pos == n:
+            if self.stats is not None:
+                self.stats.concentrated_bytes += n
+            return n
+
+        if self.engine.extendable:
+            return self._readinto_xof(out, pos, logger)
+
+        m = self.hashfn()
+        digest_size = self.digest_size
+        stats = self.stats
 
+        if stats is not None:
+            stats.concentrated_bytes += n - pos
+
+        while pos < n:
+            # increase the amount of concentrated randomness by digest_size:
+            inbytes = self._read_raw_block()
+            if stats is not None:
+                t0 = time.perf_counter()
+            m.update(inbytes)
             outbytes = m.digest()
-            self.buf += outbytes
+            if stats is not None:
+                stats.add_time('hash', time.perf_counter() - t0)
+                stats.hash_blocks += 1
+                stats.hashed_bytes += len(inbytes)
+
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("Concentrated another %d -> %d bytes: %r -> %r",
+                             len(inbytes), digest_size, bytes(inbytes), outbytes)
+
+            k = min(digest_size, n - pos)
+            out[pos:pos+k] = outbytes[:k]
+            pos += k
+
+            if k < digest_size:
+                # keep the rest for later
+                self.buflen = digest_size - k
+                self.bufpos = 0
+                self.buf[:self.buflen] = outbytes[k:]
+
+        return n
+
+    def _readinto_xof(self, out, pos, logger):
+        n = len(out)
+        m = self.hashfn()
+        min_output = self.engine.block_size
+        max_output = self.engine.max_output
+        stats = self.stats
+
+        if stats is not None:
+            stats.concentrated_bytes += n - pos
+
+        while pos < n:
+            # produce everything that is still needed in one go, within the
+            # engine's limits; anything beyond n is kept for later
+            k = min(max(n - pos, min_output), max_output)
+            inbytes = self._read_raw_block(self.needbytes_for(k))
+            if stats is not None:
+                t0 = time.perf_counter()
+            m.update(inbytes)
+            outbytes = m.digest(k)
+            if stats is not None:
+                stats.add_time('hash', time.perf_counter() - t0)
+                stats.hash_blocks += 1
+                stats.hashed_bytes += len(inbytes)
 
-            logger.debug("Concentrated another %d -> %d bytes: %r -> %r",
-                         needbytes, m.digest_size, inbytes, outbytes)
-            
-        readbytes = self.buf[:n]
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("Concentrated another %d -> %d bytes", len(inbytes), k)
+
+            used = min(k, n - pos)
+            out[pos:pos+used] = outbytes[:used]
+            pos += used
+
+            if used < k:
+                # keep the rest for later (less than min_output bytes)
+                self.buflen = k - used
+                self.bufpos = 0
+                self.buf[:self.buflen] = outbytes[used:]
+
+        return n
 
-        self.buf = self.buf[n:]
+    def read(self, n):
+        """
+        Return `n` bytes of concentrated randomness from the source given in the
+        constructor.
+        """
+
+        readbytes = bytearray(n)
+        self.readinto(readbytes)
 
-        logger.debug("read bytes: %r", readbytes)
-        return readbytes
+        return bytes(readbytes)
         
 
 
+def int_bits(n):
+    """
+    Return a tuple `(n_bits, n_bits_mask)`, where `n_bits` is the number of
+    random bits needed to draw a uniformly random integer in `{0, ..., n-1}`,
+    i.e., the ceiling of `log2(n)`, and `n_bits_mask` masks the `n_bits` lowest
+    bits of a number.
+    """
+    n_bits = (n-1).bit_length()
+    return n_bits, ((1 << n_bits) - 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def int_block_size(n, max_bits=256):
+    """
+    Return the number `m` of base-`n` digits which should be drawn at once by
+    `RandomStreamIntRecoder.getInts()`, along with the tuple
+    `(N, n_bits, n_bits_mask)` for the block range `N = n**m`.
+
+    Drawing a uniform integer in `{0, ..., N-1}` from `n_bits` random bits is
+    rejected with probability `1 - N/2**n_bits`.  We pick the block size `m`
+    (with `n_bits <= max_bits`) for which this probability is smallest.
+    """
+    best_m, best_rej = 1, None
+    N = n
+    m = 1
+    while True:
+        n_bits = (N-1).bit_length()
+        if n_bits > max_bits:
+            break
+        rej = 1.0 - N / float(1 << n_bits)
+        if best_rej is None or rej < best_rej - 1e-12:
+            best_m, best_rej = m, rej
+        if rej == 0.0 or n < 2:
+            break
+        m += 1
+        N *= n
+    N = n ** best_m
+    return (best_m, (N,) + int_bits(N))
+
+
 class RandomStreamIntRecoder(object):
     """
     Given a source of random data `f` (provided as a file stream), extract
@@ -82,18 +479,28 @@ class RandomStreamIntRecoder(object):
     The object `f` only has to implement the call ``f.read(m)`` to read `m`
     bytes of random data.  Note that the buffer must be open in binary mode,
     i.e., the `f.read()` call must return bytes, not a (unicode) string.
+
+    If `stats` is a `mkpw.stats.GenerationStats` instance, it is updated with
+    the number of bits consumed, output, rejected and recycled.
     """
-    def __init__(self, f):
+    def __init__(self, f, stats=None):
         self.f = f
+        self.stats = stats
         self.bitsbuffer = 0
         self.bitsbufferlen = 0
         self.waste = 0
         self.wastesize = 0
+        # integers drawn by getInts() but not returned yet, {n: [x, ...]}
+        self.pendingints = {}
 
-    def getInt(self, n):
+    def getInt(self, n, n_bits=None, n_bits_mask=None):
         """
         Return a random integer between `0` and `n-1`, included.
 
+        The bit width `n_bits` of `n-1` and the corresponding mask
+        `n_bits_mask` may be given if they are known already (see
+        `int_bits()`); otherwise they are computed here.
+
         This function works the following way:
     
         - ensure enough random bits in the long integer `bitsbuffer`. There are exactly
@@ -101,8 +508,10 @@ class RandomStreamIntRecoder(object):
     
         - to generate a random char, take `n_bits` from the bitsbuffer. Then:
           (a) If the number is inside `{0, ..., n-1}`, this defines a new password character.
-          (b) Otherwise, we add this value minus `n` to the `waste`, and increase
-              `wastesize` by exactly `2**n_bits-n`.
+          (b) Otherwise, this value minus `n` is uniform in `{0, ..., 2**n_bits-n-1}`,
+              and it is combined with the `waste` as a further digit: `waste`
+              becomes `waste*(2**n_bits-n) + (rn-n)`, and `wastesize` is multiplied
+              by `2**n_bits-n`.
 
         - `waste` is used to collect the randomness that wasn't used because the charstr isn't
           necessarily a power of two of length. Because the "waste numbers" (b) are uniformly
@@ -110,23 +519,29 @@ class RandomStreamIntRecoder(object):
           uniformly random number `{0, ..., wastesize-1}`.
         """
 
-        logger = logging.getLogger(__name__ + "." + self.__class__.__name__ + ".getInt()")
-
         if not n > 0:
             raise ValueError("getInt(): Expected n > 0")
 
-        # random number to be generated
-        x = 0
-
         # The number of random bits we need to have in order to be sure to be
         # able to generate a uniformly random number in {0, ..., n-1}
         #
-        # This is ceiling(math.log(len(charstr))/math.log(2))
+        # This is ceiling(math.log(len(charstr))/math.log(2)), computed exactly
         #
-        n_bits = int(math.ceil(math.log(n)/math.log(2)))
+        if n_bits is None:
+            n_bits, n_bits_mask = int_bits(n)
+        elif n_bits_mask is None:
+            # mask to get the weakest n_bits out of a number
+            n_bits_mask = ((1 << n_bits) - 1)
 
-        # mask to get the weakest n_bits out of a number
-        n_bits_mask = ((1 << n_bits) - 1)
+        x = self._draw_int(n, n_bits, n_bits_mask)
+        if self.stats is not None:
+            self.stats.count_output(n)
+        return x
+
+    def _draw_int(self, n, n_bits, n_bits_mask):
+        # the algorithm of getInt(), without counting the integer as output
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__ + ".getInt()")
 
         logger.debug('n=%d, n_bits=%d', n, n_bits)
 
@@ -137,7 +552,7 @@ class RandomStreamIntRecoder(object):
             if (self.wastesize > 2):
                 logger.debug('recycling waste: waste=%#x, wastesize=%#x=%d',
                              self.waste, self.wastesize, self.wastesize)
-                minwastebits = int(math.floor(math.log(self.wastesize)/math.log(2)))
+                minwastebits = self.wastesize.bit_length() - 1
                 twominwastebits = 2**minwastebits;
                 # now, do the same thing as when getting a random char. See if the number is
                 # in [0,2**minwastebits[: if the case, then those bits are added to the
@@ -147,6 +562,8 @@ class RandomStreamIntRecoder(object):
                     self.bitsbufferlen += minwastebits
                     self.waste = 0
                     self.wastesize = 0
+                    if self.stats is not None:
+                        self.stats.waste_bits_recycled += minwastebits
                     logger.debug('got more bits: bitsbuffer=%#x, bitsbufferlen=%d',
                                  self.bitsbuffer, self.bitsbufferlen)
                 else:
@@ -166,6 +583,10 @@ class RandomStreamIntRecoder(object):
 
                 # read 8 very random bytes
                 dat = self.f.read(8)
+                if not dat:
+                    raise EOFError("Entropy source is exhausted")
+                if self.stats is not None:
+                    self.stats.recoder_bytes_in += len(dat)
                 # dat is an array of 8 integers (bytes)
                 logger.debug('dat=%s', ",".join(['%#x'%(c) for c in dat]))
 
@@ -195,20 +616,177 @@ class RandomStreamIntRecoder(object):
 
             if rn < n:
                 # indeed got a random integer
-                x = rn
-                logger.debug('got random integer: x=%s', x)
-                return x
+                logger.debug('got random integer: x=%s', rn)
+                return rn
 
             # got waste.
-            self.waste += (rn - n)
-            self.wastesize += (2**n_bits - n)
+            if self.stats is not None:
+                self.stats.bits_rejected += n_bits
+            # (rn - n) is uniform in {0, ..., 2**n_bits-n-1} and independent of
+            # waste, so that both together are uniform in the product range;
+            # adding them up instead would not be uniform
+            rejectsize = (1 << n_bits) - n
+            self.waste = self.waste * rejectsize + (rn - n)
+            self.wastesize = (self.wastesize or 1) * rejectsize
             logger.debug('now waste=%#x=%d, wastesize=%d', self.waste, self.waste, self.wastesize)
 
             # repeat until we manage to extract an integer....
 
         raise RuntimeError("Congrats! You've just miraculously broke out of an infinite loop")
 
+    def getInts(self, n, k):
+        """
+        Return a list of `k` independent random integers between `0` and `n-1`,
+        included.
+
+        Rather than calling `getInt(n)` `k` times, this function draws blocks of
+        `m` integers at once (with `m` given by `int_block_size(n)`): a single
+        random integer in `{0, ..., n**m-1}` is drawn with `getInt()` and decoded
+        into its `m` base-`n` digits.  The block size is chosen such that this
+        wide draw is hardly ever rejected, so much less randomness goes through
+        the waste.  Digits of the last block which are not needed are kept for
+        the next call with the same `n`.
+        """
+
+        if not n > 0:
+            raise ValueError("getInts(): Expected n > 0")
+
+        # only the integers handed out count as output, not those kept for
+        # later in pendingints
+        if self.stats is not None:
+            self.stats.count_output(n, k)
+
+        xs = self.pendingints.pop(n, [])
+        if len(xs) >= k:
+            if len(xs) > k:
+                self.pendingints[n] = xs[k:]
+            return xs[:k]
+
+        if n == 1:
+            return [0] * k
+
+        m, (N, n_bits, n_bits_mask) = int_block_size(n)
+
+        while len(xs) < k:
+            x = self._draw_int(N, n_bits, n_bits_mask)
+            for j in range(m):
+                x, d = divmod(x, n)
+                xs.append(d)
+
+        if len(xs) > k:
+            self.pendingints[n] = xs[k:]
+        return xs[:k]
+
+
+
+
+class NumpyIntRecoder(object):
+    """
+    Vectorized alternative to `RandomStreamIntRecoder` which extracts many
+    random integers in a given range at once, using NumPy.
+
+    A large block of random bytes is read from `f`, unpacked into `n_bits`-wide
+    lanes, and lanes falling outside `{0, ..., n-1}` are rejected.  Each
+    accepted lane is a uniformly random integer in `{0, ..., n-1}`, exactly as
+    for `RandomStreamIntRecoder.getInt()`; the only difference is that rejected
+    lanes are discarded instead of being recycled through a waste pool.
+    Accepted integers which were not requested are kept for later calls with
+    the same `n`.
+
+    Requires NumPy.  Single integers (`getInt()`) are delegated to an internal
+    `RandomStreamIntRecoder` reading from the same source.
+    """
+
+    # lanes are assembled into uint64 values
+    MAX_N_BITS = 63
+
+    def __init__(self, f, stats=None):
+        if import_numpy() is None:
+            raise RuntimeError("NumpyIntRecoder requires the numpy package")
+        self.f = f
+        self.stats = stats
+        self.scalar_recoder = RandomStreamIntRecoder(f, stats=stats)
+        self.pool = {}
+
+    def getInt(self, n, n_bits=None, n_bits_mask=None):
+        """
+        Return a random integer between `0` and `n-1`, included.
+        """
+        return self.scalar_recoder.getInt(n, n_bits, n_bits_mask)
+
+    def getInts(self, n, count):
+        """
+        Return a NumPy array of `count` independent random integers between `0`
+        and `n-1`, included.
+        """
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__ + ".getInts()")
+
+        if not n > 0:
+            raise ValueError("getInts(): Expected n > 0")
+
+        n_bits = (n-1).bit_length()
+        if n_bits > self.MAX_N_BITS:
+            raise ValueError("getInts(): n is too large (max. 2**%d)"%(self.MAX_N_BITS))
+
+        if n_bits == 0:
+            if self.stats is not None:
+                self.stats.count_output(n, count)
+            return numpy.zeros(count, dtype=numpy.uint64)
+
+        # weights of each bit within a lane, least significant bit first
+        lane_weights = numpy.left_shift(numpy.uint64(1),
+                                        numpy.arange(n_bits, dtype=numpy.uint64))
+
+        # probability that a lane is accepted
+        p_accept = n / float(1 << n_bits)
+
+        chunks = []
+        have = 0
+        pooled = self.pool.pop(n, None)
+        if pooled is not None:
+            chunks.append(pooled)
+            have += len(pooled)
+
+        while have < count:
+            # read enough bytes so that we most probably get all the needed
+            # integers in one go
+            nlanes = int(math.ceil((count - have) / p_accept * 1.1)) + 16
+            nbytes = (nlanes * n_bits + 7) // 8
+
+            raw = self.f.read(nbytes)
+            if raw is None or len(raw) < nbytes:
+                raise EOFError("Entropy source is exhausted")
+            dat = numpy.frombuffer(raw, dtype=numpy.uint8)
+            bits = numpy.unpackbits(dat, bitorder='little')
+            nlanes = len(bits) // n_bits
+            lanes = bits[:nlanes*n_bits].reshape(nlanes, n_bits).astype(numpy.uint64)
+            values = lanes.dot(lane_weights)
+
+            accepted = values[values < n]
+
+            if self.stats is not None:
+                self.stats.recoder_bytes_in += len(dat)
+                self.stats.bits_rejected += (nlanes - len(accepted)) * n_bits
+            logger.debug("n=%d, n_bits=%d: read %d bytes, accepted %d/%d lanes",
+                         n, n_bits, len(dat), len(accepted), nlanes)
+
+            chunks.append(accepted)
+            have += len(accepted)
+
+        allvalues = numpy.concatenate(chunks)
+        if have > count:
+            self.pool[n] = allvalues[count:]
+
+        if self.stats is not None:
+            self.stats.count_output(n, count)
+
+        return allvalues[:count]
+
 
+def _is_number(s):
+    import re
+    return re.match(r'^\d+$', s) is not None
 
 
 class SplitSpec(object):
@@ -240,7 +818,7 @@ class SplitSpec(object):
         items = s.split(':',1)
         if len(items) == 2:
             if len(items[0]):
-                if not re.match(r'^\d+$', items[0]):
+                if not _is_number(items[0]):
                     raise ValueError("Expected \"<NUMBER>:<SEPARATOR-CHARS>\", got \"%s\""%(s))
                 self.num = int(items[0])
             else:
@@ -255,7 +833,7 @@ class SplitSpec(object):
             return
 
         # else, either a number or a sepstr
-        if re.match(r'^\d+$', s):
+        if _is_number(s):
             self.num = int(s)
             self.sepstr = SplitSpec.DEFAULT_SEPSTR
             return
@@ -271,6 +849,11 @@ class SplitSpec(object):
         return repr(self)
 
 
+# same as in the `string` module, which we don't import as it pulls in `re`
+ascii_lowercase = 'abcdefghijklmnopqrstuvwxyz'
+ascii_uppercase = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+digits = '0123456789'
+
 default_special_chars = '!@#$%^&*()_+/-=[]{};:,.<>'
 
 GeneratePasswordArgs = collections.namedtuple('GeneratePasswordArgs', [
@@ -283,26 +866,108 @@ GeneratePasswordArgs = collections.namedtuple('GeneratePasswordArgs', [
     'force_each_category',
     'entropy_file',
     'concentrate_randomness',
-    'in_entropy_rate'
+    'in_entropy_rate',
+    'recoder',
+    'read_ahead',
+    'concentrator',
+    'wordlist',
+    'words',
+    'health_tests',
+    'drbg',
+    'drbg_reseed_interval',
+    'drbg_seed',
+    ], defaults=[
+        'auto', # recoder
+        None, # read_ahead
+        'sha512', # concentrator
+        None, # wordlist
+        6, # words
+        None, # health_tests
+        None, # drbg
+        None, # drbg_reseed_interval
+        None, # drbg_seed
     ])
-    
 
-def generate_password(args):
 
-    logger = logging.getLogger(__name__ + ".generate_password()")
+# The fields of GeneratePasswordArgs which make up a password policy, and which
+# may be given separately for each password request (see mkpw.server) or each
+# row of a batch manifest (see mkpw.batch)
+POLICY_FIELDS = ('length', 'alpha_lower', 'alpha_upper', 'digits', 'chars', 'split',
+                 'force_each_category', 'words')
+
+def args_with_policy(base_args, fields, presets=None):
+    """
+    Return the `GeneratePasswordArgs` given by `base_args` (e.g. the parsed
+    command-line options), with the preset `fields['preset']` applied if
+    present, and then the policy fields (see `POLICY_FIELDS`) found in the
+    dictionary `fields`.  Values are as decoded from JSON: "split" is a split
+    specification string or `None`, "chars" is a boolean or a string of special
+    chars, "length" and "words" are positive integers, and the other fields are
+    booleans.  Other keys of `fields` are ignored.
+
+    `presets` is a dictionary `{name: fn}` of the available presets, where
+    `fn(namespace)` sets the preset's options.  Only the policy fields set by
+    a preset are used: the other settings, such as the entropy source and
+    rate (which e.g. the 'paranoid' preset sets too), are always those of
+    `base_args`.  Raises `ValueError` if a value is invalid.
+    """
+    import types
+    ns = types.SimpleNamespace(**dict([ (k, getattr(base_args, k))
+                                        for k in GeneratePasswordArgs._fields
+                                        if hasattr(base_args, k) ]))
+    preset = fields.get('preset')
+    if preset is not None:
+        if presets is None or preset not in presets:
+            raise ValueError("Unknown preset: %r"%(preset,))
+        preset_ns = types.SimpleNamespace(**vars(ns))
+        presets[preset](preset_ns)
+        for k in POLICY_FIELDS:
+            setattr(ns, k, getattr(preset_ns, k))
+    for k in POLICY_FIELDS:
+        if k not in fields:
+            continue
+        value = fields[k]
+        if k == 'split':
+            if value is not None and not isinstance(value, str):
+                raise ValueError("Invalid split: %r"%(value,))
+            value = SplitSpec(value)
+        elif k in ('length', 'words'):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                raise ValueError("Invalid %s: %r"%(k, value))
+        elif k == 'chars':
+            if not isinstance(value, (str, bool)):
+                raise ValueError("Invalid chars: %r"%(value,))
+        else:
+            value = bool(value)
+        setattr(ns, k, value)
+    return GeneratePasswordArgs(**vars(ns))
+
 
-    f = None
-    if args.entropy_file == '-':
-        f = sys.stdin.buffer
-    else:
-        f = open(args.entropy_file, 'rb')
+def _make_recoder(args, fin, stats=None):
 
-    if args.concentrate_randomness:
-        fin = RandomSourceConcentrator(f, args.in_entropy_rate)
-    else:
-        fin = f
+    logger = get_logger(__name__ + "._make_recoder()")
 
-    rndgen = RandomStreamIntRecoder(fin)
+    recoder = getattr(args, 'recoder', 'auto')
+
+    if recoder not in ('auto', 'python', 'numpy'):
+        raise ValueError("Invalid recoder: %r"%(recoder,))
+
+    # 'auto' is the pure-Python recoder: the two recoders turn the same
+    # random bytes into different characters, and the output must not depend
+    # on whether some unrelated code happened to import NumPy (e.g. with a
+    # fixed DRBG seed, see mkpw.drbg).  Importing NumPy just for this would
+    # take longer than generating a few passwords.
+    if recoder == 'numpy':
+        if import_numpy() is not None:
+            return NumpyIntRecoder(fin, stats=stats)
+        logger.warning("NumPy is not available, falling back to the pure-Python recoder")
+
+    return RandomStreamIntRecoder(fin, stats=stats)
+    
+
+def _get_char_categories(args):
+
+    logger = get_logger(__name__ + "._get_char_categories()")
 
     allchars = False
     if not args.alpha_lower and not args.alpha_upper and not args.digits and not args.chars:
@@ -311,61 +976,554 @@ def generate_password(args):
     pwcharcategories = {}
         
     if allchars or args.alpha_lower:
-        pwcharcategories['ascii_lowercase'] = string.ascii_lowercase
+        pwcharcategories['ascii_lowercase'] = ascii_lowercase
     if allchars or args.alpha_upper:
-        pwcharcategories['ascii_uppercase'] = string.ascii_uppercase
+        pwcharcategories['ascii_uppercase'] = ascii_uppercase
     if allchars or args.digits:
-        pwcharcategories['digits'] = string.digits
+        pwcharcategories['digits'] = digits
     if allchars or args.chars:
         pwcharcategories['chars'] = args.chars if isinstance(args.chars, str) else default_special_chars
 
     logger.debug('pwcharcategories=%r', pwcharcategories)
 
-    charlist = "".join(pwcharcategories.values())
+    return pwcharcategories
+
+
+class PasswordPolicy(object):
+    """
+    The password settings of a `GeneratePasswordArgs`, compiled into the tables
+    needed to generate passwords: the character categories and their joined
+    alphabet, the bit widths and masks needed to draw characters from them, and
+    the grouping layout given by the split specification.
+
+    Don't instantiate directly; use `PasswordPolicy.from_args()`, which caches
+    compiled policies.
+    """
+
+    # maximal number of compiled policies kept in the cache
+    CACHE_SIZE = 128
+
+    # the group slices for splitting are precomputed if there are at most this
+    # many groups (i.e., not for very long passwords)
+    MAX_SPLIT_SLICES = 256
+
+    def __init__(self, length, alpha_lower, alpha_upper, digits, chars, split_num,
+                 split_sepstr, force_each_category):
+
+        self.length = length
+        self.force_each_category = force_each_category
+
+        self.categories = _get_char_categories(GeneratePasswordArgs(
+            length=length, alpha_lower=alpha_lower, alpha_upper=alpha_upper,
+            digits=digits, chars=chars, split=None,
+            force_each_category=force_each_category, entropy_file=None,
+            concentrate_randomness=None, in_entropy_rate=None,
+        ))
+        self.category_names = list(self.categories.keys())
+
+        if force_each_category and len(self.categories) > length:
+            raise ValueError("Can't force one char per category, password too short")
+
+        self.charlist = "".join(self.categories.values())
+        self.charlist_size = len(self.charlist)
+        self.charlist_bits, self.charlist_mask = int_bits(self.charlist_size)
+        # upper bound of the number of random bits drawn per password, not
+        # counting rejected draws
+        self.draw_bits = length * self.charlist_bits
+
+        # {category-name: (chars, size, n_bits, n_bits_mask)}
+        self.category_tables = {}
+        for cat, chars in self.categories.items():
+            self.category_tables[cat] = (chars, len(chars)) + int_bits(len(chars))
+
+        self.split_num = split_num
+        self.split_sepstr = split_sepstr
+        # [(start, end), ...] slices of the unsplit password for each group
+        if split_num > 0 and length <= split_num * self.MAX_SPLIT_SLICES:
+            self.split_slices = [ (i, min(i+split_num, length))
+                                  for i in range(0, length, split_num) ]
+        else:
+            self.split_slices = None
+
+    @staticmethod
+    def key_from_args(args):
+        """
+        Return a hashable key identifying the policy-related fields of `args`.
+        """
+        chars = args.chars if isinstance(args.chars, str) else bool(args.chars)
+        split = args.split
+        return (args.length, bool(args.alpha_lower), bool(args.alpha_upper),
+                bool(args.digits), chars, split.num, split.sepstr,
+                bool(args.force_each_category))
+
+    @staticmethod
+    def from_args(args):
+        """
+        Return the compiled policy for the settings `args` (e.g., a
+        `GeneratePasswordArgs`).  Policies are compiled once and kept in a
+        least-recently-used cache of `CACHE_SIZE` entries.
+        """
+        return _compile_policy(PasswordPolicy.key_from_args(args))
+
+    def apply_split(self, pw):
+        """
+        Split the (unsplit) password `pw` into groups according to the policy.
+        """
+        if self.split_slices is None:
+            if self.split_num > 0:
+                return _split_chunk(pw, 0, self.split_num, self.split_sepstr)
+            return pw
+        return self.split_sepstr.join([pw[a:b] for (a, b) in self.split_slices])
+
+    def __repr__(self):
+        return "PasswordPolicy(length=%r,charlist=%r,split=%r,force_each_category=%r)"%(
+            self.length, self.charlist, (self.split_num, self.split_sepstr),
+            self.force_each_category)
+
+
+@functools.lru_cache(maxsize=PasswordPolicy.CACHE_SIZE)
+def _compile_policy(key):
+    return PasswordPolicy(*key)
+
+
+def policy_from_args(args):
+    """
+    Return the compiled policy for `args`: a
+    `mkpw.wordlist.PassphrasePolicy` if `args.wordlist` is set, or a
+    `PasswordPolicy` otherwise.
+    """
+    if getattr(args, 'wordlist', None):
+        from .wordlist import PassphrasePolicy
+        return PassphrasePolicy.from_args(args)
+    return PasswordPolicy.from_args(args)
 
-    logger.debug('charlist=%s', charlist)
+
+def _choose_forced_positions(policy, rndgen):
+    """
+    If the policy forces one character per category (say m categories), choose
+    m distinct positions in the password, and return a dictionary
+    `{position-in-pw: category-name}`; otherwise, return an empty dictionary.
+
+    Each category gets a uniformly random position among those not taken yet.
+    The positions taken so far are kept in a sorted list, and the `i`-th free
+    position is found by skipping over them, so this takes `O(m**2)` time and no
+    memory proportional to the length of the password.
+    """
+    force_categories = {}
+    if not policy.force_each_category:
+        return force_categories
+    taken = []
+    for cat in policy.category_names:
+        # choose from available positions
+        i = rndgen.getInt(policy.length - len(taken))
+        # find the i-th position which isn't taken
+        catpos = i
+        for p in taken:
+            if p > catpos:
+                break
+            catpos += 1
+        bisect.insort(taken, catpos)
+        force_categories[catpos] = cat
+    return force_categories
+
+
+def _draw_forced_char(policy, rndgen, cat):
+    thischarlist, size, n_bits, n_bits_mask = policy.category_tables[cat]
+    return thischarlist[rndgen.getInt(size, n_bits, n_bits_mask)]
+
+
+def _draw_chars(policy, rndgen, count):
+    # draw `count` unconstrained characters at once, returned as a list
+    xs = rndgen.getInts(policy.charlist_size, count)
+    if isinstance(rndgen, NumpyIntRecoder):
+        xs = xs.tolist()
+    return list(map(policy.charlist.__getitem__, xs))
+
+
+def _generate_one_password(policy, rndgen):
+
+    logger = get_logger(__name__ + "._generate_one_password()")
 
     # if we need at least one character per category (say m categories), then 1)
     # choose m distinct positions 2) at each of those positions, the random
     # choice will be restricted to that category
-    force_categories = {} # { position-in-pw: category-name }
-    if args.force_each_category:
-        if len(pwcharcategories) > args.length:
-            logger.error("Can't force one char per category, password too short (%d)!", args.length)
-            raise ValueError("Can't force one char per category, password too short")
+    force_categories = _choose_forced_positions(policy, rndgen)
+
+    # draw all the unconstrained characters at once
+    chars = _draw_chars(policy, rndgen, policy.length - len(force_categories))
+
+    # insert the forced characters, in increasing order of position so that
+    # each one lands at its final position
+    for catpos in sorted(force_categories):
+        ch = _draw_forced_char(policy, rndgen, force_categories[catpos])
+        logger.debug("got forced pw char at position %d: %r", catpos, ch)
+        chars.insert(catpos, ch)
+
+    # potentially split the password into groups
+    return policy.apply_split("".join(chars))
+
+
+def _split_chunk(s, offset, num, sepstr):
+    """
+    Insert the separator `sepstr` in `s` between groups of `num` characters,
+    where `s` is a piece of an unsplit password starting at position `offset`.
+    The result starts with a separator if `s` starts a new group (other than
+    the first one).
+    """
+    pieces = []
+    i = 0
+    if offset % num:
+        # complete the group started in the previous piece
+        i = min(len(s), num - offset % num)
+        pieces.append(s[:i])
+    elif offset > 0:
+        pieces.append('')
+    for j in range(i, len(s), num):
+        pieces.append(s[j:j+num])
+    return sepstr.join(pieces)
+
+
+# number of password characters generated at once when streaming
+STREAM_CHUNK_SIZE = 1 << 16
+
+def _generate_password_chunks(policy, rndgen, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generate a password like `_generate_one_password()`, but yield it in pieces
+    of about `chunk_size` characters (plus separators), so that memory use
+    doesn't depend on the length of the password.
+    """
+    length = policy.length
+    split_num = policy.split_num
+    split_sepstr = policy.split_sepstr
+
+    force_categories = _choose_forced_positions(policy, rndgen)
+    forced_positions = sorted(force_categories)
+    k = 0 # next forced position to place
+
+    for a in range(0, length, chunk_size):
+        b = min(a + chunk_size, length)
+        k_end = bisect.bisect_left(forced_positions, b, k)
+
+        chars = _draw_chars(policy, rndgen, (b - a) - (k_end - k))
+        for catpos in forced_positions[k:k_end]:
+            chars.insert(catpos - a, _draw_forced_char(policy, rndgen,
+                                                       force_categories[catpos]))
+        k = k_end
+
+        s = "".join(chars)
+        if split_num > 0:
+            s = _split_chunk(s, a, split_num, split_sepstr)
+        yield s
+
+
+class PasswordGenerator(object):
+    """
+    Holds an entropy source along with the randomness concentrator and integer
+    recoder reading from it, so that several passwords can be generated with
+    the same settings without any per-password setup.
+
+    Arguments:
+
+      - `args`: the password settings, e.g. a `GeneratePasswordArgs` instance.
+        The entropy source is given by `args.entropy_file` (see
+        `mkpw.entropy.parse_entropy_source_spec()`).
+
+      - `pool`: the `EntropySourcePool` from which to get the entropy source.
+        By default, `mkpw.entropy.default_entropy_pool` is used.  The source
+        belongs to the pool and is left open by `close()`.
+
+      - `stats`: an optional `mkpw.stats.GenerationStats` instance, which is
+        updated by the concentrator and the recoder.
+
+    If `args.health_tests` is one of the policies 'abort', 'warn' or 'reseed',
+    the raw data read from the entropy source goes through the continuous
+    health tests of `mkpw.health.HealthTestedSource`, whose counters are then
+    available as the `health` attribute (a `mkpw.health.HealthTests`).
+
+    If `args.drbg` is 'hash' or 'hmac', the recoder reads from a
+    `mkpw.drbg.DrbgSource` seeded from the concentrated randomness, and
+    reseeded every `args.drbg_reseed_interval` bytes of output.  If
+    `args.drbg_seed` is set (a string of hexadecimal digits), the DRBG is
+    seeded with it instead, and the passwords are reproducible.
+    """
+    def __init__(self, args, pool=None, stats=None):
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        self.args = args
+        self.stats = stats
+
+        self.f = open_entropy_source(args.entropy_file, pool=pool)
+
+        # continuous health tests on the raw data (see mkpw.health)
+        self.health = None
+        health_policy = getattr(args, 'health_tests', None)
+        if health_policy and health_policy != 'off':
+            from .health import HealthTestedSource
+            self.f = HealthTestedSource(self.f, args.in_entropy_rate, policy=health_policy,
+                                        stats=stats)
+            self.health = self.f.tests
+
+        if args.concentrate_randomness:
+            self.fin = RandomSourceConcentrator(self.f, args.in_entropy_rate,
+                                                read_ahead=getattr(args, 'read_ahead', None),
+                                                stats=stats,
+                                                engine=getattr(args, 'concentrator', 'sha512'))
         else:
-            avail_catpos_list = list(range(args.length))
-            for cat in pwcharcategories.keys():
-                # choose from available positions
-                i = rndgen.getInt(len(avail_catpos_list))
-                catpos = avail_catpos_list[i]
-                del avail_catpos_list[i]
-                force_categories[catpos] = cat
-            # force_categories is now properly initialized
-
-    pw = ''
-    l = 0 # saved value of len(pw)
-    while (l < args.length):
-        if l in force_categories:
-            # only choose from fixed category
-            thischarlist = pwcharcategories[force_categories[l]]
+            self.fin = self.f
+
+        drbg = getattr(args, 'drbg', None)
+        if drbg and drbg != 'off':
+            from .drbg import DrbgSource, DEFAULT_RESEED_INTERVAL, parse_seed
+            reseed_interval = (getattr(args, 'drbg_reseed_interval', None)
+                               or DEFAULT_RESEED_INTERVAL)
+            seed = getattr(args, 'drbg_seed', None)
+            if seed is not None:
+                self.fin = DrbgSource(None, drbg, reseed_interval, seed=parse_seed(seed),
+                                      stats=stats)
+            else:
+                entropyrate = 1.0 if args.concentrate_randomness else args.in_entropy_rate
+                self.fin = DrbgSource(self.fin, drbg, reseed_interval,
+                                      entropyrate=entropyrate, stats=stats)
+
+        self.rndgen = _make_recoder(args, self.fin, stats=stats)
+
+        self.policy = policy_from_args(args)
+        if isinstance(self.policy, PasswordPolicy):
+            self._generate_one = _generate_one_password
         else:
-            # use our charlist
-            thischarlist = charlist
+            from .wordlist import _generate_one_passphrase
+            self._generate_one = _generate_one_passphrase
 
-        x = rndgen.getInt(len(thischarlist))
-        ch = thischarlist[x]
-        logger.debug("got pw char: %r (x=%d from thischarlist=%r)", ch, x, thischarlist)
+        logger.debug('policy=%r', self.policy)
 
-        pw += ch
-        l += 1
+    @staticmethod
+    def key_from_args(args):
+        """
+        Return a hashable key identifying all the settings of `args` which
+        determine the generator: the policy, the entropy source and how it is
+        read.
+        """
+        if getattr(args, 'wordlist', None):
+            from .wordlist import PassphrasePolicy
+            policy_key = PassphrasePolicy.key_from_args(args)
+        else:
+            policy_key = PasswordPolicy.key_from_args(args)
+        return policy_key + (
+            args.entropy_file, bool(args.concentrate_randomness), args.in_entropy_rate,
+            getattr(args, 'recoder', 'auto'), getattr(args, 'read_ahead', None),
+            getattr(args, 'concentrator', 'sha512'), getattr(args, 'health_tests', None),
+            getattr(args, 'drbg', None), getattr(args, 'drbg_reseed_interval', None),
+            getattr(args, 'drbg_seed', None),
+        )
+
+    def generate(self):
+        """
+        Generate and return a new password.
+        """
+        stats = self.stats
+        if stats is None:
+            return self._generate_one(self.policy, self.rndgen)
+        stats.passwords += 1
+        t0 = time.perf_counter()
+        input_time = stats.input_time()
+        pw = self._generate_one(self.policy, self.rndgen)
+        stats.add_recode_time(time.perf_counter() - t0, input_time)
+        return pw
+
+    def generate_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Generate a new password, yielding it in consecutive pieces of about
+        `chunk_size` characters (plus group separators).  Memory use stays
+        constant however long the password is, which makes this suitable for
+        very long secrets such as key material or one-time pads.  Passphrases
+        are yielded in one piece.
+        """
+        stats = self.stats
+        if stats is not None:
+            stats.passwords += 1
+        if isinstance(self.policy, PasswordPolicy):
+            chunks = _generate_password_chunks(self.policy, self.rndgen, chunk_size)
+        else:
+            # a passphrase, in one piece (generated lazily, within the timing
+            # below)
+            chunks = ( self._generate_one(self.policy, self.rndgen) for j in range(1) )
+        while True:
+            if stats is not None:
+                t0 = time.perf_counter()
+                input_time = stats.input_time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                if stats is not None:
+                    stats.add_recode_time(time.perf_counter() - t0, input_time)
+            yield chunk
+
+    def buffered_bits(self):
+        """
+        Return the number of random bits currently left unused in the recoder's
+        buffer.
+        """
+        rndgen = self.rndgen
+        if isinstance(rndgen, NumpyIntRecoder):
+            rndgen = rndgen.scalar_recoder
+        return rndgen.bitsbufferlen
 
-            
+    def close(self):
+        if self.stats is not None and self.rndgen is not None:
+            self.stats.bits_left += self.buffered_bits()
+        # the entropy source itself is owned by the pool
+        self.f = None
+        self.fin = None
+        self.rndgen = None
 
-    # potentially split the password into groups
-    spl = args.split
-    if spl.num > 0:
-        pw = spl.sepstr.join([pw[i:i+spl.num] for i in range(0, len(pw), spl.num)])
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    return pw
 
+def generate_passwords(args, count, jobs=1, chunksize=None, stats=None):
+    """
+    Generate `count` passwords according to `args`, yielding them one by one.
+
+    A single entropy source, concentrator and `RandomStreamIntRecoder` are
+    shared for the whole batch, so that leftover bits (including the recoder's
+    waste) carry over from one password to the next.  The entropy source is
+    taken from `mkpw.entropy.default_entropy_pool` and stays open for later
+    calls.
+
+    If `jobs > 1`, the work is split into chunks of `chunksize` passwords which
+    are generated by a pool of `jobs` worker processes.  Each worker opens the
+    entropy file on its own and keeps its own concentrator and recoder state,
+    so no randomness is shared between workers.  Passwords are still yielded in
+    order.  Parallel generation requires an entropy source which gives
+    independent data to each reader, such as `getrandom:` or `/dev/urandom`
+    (not the standard input or a regular file), and no fixed DRBG seed.
+
+    If `stats` is a `mkpw.stats.GenerationStats` instance, it is updated with
+    the counters of the whole batch (including those of all workers).
+    """
+
+    if count < 0:
+        raise ValueError("generate_passwords(): Expected count >= 0")
+
+    if jobs is not None and jobs > 1:
+        for pw in _generate_passwords_parallel(args, count, jobs, chunksize, stats):
+            yield pw
+        return
+
+    with PasswordGenerator(args, stats=stats) as pwgen:
+        for j in range(count):
+            yield pwgen.generate()
+
+
+# the PasswordGenerator of the current worker process
+_worker_pwgen = None
+_worker_bits_left = 0
+
+def _worker_init(args, with_stats):
+    global _worker_pwgen
+    stats = None
+    if with_stats:
+        from .stats import GenerationStats
+        stats = GenerationStats()
+    # use a private pool, never anything inherited from the parent process
+    _worker_pwgen = PasswordGenerator(args, pool=EntropySourcePool(), stats=stats)
+
+def _worker_generate(count):
+    global _worker_bits_left
+    pws = [ _worker_pwgen.generate() for j in range(count) ]
+    stats = _worker_pwgen.stats
+    if stats is None:
+        return pws, None
+    # report the counters accumulated since the last chunk
+    bits_left = _worker_pwgen.buffered_bits()
+    stats.bits_left = bits_left - _worker_bits_left
+    _worker_bits_left = bits_left
+    statsdict = stats.as_dict()
+    stats.reset()
+    return pws, statsdict
+
+def check_parallel_args(args):
+    """
+    Raise `ValueError` if passwords can't be generated with the settings `args`
+    by several independent processes, i.e., if the entropy source isn't
+    parallel-safe or if a fixed DRBG seed is given.
+    """
+    if getattr(args, 'drbg_seed', None) is not None:
+        raise ValueError("Can't generate passwords in parallel from a fixed DRBG seed, "
+                         "all workers would generate the same passwords")
+
+    if not open_entropy_source(args.entropy_file).parallel_safe:
+        raise ValueError("Can't generate passwords in parallel from entropy source %r, "
+                         "parallel workers would read the same data"%(args.entropy_file))
+
+def _generate_passwords_parallel(args, count, jobs, chunksize, stats):
+
+    logger = get_logger(__name__ + "._generate_passwords_parallel()")
+
+    import concurrent.futures
+
+    check_parallel_args(args)
+
+    if chunksize is None:
+        # a few chunks per worker to balance the load, but not too large so
+        # that results start streaming quickly
+        chunksize = max(1, min(10000, count // (4*jobs)))
+
+    logger.debug("generating %d passwords with %d jobs, chunksize=%d", count, jobs, chunksize)
+
+    chunks = [ min(chunksize, count - k) for k in range(0, count, chunksize) ]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_worker_init,
+                                                initargs=(args, stats is not None)) as executor:
+        # keep a bounded number of chunks in flight, and collect them in order
+        pending = collections.deque()
+        chunks_iter = iter(chunks)
+        try:
+            for c in chunks_iter:
+                pending.append(executor.submit(_worker_generate, c))
+                if len(pending) >= 2*jobs:
+                    break
+            while pending:
+                pws, statsdict = pending.popleft().result()
+                if stats is not None:
+                    stats.merge(statsdict)
+                for pw in pws:
+                    yield pw
+                for c in chunks_iter:
+                    pending.append(executor.submit(_worker_generate, c))
+                    break
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+
+def generate_password(args):
+    """
+    Generate a single password according to `args` (see `GeneratePasswordArgs`).
+    """
+    pwiter = generate_passwords(args, 1)
+    try:
+        return next(pwiter)
+    finally:
+        pwiter.close()
+
+
+def write_passwords(args, out, count=1, chunk_size=STREAM_CHUNK_SIZE, stats=None):
+    """
+    Generate `count` passwords according to `args` and write them to the text
+    file object `out`, one per line, as they are generated: each password is
+    written in pieces of about `chunk_size` characters (see
+    `PasswordGenerator.generate_chunks()`), so memory use doesn't depend on the
+    password length.
+    """
+    with PasswordGenerator(args, stats=stats) as pwgen:
+        for j in range(count):
+            for chunk in pwgen.generate_chunks(chunk_size):
+                out.write(chunk)
+            out.write('\n')
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import collections
+
+from ._logutil import get_logger
+
+from .mkpw import PasswordGenerator
+
+
+
+class _PoolEntry(object):
+    """
+    The queue of ready-made passwords for one policy, along with the generator
+    which fills it and its counters.
+    """
+    def __init__(self, key, name, pwgen):
+        self.key = key
+        self.name = name
+        self.pwgen = pwgen
+        # serializes the use of pwgen between the fill thread and misses
+        self.pwgen_lock = threading.Lock()
+        # [ (time-generated, password), ... ], oldest first
+        self.queue = collections.deque()
+        # set when the queue fell below the low-water mark, until it is full
+        self.refilling = True
+        # exception raised by the generator, if any; we stop filling then
+        self.error = None
+        self.hits = 0
+        self.misses = 0
+        self.filled = 0
+        self.evicted = 0
+
+
+class PasswordPool(object):
+    """
+    Keeps a bounded queue of pre-generated passwords for each registered
+    policy, so that requests are answered immediately instead of waiting on a
+    possibly slow entropy source (e.g. `/dev/random` with a low entropy rate).
+
+    A background thread generates passwords for each policy whose queue has
+    fallen below `low_water` entries, until the queue holds `size` entries
+    again.  Passwords which have been waiting for more than `ttl` seconds are
+    dropped (and replaced), so that pooled secrets don't sit in memory
+    indefinitely; use `ttl=None` to keep them until they are used.  Note that
+    with a finite `ttl`, the pool keeps consuming entropy for each registered
+    policy (`size` passwords every `ttl` seconds) even if nobody asks for them.
+
+    Arguments:
+
+      - `size`: the number of passwords to keep ready for each policy;
+
+      - `low_water`: refill a queue when it holds fewer than this many
+        passwords (by default, half of `size`);
+
+      - `ttl`: the time in seconds after which unused passwords are dropped;
+
+      - `pool`: the `EntropySourcePool` from which the generators get their
+        entropy sources (see `PasswordGenerator`).
+
+    Passwords are handed out by `get()`, which registers the policy if needed.
+    If a queue is empty, `get()` generates the password directly (this counts
+    as a miss).  The counters are available through `metrics()`.
+
+    The background thread is started with the first registered policy.  Call
+    `close()` (or use the pool as a context manager) to stop it and drop all
+    pooled passwords.
+    """
+
+    def __init__(self, size=32, low_water=None, ttl=600.0, pool=None):
+        if size < 1:
+            raise ValueError("PasswordPool(): Expected size >= 1")
+        if low_water is None:
+            low_water = max(1, size // 2)
+        if low_water < 1 or low_water > size:
+            raise ValueError("PasswordPool(): Expected 1 <= low_water <= size")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("PasswordPool(): Expected ttl > 0")
+
+        self.size = size
+        self.low_water = low_water
+        self.ttl = ttl
+        self.pool = pool
+
+        # {generator-key: _PoolEntry}; protected by self.cond, as are the
+        # queues and the counters of the entries
+        self.entries = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def register(self, args, name=None):
+        """
+        Start keeping passwords ready for the settings `args` (e.g. a
+        `GeneratePasswordArgs`), and return the key identifying them.  The
+        optional `name` is used to report the policy's counters in `metrics()`;
+        by default, the policy's `repr()` and the entropy source are used.  Registering the same
+        settings again has no effect.
+        """
+        return self._get_entry(args, name).key
+
+    def unregister(self, args):
+        """
+        Stop keeping passwords ready for the settings `args`, dropping those
+        which are pooled.
+        """
+        key = PasswordGenerator.key_from_args(args)
+        with self.cond:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            entry.queue.clear()
+        with entry.pwgen_lock:
+            entry.pwgen.close()
+
+    def _get_entry(self, args, name=None):
+        key = PasswordGenerator.key_from_args(args)
+        with self.cond:
+            if self.closed:
+                raise ValueError("PasswordPool is closed")
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry
+        # open the source and set up the generator outside of the lock; this
+        # raises if the settings are invalid
+        pwgen = PasswordGenerator(args, pool=self.pool)
+        if name is None:
+            name = "%r from %s"%(pwgen.policy, args.entropy_file)
+        with self.cond:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = _PoolEntry(key, name, pwgen)
+                self.entries[key] = entry
+                self._start_thread()
+                self.cond.notify_all()
+                return entry
+        # somebody else registered the same settings in the meantime
+        pwgen.close()
+        return entry
+
+    def get(self, args):
+        """
+        Return a password for the settings `args`, taken from the pool if one
+        is ready, or generated on the spot otherwise.
+        """
+        entry = self._get_entry(args)
+        with self.cond:
+            self._evict(entry, time.monotonic())
+            if entry.queue:
+                pw = entry.queue.popleft()[1]
+                entry.hits += 1
+            else:
+                pw = None
+                entry.misses += 1
+            if len(entry.queue) < self.low_water:
+                entry.refilling = True
+                self.cond.notify_all()
+        if pw is None:
+            with entry.pwgen_lock:
+                pw = entry.pwgen.generate()
+        return pw
+
+    def metrics(self):
+        """
+        Return a dictionary with the pool's settings and counters, suitable for
+        monitoring (it can be serialized as JSON).
+
+        The item `'policies'` is a dictionary `{name: counters}` holding, for
+        each registered policy: `'available'`, the number of passwords ready;
+        `'hits'` and `'misses'`, the number of passwords served from the pool
+        and generated on the spot; `'filled'`, the number of passwords
+        generated in the background; `'evicted'`, the number of passwords
+        dropped after `ttl`; `'oldest_age'`, the age in seconds of the oldest
+        pooled password (or `None`); and `'error'`, the error which stopped the
+        background generation, if any.  The item `'totals'` sums the counters
+        over all policies, along with the overall `'miss_rate'`.
+        """
+        now = time.monotonic()
+        policies = {}
+        totals = dict(available=0, hits=0, misses=0, filled=0, evicted=0)
+        with self.cond:
+            for entry in self.entries.values():
+                m = {
+                    'available': len(entry.queue),
+                    'hits': entry.hits,
+                    'misses': entry.misses,
+                    'filled': entry.filled,
+                    'evicted': entry.evicted,
+                    'oldest_age': (now - entry.queue[0][0]) if entry.queue else None,
+                    'error': str(entry.error) if entry.error is not None else None,
+                }
+                policies[entry.name] = m
+                for k in totals:
+                    totals[k] += m[k]
+        requests = totals['hits'] + totals['misses']
+        totals['miss_rate'] = totals['misses'] / requests if requests else 0.0
+        return {
+            'size': self.size,
+            'low_water': self.low_water,
+            'ttl': self.ttl,
+            'policies': policies,
+            'totals': totals,
+        }
+
+    def close(self):
+        """
+        Stop the background thread, and drop all pooled passwords.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        with self.cond:
+            entries = list(self.entries.values())
+            self.entries = {}
+        for entry in entries:
+            entry.queue.clear()
+            with entry.pwgen_lock:
+                entry.pwgen.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # the following methods are called with self.cond held
+
+    def _start_thread(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, name='PasswordPool', daemon=True)
+        self.thread.start()
+
+    def _evict(self, entry, now):
+        if self.ttl is None:
+            return
+        queue = entry.queue
+        while queue and now - queue[0][0] > self.ttl:
+            queue.popleft()
+            entry.evicted += 1
+        if len(queue) < self.low_water:
+            entry.refilling = True
+
+    def _next_to_fill(self):
+        # evict stale passwords, and return the entry which most needs a new
+        # password, or None if all queues are full enough
+        now = time.monotonic()
+        best = None
+        for entry in self.entries.values():
+            self._evict(entry, now)
+            if not entry.refilling or entry.error is not None:
+                continue
+            if best is None or len(entry.queue) < len(best.queue):
+                best = entry
+        return best
+
+    def _wait_delay(self):
+        # time until the next password goes stale, or None
+        if self.ttl is None:
+            return None
+        oldest = [ entry.queue[0][0] for entry in self.entries.values() if entry.queue ]
+        if not oldest:
+            return None
+        return max(0.0, min(oldest) + self.ttl - time.monotonic()) + 0.001
+
+    # the background thread
+
+    def _run(self):
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+                    entry = self._next_to_fill()
+                    if entry is not None:
+                        break
+                    self.cond.wait(self._wait_delay())
+
+            # generate without holding self.cond, so that requests can be
+            # served from the other queues in the meantime
+            try:
+                with entry.pwgen_lock:
+                    if entry.pwgen.rndgen is None:
+                        # unregistered or closed in the meantime
+                        continue
+                    pw = entry.pwgen.generate()
+            except Exception as e:
+                logger.error("Can't generate passwords for %s: %s", entry.name, e)
+                with self.cond:
+                    entry.error = e
+                continue
+
+            with self.cond:
+                entry.queue.append((time.monotonic(), pw))
+                entry.filled += 1
+                if len(entry.queue) >= self.size:
+                    entry.refilling = False
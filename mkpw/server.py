@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import json
+import socket
+import socketserver
+import threading
+from ._logutil import get_logger
+
+from .mkpw import POLICY_FIELDS, PasswordGenerator, args_with_policy
+from .health import EntropyHealthError
+
+
+# Protocol
+# --------
+#
+# The client sends one JSON object per line, and the server answers each with
+# one JSON object on a line.  A request may contain:
+#
+#   - "preset": one of the preset names given to the server (e.g. "mobile",
+#     "website", "paranoid"), applied first; only the policy part of the
+#     preset applies (e.g. "paranoid" doesn't switch to /dev/random);
+#
+#   - any of the policy fields "length", "alpha_lower", "alpha_upper",
+#     "digits", "chars" (true/false or a string of special chars), "split"
+#     (a split specification string as for -s, or null),
+#     "force_each_category" and "words" (the number of words, if the server
+#     generates passphrases from a word list);
+#
+#   - "count": the number of passwords to generate (default 1, at most
+#     MAX_COUNT).
+#
+# "length" and "words" may not exceed MAX_LENGTH.
+#
+# The answer is {"passwords": [...]} or {"error": "<message>"}.  Entropy
+# settings (entropy file, concentration, entropy rate) are those of the server.
+#
+# The request {"metrics": true} is answered with {"metrics": {...}}, the
+# counters of the server's password pool (see `mkpw.pwpool.PasswordPool`), or
+# {"metrics": null} if the server doesn't pool passwords.
+
+MAX_COUNT = 100000
+
+MAX_LENGTH = 4096
+
+
+
+class PasswordServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves passwords over a local Unix socket, keeping a warm
+    `PasswordGenerator` (open entropy source, concentrator and recoder state)
+    for each policy requested so far.
+
+    Arguments:
+
+      - `path`: the path of the Unix socket.  The socket is only accessible by
+        the current user.
+
+      - `base_args`: the settings used for all requests, e.g. as parsed from the
+        command line; requests may override the policy fields.
+
+      - `presets`: a dictionary `{name: fn}` of presets which requests may
+        refer to, where `fn(namespace)` sets the preset's options on a
+        namespace (see `mkpw.mkpw.args_with_policy()`).
+
+      - `password_pool`: an optional `mkpw.pwpool.PasswordPool`, from which
+        passwords are then served instead of being generated on request.  The
+        server closes it in `server_close()`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, base_args, presets=None, password_pool=None):
+        self.path = path
+        self.base_args = base_args
+        self.presets = presets if presets is not None else {}
+        self.password_pool = password_pool
+        self.generators = {}
+        self.generators_lock = threading.Lock()
+
+        _remove_stale_socket(path)
+
+        old_umask = os.umask(0o077)
+        try:
+            super(PasswordServer, self).__init__(path, PasswordRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def make_args(self, request):
+        """
+        Return the `GeneratePasswordArgs` for the JSON request `request`.
+        """
+        return args_with_policy(self.base_args, request, self.presets)
+
+    def get_generator(self, args):
+        """
+        Return the warm `PasswordGenerator` for `args`, along with the lock to
+        hold while using it.
+        """
+        key = PasswordGenerator.key_from_args(args)
+        with self.generators_lock:
+            item = self.generators.get(key)
+            if item is None:
+                item = (PasswordGenerator(args), threading.Lock())
+                self.generators[key] = item
+        return item
+
+    def handle_request_object(self, request):
+        """
+        Process the decoded JSON request `request` and return the answer object.
+        """
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            if request.get('metrics'):
+                if self.password_pool is None:
+                    return {'metrics': None}
+                return {'metrics': self.password_pool.metrics()}
+            count = request.get('count', 1)
+            if not isinstance(count, int) or isinstance(count, bool) \
+               or count < 0 or count > MAX_COUNT:
+                raise ValueError("Invalid count: %r"%(count,))
+            args = self.make_args(request)
+            for k in ('length', 'words'):
+                # the type was checked by make_args()
+                if request.get(k, 0) > MAX_LENGTH:
+                    raise ValueError("Invalid %s: %r (at most %d)"%(k, request[k], MAX_LENGTH))
+            if self.password_pool is not None:
+                pws = [ self.password_pool.get(args) for j in range(count) ]
+            else:
+                pwgen, lock = self.get_generator(args)
+                with lock:
+                    pws = [ pwgen.generate() for j in range(count) ]
+        except (ValueError, EntropyHealthError, EOFError) as e:
+            return {'error': str(e)}
+        return {'passwords': pws}
+
+    def server_close(self):
+        super(PasswordServer, self).server_close()
+        if self.password_pool is not None:
+            self.password_pool.close()
+        with self.generators_lock:
+            for pwgen, lock in self.generators.values():
+                pwgen.close()
+            self.generators = {}
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class PasswordRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                answer = {'error': "Invalid JSON request: %s"%(e)}
+            else:
+                answer = self.server.handle_request_object(request)
+            logger.debug("request %r -> %s", line,
+                         'error' if 'error' in answer else 'ok')
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def _remove_stale_socket(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ValueError("%s exists and is not a socket"%(path))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except ConnectionRefusedError:
+        # nobody is listening any more
+        os.unlink(path)
+        return
+    finally:
+        s.close()
+    raise ValueError("A server is already listening on %s"%(path))
+
+
+class PasswordClient(object):
+    """
+    Client for a `PasswordServer` listening on the Unix socket `path`.  The
+    connection is kept open for successive requests.
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, **request):
+        """
+        Send the request with the given fields (see the protocol description in
+        this module) and return the list of passwords.  Raises `ValueError` if
+        the server reports an error.
+        """
+        return self._roundtrip(request)['passwords']
+
+    def metrics(self):
+        """
+        Return the counters of the server's password pool, or `None` if the
+        server doesn't pool passwords.
+        """
+        return self._roundtrip({'metrics': True})['metrics']
+
+    def _roundtrip(self, request):
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the server")
+        answer = json.loads(line.decode('utf-8'))
+        if 'error' in answer:
+            raise ValueError(answer['error'])
+        return answer
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+import time
+import threading
+
+from ._logutil import get_logger
+
+from .mkpw import PasswordGenerator, STREAM_CHUNK_SIZE, args_with_policy, policy_from_args
+from .entropy import EntropySource, EntropySourcePool, open_entropy_source, \
+    make_entropy_source
+
+
+# Concurrency contract of SharedPasswordGenerator
+# -----------------------------------------------
+#
+#   - `generate()` and `generate_chunks()` may be called from any number of
+#     threads at the same time.
+#
+#   - Each thread gets its own `PasswordGenerator` (concentrator, optional DRBG
+#     and integer recoder), created on its first call and kept in
+#     thread-local storage.  None of that state is ever shared: leftover bits
+#     of one thread never end up in another thread's passwords, and the
+#     hashing of different threads runs without any lock.  (hashlib releases
+#     the GIL while hashing large blocks, so the threads' concentrators may
+#     even hash in parallel.)
+#
+#   - Entropy sources which several readers may use independently (see
+#     `EntropySource.parallel_safe`: `getrandom:`, devices such as
+#     /dev/urandom, reservoir files) are opened by each thread on its own, so
+#     that threads never wait for each other.  Other sources (the standard
+#     input, regular files) are shared, along with their health tests: reads
+#     from them are serialized by a single lock.  Each thread reads
+#     `SHARED_READ_SIZE` bytes at a time into a buffer of its own, from which
+#     its generator is fed, so that the lock is taken once for hundreds of
+#     passwords.  Every byte read goes to exactly one thread; what is left in
+#     a thread's buffer when its generator is dropped is never used.
+#     `contention()` tells which fraction of their time the threads spent
+#     waiting for the lock.
+#
+#   - The iterator returned by `generate_chunks()` must be consumed by the
+#     thread which called it.
+#
+#   - `close()` must not be called while other threads are generating; after
+#     `close()`, `generate()` raises `ValueError`.  The generator of a thread
+#     which has exited is dropped when a new thread makes its first call.
+#
+#   - Not fork-safe: a child process must create its own instance.
+
+
+# bytes which a thread reads from a shared entropy source at once
+SHARED_READ_SIZE = 1 << 16
+
+
+class _SharedSource(EntropySource):
+    """
+    Serializes the reads from the entropy source `source` (shared by all
+    threads) with `lock`, counting how often a thread had to wait for it, and
+    for how long.
+    """
+    def __init__(self, source, lock):
+        super(_SharedSource, self).__init__(getattr(source, 'spec', None))
+        self.source = source
+        self.lock = lock
+        self.reads = 0
+        self.contended_reads = 0
+        self.wait_time = 0.0
+
+    def _acquire(self):
+        if not self.lock.acquire(blocking=False):
+            t0 = time.perf_counter()
+            self.lock.acquire()
+            self.wait_time += time.perf_counter() - t0
+            self.contended_reads += 1
+        self.reads += 1
+
+    def readinto(self, b):
+        self._acquire()
+        try:
+            return self.source.readinto(b)
+        finally:
+            self.lock.release()
+
+    def read(self, n):
+        self._acquire()
+        try:
+            return self.source.read(n)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # the shared source is closed by SharedPasswordGenerator
+        pass
+
+
+class _ThreadBuffer(EntropySource):
+    """
+    A thread's own buffer in front of the `_SharedSource` `shared`, refilled
+    with `size` bytes at a time, whatever the sizes of the thread's reads.
+    """
+    def __init__(self, shared, size=SHARED_READ_SIZE):
+        super(_ThreadBuffer, self).__init__(shared.spec)
+        self.shared = shared
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # unread data: buf[pos:end]
+        self.pos = 0
+        self.end = 0
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = len(out)
+        k = min(n, self.end - self.pos)
+        out[:k] = self.view[self.pos:self.pos+k]
+        self.pos += k
+        while k < n:
+            if n - k >= len(self.buf):
+                # large read, no need to go through the buffer
+                nread = self.shared.readinto(out[k:])
+            else:
+                nread = self.shared.readinto(self.view)
+                self.pos = 0
+                self.end = nread
+                nread = min(nread, n - k)
+                out[k:k+nread] = self.view[:nread]
+                self.pos = nread
+            if not nread:
+                break
+            k += nread
+        return k
+
+
+class SharedPasswordGenerator(object):
+    """
+    A password generator which can be shared by any number of threads, e.g.
+    the request handlers of a threaded web service.  See the concurrency
+    contract in this module.
+
+    Arguments:
+
+      - `args`: the password settings, as for `PasswordGenerator`.  A fixed
+        DRBG seed (`args.drbg_seed`) is refused, as all threads would then
+        generate the same passwords.
+
+      - `pool`: the `EntropySourcePool` from which to get the entropy source (by
+        default, `mkpw.entropy.default_entropy_pool`).
+
+      - `stats`: an optional `mkpw.stats.GenerationStats`.  Each thread counts
+        in its own instance; the counters are added to `stats` by
+        `collect_stats()` and `close()`.
+
+    The attribute `per_thread_sources` tells whether each thread opens the
+    entropy source on its own.  Otherwise, `reads` and `contended_reads` count
+    the reads from the shared source and those for which the lock was taken by
+    another thread, `wait_time` is the total time threads spent waiting for
+    it (see `contention()`), and `health` holds the shared
+    `mkpw.health.HealthTests` (if enabled).
+    """
+
+    def __init__(self, args, pool=None, stats=None):
+
+        if getattr(args, 'drbg_seed', None) is not None:
+            raise ValueError("Can't share a generator with a fixed DRBG seed between "
+                             "threads, all threads would generate the same passwords")
+
+        self.args = args_with_policy(args, {})
+        self.stats = stats
+
+        self.lock = threading.Lock()
+        self.health = None
+        self._health_stats = None
+
+        source = open_entropy_source(args.entropy_file, pool=pool)
+        self.per_thread_sources = (getattr(source, 'parallel_safe', False)
+                                   and _can_open(args.entropy_file))
+        if self.per_thread_sources:
+            self.source = None
+        else:
+            self._init_shared_source(source, args)
+
+        self.local = threading.local()
+        # [ (thread, pwgen, pool, busy), ... ] for all threads which have a
+        # generator, where busy[0] is the time the thread spent generating;
+        # protected by self.generators_lock
+        self.generators = []
+        self.generators_lock = threading.Lock()
+        self.closed = False
+        # time spent generating by the threads whose generators were dropped
+        self._retired_busy_time = 0.0
+
+        # compiled once (and cached), then shared by the threads' generators;
+        # this also raises right away if the settings are invalid
+        self.policy = policy_from_args(self.args)
+
+    def _init_shared_source(self, source, args):
+        # the health tests run once on the shared source, not in each thread
+        self.args = self.args._replace(health_tests='off')
+        health_policy = getattr(args, 'health_tests', None)
+        if health_policy and health_policy != 'off':
+            from .health import HealthTestedSource
+            if self.stats is not None:
+                from .stats import GenerationStats
+                self._health_stats = GenerationStats()
+            source = HealthTestedSource(source, args.in_entropy_rate, policy=health_policy,
+                                        stats=self._health_stats)
+            self.health = source.tests
+        self.source = _SharedSource(source, self.lock)
+
+    def _get(self):
+        state = getattr(self.local, 'state', None)
+        if state is not None:
+            return state
+        if self.closed:
+            raise ValueError("SharedPasswordGenerator is closed")
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        stats = None
+        if self.stats is not None:
+            from .stats import GenerationStats
+            stats = GenerationStats()
+        # the thread's own pool: its own source, or the shared one
+        pool = EntropySourcePool()
+        if not self.per_thread_sources:
+            pool.add(self.args.entropy_file, _ThreadBuffer(self.source))
+        pwgen = PasswordGenerator(self.args, pool=pool, stats=stats)
+        thread = threading.current_thread()
+        logger.debug("new generator for thread %s", thread.name)
+        state = (thread, pwgen, pool, [ 0.0 ])
+        with self.generators_lock:
+            if self.closed:
+                pool.close()
+                raise ValueError("SharedPasswordGenerator is closed")
+            self._prune()
+            self.generators.append(state)
+        self.local.state = state
+        return state
+
+    def _prune(self):
+        # drop the generators of threads which have exited (with
+        # self.generators_lock held)
+        alive = []
+        for state in self.generators:
+            if state[0].is_alive():
+                alive.append(state)
+            else:
+                self._retire(state)
+        self.generators = alive
+
+    def _retire(self, state):
+        thread, pwgen, pool, busy = state
+        self._retired_busy_time += busy[0]
+        stats = pwgen.stats
+        pwgen.close()
+        pool.close()
+        if stats is not None:
+            self.stats.merge(stats)
+
+    def generate(self):
+        """
+        Generate and return a new password, using the calling thread's
+        generator.
+        """
+        state = self._get()
+        t0 = time.perf_counter()
+        try:
+            return state[1].generate()
+        finally:
+            state[3][0] += time.perf_counter() - t0
+
+    def generate_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Generate a new password in pieces, see
+        `PasswordGenerator.generate_chunks()`.
+        """
+        state = self._get()
+        return self._timed_chunks(state[1].generate_chunks(chunk_size), state[3])
+
+    def _timed_chunks(self, chunks, busy):
+        # count the time spent producing the chunks, not that spent by the
+        # caller in between
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                busy[0] += time.perf_counter() - t0
+            yield chunk
+
+    def busy_time(self):
+        """
+        Return the total time the threads have spent in `generate()` so far.
+        """
+        with self.generators_lock:
+            return self._retired_busy_time + sum([ state[3][0] for state in self.generators ])
+
+    def contention(self):
+        """
+        Return the fraction of the time spent generating passwords (by all
+        threads together) which threads spent waiting for another one to finish
+        reading from the shared entropy source; 0 with per-thread sources.
+        """
+        busy = self.busy_time()
+        return min(1.0, self.wait_time / busy) if busy > 0 else 0.0
+
+    @property
+    def reads(self):
+        return self.source.reads if self.source is not None else 0
+
+    @property
+    def contended_reads(self):
+        return self.source.contended_reads if self.source is not None else 0
+
+    @property
+    def wait_time(self):
+        return self.source.wait_time if self.source is not None else 0.0
+
+    def collect_stats(self):
+        """
+        Add the counters of all threads so far to `stats` (given to the
+        constructor), and reset them.  Should be called while no thread is
+        generating, e.g. after joining the worker threads.  Returns `stats`.
+        """
+        if self.stats is None:
+            return None
+        with self.generators_lock:
+            for thread, pwgen, pool, busy in self.generators:
+                self.stats.merge(pwgen.stats)
+                pwgen.stats.reset()
+        if self._health_stats is not None:
+            with self.lock:
+                self.stats.merge(self._health_stats)
+                self._health_stats.reset()
+        return self.stats
+
+    def close(self):
+        """
+        Drop the generators of all threads, adding their counters to `stats`,
+        and close the sources which the threads opened on their own.  The
+        shared entropy source belongs to the pool and is left open.
+        """
+        with self.generators_lock:
+            self.closed = True
+            generators = self.generators
+            self.generators = []
+        for state in generators:
+            self._retire(state)
+        if self._health_stats is not None:
+            self.stats.merge(self._health_stats)
+            self._health_stats.reset()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _can_open(spec):
+    # whether each thread can open the entropy source `spec` on its own (it
+    # might be a source which was added to a pool under a made-up name)
+    try:
+        make_entropy_source(spec).close()
+    except (ValueError, OSError, EOFError):
+        return False
+    return True
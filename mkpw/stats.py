@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import math
+import time
+import contextlib
+
+
+
+class GenerationStats(object):
+    """
+    Counters collecting where the randomness and the time go while generating
+    passwords.
+
+    An instance can be given as the `stats` argument of
+    `RandomSourceConcentrator`, `RandomStreamIntRecoder`, `PasswordGenerator` or
+    `generate_passwords()`, which then update it.  When no stats object is
+    given (the default), none of the counting is done.
+
+    Counters:
+
+      - `source_reads`, `source_bytes`: number of reads and of raw bytes read
+        from the entropy source by the concentrator (including bytes read
+        ahead which were not used yet);
+
+      - `hash_blocks`, `hashed_bytes`, `concentrated_bytes`: number of hash
+        blocks computed, of raw bytes absorbed by the hash, and of
+        concentrated bytes handed out by the concentrator;
+
+      - `recoder_bytes_in`: bytes read by the integer recoder (from the
+        concentrator, or directly from the source if there is no concentration
+        step);
+
+      - `ints_output`, `bits_output`: number of random integers produced by the
+        recoder, and their total entropy in bits (`log2(n)` for an integer in
+        `{0, ..., n-1}`);
+
+      - `bits_rejected`: bits drawn by the recoder which fell out of range;
+
+      - `waste_bits_recycled`: bits recovered from the recoder's waste;
+
+      - `bits_left`: bits left unused in the recoder's buffer at the end;
+
+      - `passwords`: number of passwords generated;
+
+      - `health_samples`, `health_failures`, `health_discarded_bytes`: number
+        of raw bytes which went through the health tests, number of failed
+        tests, and number of bytes dropped because of failures (see
+        `mkpw.health`);
+
+      - `drbg_seed_bytes`, `drbg_bytes`, `drbg_reseeds`: number of bytes read
+        by the DRBG as entropy input (to instantiate and reseed it), of bytes
+        generated by the DRBG, and number of times it was reseeded (see
+        `mkpw.drbg`).
+
+    The attribute `times` holds the wall-clock time in seconds spent in each
+    stage: `'read'` (the concentrator reading the source, including the health
+    tests; without concentration, reads count as `'recode'`), `'hash'`
+    (concentrating), `'drbg'` (generating the DRBG output), `'recode'` (turning
+    random bytes into passwords: the integer recoder and the assembly of the
+    password, excluding the time of the stages before it), and `'total'` if
+    set by the caller (see `timer()`).
+    """
+
+    # stages which run beneath the recoder, see add_recode_time()
+    INPUT_STAGES = ('read', 'hash', 'drbg')
+
+    COUNTERS = (
+        'source_reads',
+        'source_bytes',
+        'hash_blocks',
+        'hashed_bytes',
+        'concentrated_bytes',
+        'recoder_bytes_in',
+        'ints_output',
+        'bits_output',
+        'bits_rejected',
+        'waste_bits_recycled',
+        'bits_left',
+        'passwords',
+        'health_samples',
+        'health_failures',
+        'health_discarded_bytes',
+        'drbg_seed_bytes',
+        'drbg_bytes',
+        'drbg_reseeds',
+    )
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for c in self.COUNTERS:
+            setattr(self, c, 0)
+        self.times = {}
+
+    def add_time(self, stage, dt):
+        self.times[stage] = self.times.get(stage, 0.0) + dt
+
+    def input_time(self):
+        """
+        Return the total time spent so far in the `INPUT_STAGES`.
+        """
+        times = self.times
+        return sum([ times.get(stage, 0.0) for stage in self.INPUT_STAGES ])
+
+    def add_recode_time(self, dt, input_time):
+        """
+        Add the time `dt` spent generating to the 'recode' stage, minus the time
+        spent in the input stages meanwhile; `input_time` is the value of
+        `input_time()` when generation started.
+        """
+        self.add_time('recode', dt - (self.input_time() - input_time))
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Context manager which adds the wall-clock time spent in the `with` block
+        to the stage `stage`.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    def count_output(self, n, count=1):
+        """
+        Record that `count` random integers in `{0, ..., n-1}` were produced.
+        """
+        self.ints_output += count
+        if n > 1:
+            self.bits_output += count * math.log2(n)
+
+    def consumed_bits(self):
+        """
+        Return the number of raw bits consumed from the entropy source: those
+        absorbed by the concentrator's hash (bytes read ahead but not used yet
+        don't count), or if there is no concentration step, those read as
+        entropy input by the DRBG or else those read by the recoder.  The
+        DRBG's output is not raw entropy and doesn't count.
+        """
+        if self.hashed_bytes:
+            return 8 * self.hashed_bytes
+        if self.drbg_bytes:
+            return 8 * self.drbg_seed_bytes
+        return 8 * self.recoder_bytes_in
+
+    def efficiency(self):
+        """
+        Return the entropy efficiency, i.e., the entropy of the output divided
+        by the number of raw bits consumed, or `None` if nothing was consumed.
+        """
+        consumed = self.consumed_bits()
+        if not consumed:
+            return None
+        return self.bits_output / consumed
+
+    def as_dict(self):
+        d = dict([ (c, getattr(self, c)) for c in self.COUNTERS ])
+        d['times'] = dict(self.times)
+        return d
+
+    def merge(self, other):
+        """
+        Add the counters of `other` (a `GenerationStats` or a dictionary as
+        returned by `as_dict()`) to this object.
+        """
+        if isinstance(other, GenerationStats):
+            other = other.as_dict()
+        for c in self.COUNTERS:
+            setattr(self, c, getattr(self, c) + other.get(c, 0))
+        for stage, dt in other.get('times', {}).items():
+            self.add_time(stage, dt)
+
+    def format_report(self):
+        """
+        Return a human-readable report of the collected statistics.
+        """
+        lines = []
+        lines.append("passwords generated:        %d"%(self.passwords))
+        lines.append("source reads / bytes:       %d / %d"%(self.source_reads, self.source_bytes))
+        lines.append("hash blocks:                %d (%d bytes absorbed, %d bytes handed out)"%(
+            self.hash_blocks, self.hashed_bytes, self.concentrated_bytes))
+        lines.append("recoder input bytes:        %d"%(self.recoder_bytes_in))
+        lines.append("integers output:            %d (%.1f bits of entropy)"%(
+            self.ints_output, self.bits_output))
+        lines.append("bits rejected:              %d"%(self.bits_rejected))
+        lines.append("waste bits recycled:        %d"%(self.waste_bits_recycled))
+        lines.append("bits left in buffer:        %d"%(self.bits_left))
+        if self.health_samples:
+            lines.append("health tests:               %d bytes tested, %d failures, "
+                         "%d bytes discarded"%(self.health_samples, self.health_failures,
+                                               self.health_discarded_bytes))
+        if self.drbg_bytes:
+            lines.append("DRBG seed input bytes:      %d"%(self.drbg_seed_bytes))
+            lines.append("DRBG output bytes / reseeds: %d / %d"%(self.drbg_bytes,
+                                                                 self.drbg_reseeds))
+        eff = self.efficiency()
+        if eff is not None:
+            lines.append("entropy efficiency:         %.4f (output bits / consumed bits%s)"%(
+                eff, ", pseudorandom" if self.drbg_bytes else ""))
+        for stage in sorted(self.times.keys()):
+            lines.append("time %-22s %.6f s"%(stage + ':', self.times[stage]))
+        return "\n".join(lines)
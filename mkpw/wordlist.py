@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import mmap
+import array
+import struct
+import functools
+
+from ._logutil import get_logger
+
+
+# Word lists
+# ----------
+#
+# A word list is a text file (UTF-8) with one word per line.  Blank lines are
+# ignored, as is a leading dice-roll number followed by whitespace (as in the
+# usual diceware lists, e.g. "11111<TAB>abacus").
+#
+# The list is memory-mapped and never read as a whole.  To pick the i-th word
+# in constant time, we keep an index of the byte offsets at which each word
+# starts.  The index is built once and stored beside the list, in
+# "<wordlist>.mkpwidx":
+#
+#   - header: magic b'MKPWIDX1', then the size and modification time (in ns) of
+#     the word list it was built for, and the number of words, as
+#     little-endian unsigned 64-bit integers;
+#
+#   - the offsets of the start of each word, as little-endian unsigned 64-bit
+#     integers.
+#
+# The index is rebuilt whenever the size or the modification time of the list
+# doesn't match.
+
+INDEX_SUFFIX = '.mkpwidx'
+
+_INDEX_MAGIC = b'MKPWIDX1'
+_INDEX_HEADER = struct.Struct('<8sQQQ')
+_INDEX_OFFSET = struct.Struct('<Q')
+
+# start of the word on each non-blank line
+_WORD_START_RX = None
+
+def _word_start_rx():
+    global _WORD_START_RX
+    if _WORD_START_RX is None:
+        import re
+        _WORD_START_RX = re.compile(rb'^[ \t]*(?:[0-9]+[ \t]+)?(?=\S)', re.MULTILINE)
+    return _WORD_START_RX
+
+
+class Wordlist(object):
+    """
+    A memory-mapped word list with an on-disk offset index (see the format
+    description in this module).  `len(wordlist)` is the number of words, and
+    `wordlist[i]` returns the `i`-th word as a `str`.
+
+    Don't instantiate directly; use `open_wordlist()`, which caches open word
+    lists.
+    """
+    def __init__(self, path):
+
+        logger = get_logger(__name__ + "." + self.__class__.__name__)
+
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size == 0:
+                raise ValueError("Word list %s is empty"%(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+
+        self.index = self._load_index()
+        if self.index is None:
+            logger.debug("building word index for %s", path)
+            self.index = self._build_index()
+            try:
+                self._save_index(self.index)
+            except OSError as e:
+                # we can still use the index we built, only we'll have to
+                # build it again next time
+                logger.warning("Can't store the word index for %s: %s", path, e)
+
+        magic, size, mtime_ns, self.count = _INDEX_HEADER.unpack_from(self.index, 0)
+        if self.count == 0:
+            raise ValueError("Word list %s has no words"%(path))
+
+    def _load_index(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_size < _INDEX_HEADER.size:
+                return None
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, mtime_ns, count = _INDEX_HEADER.unpack_from(index, 0)
+        if (magic != _INDEX_MAGIC or size != self.size or mtime_ns != self.mtime_ns
+            or len(index) != _INDEX_HEADER.size + count*_INDEX_OFFSET.size):
+            index.close()
+            return None
+        return index
+
+    def _build_index(self):
+        offsets = array.array('Q', (m.end() for m in _word_start_rx().finditer(self.mm)))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        header = _INDEX_HEADER.pack(_INDEX_MAGIC, self.size, self.mtime_ns, len(offsets))
+        return header + offsets.tobytes()
+
+    def _save_index(self, index):
+        # write to a temporary file first, so that concurrent readers never see
+        # a partial index
+        tmppath = '%s.%d.tmp'%(self.index_path, os.getpid())
+        try:
+            with open(tmppath, 'wb') as f:
+                f.write(index)
+            os.replace(tmppath, self.index_path)
+        except OSError:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError("Word index out of range: %d"%(i))
+        start, = _INDEX_OFFSET.unpack_from(self.index, _INDEX_HEADER.size + i*_INDEX_OFFSET.size)
+        end = self.mm.find(b'\n', start)
+        if end < 0:
+            end = len(self.mm)
+        return self.mm[start:end].rstrip().decode('utf-8')
+
+    def close(self):
+        self.mm.close()
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+
+    def __repr__(self):
+        return "Wordlist(%r, %d words)"%(self.path, self.count)
+
+
+@functools.lru_cache(maxsize=16)
+def _open_wordlist(path, size, mtime_ns):
+    return Wordlist(path)
+
+def open_wordlist(path):
+    """
+    Return the `Wordlist` for the file `path`, building and storing its index if
+    needed.  Open word lists are cached, and reopened if the file changed.
+    """
+    st = os.stat(path)
+    return _open_wordlist(path, st.st_size, st.st_mtime_ns)
+
+
+class PassphrasePolicy(object):
+    """
+    The passphrase settings of a `GeneratePasswordArgs` with a word list: the
+    word list, the number of words, and the separator placed between words,
+    which is the separator string of `args.split` if it splits (the group
+    length is ignored), or a space.
+
+    Use `PassphrasePolicy.from_args()`.
+    """
+    def __init__(self, wordlist, words, sepstr):
+        if words < 1:
+            raise ValueError("Expected at least one word")
+        self.wordlist = wordlist
+        self.words = words
+        self.sepstr = sepstr
+        self.wordlist_size = len(wordlist)
+        # upper bound of the number of random bits drawn per passphrase, not
+        # counting rejected draws
+        self.draw_bits = words * (self.wordlist_size - 1).bit_length()
+
+    @staticmethod
+    def key_from_args(args):
+        """
+        Return a hashable key identifying the passphrase-related fields of
+        `args`.
+        """
+        split = args.split
+        sepstr = split.sepstr if split.num > 0 else ' '
+        return (args.wordlist, args.words, sepstr)
+
+    @staticmethod
+    def from_args(args):
+        wordlist, words, sepstr = PassphrasePolicy.key_from_args(args)
+        try:
+            wl = open_wordlist(wordlist)
+        except OSError as e:
+            raise ValueError("Can't open word list: %s"%(e))
+        return PassphrasePolicy(wl, words, sepstr)
+
+    def __repr__(self):
+        return "PassphrasePolicy(wordlist=%r,words=%r,sepstr=%r)"%(
+            self.wordlist.path, self.words, self.sepstr)
+
+
+def _generate_one_passphrase(policy, rndgen):
+
+    logger = get_logger(__name__ + "._generate_one_passphrase()")
+
+    wordlist = policy.wordlist
+    n = policy.wordlist_size
+
+    words = []
+    for j in range(policy.words):
+        x = rndgen.getInt(n)
+        words.append(wordlist[x])
+        logger.debug("got word: %r (x=%d)", words[-1], x)
+
+    return policy.sepstr.join(words)
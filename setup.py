@@ -9,6 +9,9 @@ setup(name='mkpw',
       author_email='phfa'+str('ist@gm'+'ail')+'.com',
       url='https://github.com/phfaist/mkpw/',
       packages=['mkpw'],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       entry_points={
           'console_scripts': [
               'mkpw = mkpw.__main__:main'